@@ -10,7 +10,7 @@ import torch.nn.functional as F
 from .llama import Transformer, ModelArgs, RMSNorm
 from .tokenizer import Tokenizer
 from .misc import download
-from .utils import sample_top_p
+from .sampling import sample
 
 from ImageBind.models import imagebind_model
 
@@ -229,7 +229,9 @@ class LLaMA_adapter(nn.Module):
             top_p: float = 0.75,
             cache_size=10,
             cache_t=20,
-            cache_weight=0.5
+            cache_weight=0.5,
+            top_k=0,
+            repetition_penalty=1.0
     ):
         bsz = len(prompts)
         params = self.llama.params
@@ -256,12 +258,8 @@ class LLaMA_adapter(nn.Module):
         for cur_pos in range(start_pos, total_len):
             with torch.cuda.amp.autocast():
                 logits = self.forward_inference(visual_query, tokens[:, prev_pos:cur_pos], prev_pos)
-            if temperature > 0:
-                probs = torch.softmax(logits / temperature, dim=-1)
-                next_token = sample_top_p(probs, top_p)
-            else:
-                next_token = torch.argmax(logits, dim=-1)
-            next_token = next_token.reshape(-1)
+            next_token = sample(logits, temperature, top_p, top_k, repetition_penalty,
+                                prev_tokens=tokens[:, :cur_pos])
 
             next_token = torch.where(
                 input_text_mask[:, cur_pos], tokens[:, cur_pos], next_token
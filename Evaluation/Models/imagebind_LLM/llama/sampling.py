@@ -0,0 +1,70 @@
+import torch
+
+
+def _per_row(value, bsz, device, dtype):
+    if torch.is_tensor(value):
+        return value.to(device=device, dtype=dtype).reshape(-1).expand(bsz)
+    return torch.full((bsz,), value, device=device, dtype=dtype)
+
+
+def apply_repetition_penalty_(logits, prev_tokens, penalty):
+    """CTRL style repetition penalty, in place: the logits of tokens in prev_tokens [bsz, n] are divided by
+    penalty [bsz] (multiplied if negative)."""
+    score = logits.gather(-1, prev_tokens)
+    penalty = penalty[:, None]
+    logits.scatter_(-1, prev_tokens, torch.where(score < 0, score * penalty, score / penalty))
+    return logits
+
+
+def _candidates(logits, k, top_k, top_p):
+    # probabilities of the k most likely tokens under the full softmax, restricted to each row's top_k
+    # (and renormalised there) and cut to the nucleus; complete is False where the nucleus may reach past k
+    vals, idx = logits.topk(k, dim=-1)
+    probs = vals.sub_(logits.logsumexp(dim=-1, keepdim=True)).exp_()
+    limited = top_k > 0
+    rank = torch.arange(k, device=logits.device)
+    probs.masked_fill_(limited[:, None] & (rank >= top_k[:, None]), 0.0)
+    probs.div_(torch.where(limited, probs.sum(dim=-1), torch.ones_like(top_p))[:, None])
+    cum = probs.cumsum(dim=-1)
+    complete = limited | (cum[:, -1] > top_p) | (k == logits.shape[-1])
+    probs.masked_fill_(cum - probs > top_p[:, None], 0.0)
+    return probs, idx, complete
+
+
+@torch.no_grad()
+def sample(logits, temperature=0.1, top_p=0.75, top_k=0, repetition_penalty=1.0, prev_tokens=None,
+           num_candidates=64):
+    """Sample the next token of every row of logits [bsz, vocab]. Returns [bsz] token ids.
+
+    temperature, top_p, top_k and repetition_penalty are floats/ints or per-row tensors. Rows with
+    temperature <= 0 are greedy, top_k <= 0 disables the top-k cut. The repetition penalty applies to the
+    tokens in prev_tokens [bsz, n]. logits is modified in place.
+
+    Instead of sorting the whole vocabulary, only the max(num_candidates, top_k) most likely tokens are
+    considered; their probabilities are taken from the full softmax, so for rows whose nucleus closes
+    within them this is exactly sample_top_p(softmax(logits / temperature), top_p). The remaining rows
+    (very flat distributions or top_p close to 1) are sorted fully.
+    """
+    bsz, vocab = logits.shape
+    device = logits.device
+    if prev_tokens is not None and prev_tokens.shape[-1] > 0 and (
+            torch.is_tensor(repetition_penalty) or repetition_penalty != 1.0):
+        apply_repetition_penalty_(logits, prev_tokens, _per_row(repetition_penalty, bsz, device, logits.dtype))
+
+    if not torch.is_tensor(temperature) and temperature <= 0:
+        return logits.argmax(dim=-1)
+    temperature = _per_row(temperature, bsz, device, logits.dtype)
+    top_p = _per_row(top_p, bsz, device, logits.dtype)
+    top_k = _per_row(top_k, bsz, device, torch.long)
+    greedy = temperature <= 0
+    next_token = logits.argmax(dim=-1)
+
+    logits.div_(torch.where(greedy, torch.ones_like(temperature), temperature)[:, None])
+    k = min(vocab, max(num_candidates, int(top_k.max())))
+    probs, idx, complete = _candidates(logits, k, top_k, top_p)
+    sampled = idx.gather(-1, torch.multinomial(probs, num_samples=1)).squeeze(-1)
+    incomplete = (~complete & ~greedy).nonzero().squeeze(-1)
+    if incomplete.numel():
+        probs, idx, _ = _candidates(logits[incomplete], vocab, top_k[incomplete], top_p[incomplete])
+        sampled[incomplete] = idx.gather(-1, torch.multinomial(probs, num_samples=1)).squeeze(-1)
+    return torch.where(greedy, next_token, sampled)
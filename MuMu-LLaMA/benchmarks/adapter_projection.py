@@ -0,0 +1,95 @@
+"""Per-token decode cost of the adapted layers with and without precomputed adapter projections.
+
+Runs the last 3 * query_layer layers of a randomly initialised LLaMA (the layers MuMu_LLaMA feeds the
+audio/image/video adapters into) for a batch of decode steps, once projecting the adapters at every step
+(forward_inference without `adapters`) and once with Attention.project_adapter() results computed up front.
+
+    python benchmarks/adapter_projection.py --device cuda --dtype float16
+    python benchmarks/adapter_projection.py --dim 1024 --n_heads 8   # CPU sized
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import torch
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from llama.llama import ModelArgs, Transformer  # noqa: E402
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--dim', default=4096, type=int)
+parser.add_argument('--n_heads', default=32, type=int)
+parser.add_argument('--n_layers', default=18, type=int, help='adapted layers, 3 * query_layer in MuMu_LLaMA')
+parser.add_argument('--batch_size', default=1, type=int)
+parser.add_argument('--prompt_len', default=64, type=int)
+parser.add_argument('--steps', default=64, type=int)
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+parser.add_argument('--dtype', default='float32', type=str)
+args = parser.parse_args()
+
+dtype = getattr(torch, args.dtype)
+torch.manual_seed(0)
+model_args = ModelArgs(dim=args.dim, n_heads=args.n_heads, n_layers=args.n_layers, vocab_size=32008,
+                       max_seq_len=args.prompt_len + args.steps + 1, max_batch_size=args.batch_size)
+model = Transformer(model_args).to(args.device, dtype).eval()
+for layer in model.layers:
+    torch.nn.init.normal_(layer.attention.gate, std=0.1)
+
+# modality features + prefix query, one (bsz, 1, dim) adapter prompt per layer
+adapter_inputs = [torch.randn(args.batch_size, 1, args.dim, device=args.device, dtype=dtype)
+                  for _ in model.layers]
+tokens = torch.randint(0, 32000, (args.batch_size, args.prompt_len + args.steps), device=args.device)
+freqs_cis = model.freqs_cis.to(args.device)
+
+
+def sync():
+    if args.device.startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+@torch.inference_mode()
+def run(precompute):
+    kv_cache = model.kv_cache
+    seq_ids = [kv_cache.allocate(model_args.max_seq_len) for _ in range(args.batch_size)]
+
+    def forward(start_pos, seqlen, adapters):
+        positions = start_pos + torch.arange(seqlen, device=args.device).expand(args.batch_size, seqlen)
+        kv_cache.bind(seq_ids, positions)
+        h = model.tok_embeddings(tokens[:, start_pos:start_pos + seqlen])
+        mask = None
+        if seqlen > 1:
+            mask = torch.triu(torch.full((seqlen, seqlen), float("-inf"), device=args.device), diagonal=1)
+            mask = mask.type_as(h)
+        if adapters is None:
+            adapters = adapter_inputs
+        for layer, adapter in zip(model.layers, adapters):
+            h = layer(h, start_pos, freqs_cis[start_pos:start_pos + seqlen], mask, adapter)
+        kv_cache.unbind()
+        return h
+
+    try:
+        adapters = None
+        if precompute:
+            adapters = [layer.attention.project_adapter(a) for layer, a in zip(model.layers, adapter_inputs)]
+        out = [forward(0, args.prompt_len, adapters)[:, -1]]
+        sync()
+        start = time.time()
+        for pos in range(args.prompt_len, args.prompt_len + args.steps):
+            out.append(forward(pos, 1, adapters)[:, -1])
+        sync()
+        elapsed = time.time() - start
+    finally:
+        for seq_id in seq_ids:
+            kv_cache.free(seq_id)
+    return elapsed / args.steps, torch.stack(out, dim=1)
+
+
+run(False)  # warm up
+per_step, reference = run(False)
+per_step_cached, cached = run(True)
+print(f"layers={args.n_layers} dim={args.dim} batch={args.batch_size} device={args.device} dtype={args.dtype}")
+print(f"adapters projected every step: {per_step * 1000:.3f} ms/token")
+print(f"adapters projected once:       {per_step_cached * 1000:.3f} ms/token "
+      f"({(1 - per_step_cached / per_step) * 100:.1f}% less)")
+print(f"max abs difference: {(reference - cached).abs().max().item():.3e}")
@@ -0,0 +1,212 @@
+"""Equivalence and speed of the attention backends of llama.llama.Attention (ATTENTION_BACKENDS).
+
+Runs a randomly initialised Transformer with gated adapters in every layer through the cases the model
+uses: causal prefill, prefill at an offset behind cached keys (prefix cache hits, speculative verification),
+decode steps, left padding and per-row positions (dense masks), and single and multi-token adapter prompts
+(the gated adapter branch). Every backend is compared against the reference backend on the logits, with full
+multi-head attention and grouped-query attention (both the enable_gqa kernel of torch >= 2.5 and the repeated
+keys/values of older versions), and timed on prefill and decode. Exits with status 1 if any case differs by more
+than the tolerance. The check is seeded and runs with torch.empty/torch.empty_like filling their memory with NaN, so
+reading memory nobody wrote (e.g. the padding of the KV cache) always fails instead of passing by chance.
+
+    python benchmarks/attention_backends.py
+    python benchmarks/attention_backends.py --device cuda --dtype float16 --dim 4096 --n_heads 32
+    python benchmarks/attention_backends.py --n_kv_heads 2 --skip_timing
+"""
+import argparse
+import contextlib
+import sys
+import time
+from pathlib import Path
+
+import torch
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import llama.llama as llama_module  # noqa: E402
+from llama.llama import ATTENTION_BACKENDS, CausalMask, ModelArgs, Transformer  # noqa: E402
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--dim', default=512, type=int)
+parser.add_argument('--n_heads', default=8, type=int)
+parser.add_argument('--n_kv_heads', default=[None, 2], type=int, nargs='+',
+                    help='key/value heads of each model to check, fewer than n_heads for grouped-query attention '
+                         '(default: n_heads and 2)')
+parser.add_argument('--n_layers', default=4, type=int)
+parser.add_argument('--batch_size', default=2, type=int)
+parser.add_argument('--prompt_len', default=128, type=int)
+parser.add_argument('--steps', default=32, type=int)
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+parser.add_argument('--dtype', default='float32', type=str)
+parser.add_argument('--skip_timing', action='store_true')
+args = parser.parse_args()
+
+dtype = getattr(torch, args.dtype)
+tolerance = 1e-4 if dtype == torch.float32 else 2e-2
+bsz, n = args.batch_size, args.prompt_len
+torch.manual_seed(0)
+tokens = torch.randint(0, 1000, (bsz, n + max(args.steps, 8)), device=args.device)
+adapter_1 = torch.randn(bsz, 1, args.dim, device=args.device, dtype=dtype)
+adapter_4 = torch.randn(1, 4, args.dim, device=args.device, dtype=dtype)
+
+
+def build(n_kv_heads):
+    torch.manual_seed(0)
+    model_args = ModelArgs(dim=args.dim, n_heads=args.n_heads, n_kv_heads=n_kv_heads, n_layers=args.n_layers,
+                           vocab_size=1000, max_seq_len=n + max(args.steps, 8) + 16, max_batch_size=bsz)
+    model = Transformer(model_args).to(args.device, dtype).eval()
+    for name, p in model.named_parameters():
+        if 'gate' in name or 'lora' in name:
+            torch.nn.init.normal_(p, std=0.1)
+    return model
+
+
+@contextlib.contextmanager
+def nan_filled_empty():
+    empty, empty_like = torch.empty, torch.empty_like
+
+    def poisoned(fn):
+        def wrapper(*a, **kw):
+            out = fn(*a, **kw)
+            return out.fill_(float("nan")) if out.is_floating_point() else out
+        return wrapper
+
+    torch.empty, torch.empty_like = poisoned(empty), poisoned(empty_like)
+    try:
+        yield
+    finally:
+        torch.empty, torch.empty_like = empty, empty_like
+
+
+def sync():
+    if args.device.startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+@torch.inference_mode()
+def layers(x_tokens, start_pos, mask, adapter=None, seq_ids=None, positions=None):
+    # logits of the Transformer with an optional adapter in each layer, KV cache bound when seq_ids are given
+    _bsz, seqlen = x_tokens.shape
+    if seq_ids is not None:
+        if positions is None:
+            positions = start_pos + torch.arange(seqlen, device=args.device).expand(_bsz, seqlen)
+        model.kv_cache.bind(seq_ids, positions)
+    try:
+        h = model.tok_embeddings(x_tokens)
+        rope = model.rope(start_pos, seqlen, h.device)
+        for layer in model.layers:
+            h = layer(h, start_pos if seq_ids is None else 0, rope, mask,
+                      None if adapter is None else adapter)
+        return model.output(model.norm(h)).float()
+    finally:
+        if seq_ids is not None:
+            model.kv_cache.unbind()
+
+
+@torch.inference_mode()
+def decode(adapter, steps):
+    # prefill the first n - 8 tokens, prefill 8 more at an offset, then decode steps tokens one by one
+    seq_ids = [model.kv_cache.allocate(n + steps) for _ in range(bsz)]
+    try:
+        out = [layers(tokens[:, :n - 8], 0, CausalMask(0, n - 8), adapter, seq_ids)]
+        out.append(layers(tokens[:, n - 8:n], n - 8, CausalMask(n - 8, 8), adapter, seq_ids))
+        for pos in range(n, n + steps):
+            out.append(layers(tokens[:, pos:pos + 1], pos, None, adapter, seq_ids))
+        return torch.cat(out, dim=1)
+    finally:
+        for seq_id in seq_ids:
+            model.kv_cache.free(seq_id)
+
+
+def left_padded(adapter):
+    # first row padded by 5 tokens, padding queries only see themselves
+    pad = torch.zeros(bsz, n, dtype=torch.bool, device=args.device)
+    pad[0, :5] = True
+    self_key = torch.eye(n, dtype=torch.bool, device=args.device)
+    mask = torch.zeros(bsz, 1, n, n, device=args.device)
+    mask = mask.masked_fill(pad[:, None, None, :] & ~self_key, float("-inf")) + CausalMask(0, n).dense(args.device)
+    return layers(tokens[:, :n], 0, mask.to(dtype), adapter)
+
+
+@torch.inference_mode()
+def per_row(adapter):
+    # rows at different positions (continuous batching): row i has i * 3 more cached tokens
+    seq_ids = [model.kv_cache.allocate(n + 8) for _ in range(bsz)]
+    try:
+        starts = [n - 8 - 3 * i for i in range(bsz)]
+        for seq_id, start in zip(seq_ids, starts):
+            layers(tokens[:1, :start], 0, CausalMask(0, start), adapter if adapter is None else adapter[:1],
+                   [seq_id])
+        start_pos = torch.tensor(starts, device=args.device)
+        positions = start_pos[:, None]
+        key_pos = torch.arange(int(positions.max()) + 1, device=args.device)
+        mask = torch.zeros(bsz, 1, 1, len(key_pos), device=args.device)
+        mask = mask.masked_fill(key_pos > positions[:, None, :, None], float("-inf")).to(dtype)
+        x = torch.stack([tokens[i, s:s + 1] for i, s in enumerate(starts)])
+        return layers(x, start_pos, mask, adapter, seq_ids, positions=positions)
+    finally:
+        for seq_id in seq_ids:
+            model.kv_cache.free(seq_id)
+
+
+cases = {
+    'causal prefill': lambda a: layers(tokens[:, :n], 0, CausalMask(0, n), a),
+    'cached prefill + decode': lambda a: decode(a, 8),
+    'left padding': left_padded,
+    'per-row positions': per_row,
+}
+adapters = {'no adapter': None, 'adapter len 1': adapter_1, 'adapter len 4': adapter_4}
+
+
+
+def timeit(fn):
+    fn()
+    sync()
+    start = time.time()
+    fn()
+    sync()
+    return time.time() - start
+
+
+print(f"dim={args.dim} heads={args.n_heads} layers={args.n_layers} batch={bsz} prompt={n} "
+      f"device={args.device} dtype={args.dtype} torch={torch.__version__}")
+ok = True
+for n_kv_heads in args.n_kv_heads:
+    model = build(n_kv_heads)
+    grouped = model.layers[0].attention.n_rep > 1
+    # grouped keys/values go through the enable_gqa kernel or are repeated (the path of torch < 2.5)
+    gqa_paths = ([True, False] if llama_module._SDPA_GQA else [False]) if grouped else [llama_module._SDPA_GQA]
+    kv_heads = n_kv_heads or args.n_heads
+    for backend in ATTENTION_BACKENDS:
+        if backend == 'reference':
+            continue
+        for lower_right in ([True, False] if llama_module.causal_lower_right is not None else [False]):
+            for enable_gqa in gqa_paths:
+                saved = llama_module.causal_lower_right, llama_module._SDPA_GQA
+                if not lower_right:
+                    llama_module.causal_lower_right = None  # dense fallback of torch < 2.3
+                llama_module._SDPA_GQA = enable_gqa
+                path = ('lower-right bias' if lower_right else 'dense offset mask') + (
+                    ', ' + ('enable_gqa' if enable_gqa else 'repeat_kv') if grouped else '')
+                for case, fn in cases.items():
+                    for adapter_name, adapter in adapters.items():
+                        with nan_filled_empty():
+                            model.set_attention_backend('reference')
+                            ref = fn(adapter)
+                            model.set_attention_backend(backend)
+                            out = fn(adapter)
+                        err = (ref - out).abs().max().item()
+                        ok = ok and err < tolerance
+                        print(f"kv_heads {kv_heads:3d} {backend:5s} {path:29s} {case:24s} {adapter_name:14s} "
+                              f"max abs diff {err:.2e}{'' if err < tolerance else '   FAIL'}")
+                llama_module.causal_lower_right, llama_module._SDPA_GQA = saved
+
+    if not args.skip_timing:
+        for backend in ATTENTION_BACKENDS:
+            model.set_attention_backend(backend)
+            t_prefill = timeit(lambda: layers(tokens[:, :n], 0, CausalMask(0, n), adapter_1))
+            t_decode = timeit(lambda: decode(adapter_1, args.steps)) - t_prefill
+            print(f"kv_heads {kv_heads:3d} {backend:9s} prefill {t_prefill * 1e3:8.2f} ms   "
+                  f"decode {t_decode / args.steps * 1e3:7.3f} ms/token")
+
+print("equivalent" if ok else f"NOT equivalent (tolerance {tolerance})")
+sys.exit(0 if ok else 1)
@@ -0,0 +1,91 @@
+"""Latency and CLAP score of the AudioLDM2 sampler profiles (llama/audioldm2/profiles.py) on a fixture set of
+prompts, to choose --music_profile.
+
+Every profile generates one clip per prompt (seeded, so all profiles start from the same noise for a prompt) and
+is timed end to end: prompt encoding, UNet steps x candidates, VAE + vocoder and the CLAP ranking of the
+candidates. The returned clip is then scored against its prompt with CLAP as the cosine similarity of the text
+and audio embeddings, the same way (torchaudio resampling) for all profiles. A warm-up generation runs first.
+
+    python benchmarks/audioldm2_profiles.py --music_decoder_path cvssp/audioldm2-music
+    python benchmarks/audioldm2_profiles.py --profiles reference fast --scheduler unipc --steps 10 20 50
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from llama.audioldm2 import AudioLDM2Pipeline  # noqa: E402
+from llama.audioldm2.profiles import SAMPLER_PROFILES, SCHEDULERS, SCORING, apply_profile, get_profile  # noqa: E402
+
+FIXTURE_PROMPTS = (
+    "A calm piano melody with soft strings in the background.",
+    "Energetic rock music with distorted electric guitars and loud drums.",
+    "Upbeat electronic dance music with a heavy bass line.",
+    "A solo acoustic guitar playing a slow folk tune.",
+    "Jazz with a walking double bass, brushed drums and a saxophone.",
+    "An orchestral film score with brass and timpani building tension.",
+)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--music_decoder_path', default="cvssp/audioldm2-music", type=str)
+parser.add_argument('--profiles', default=list(SAMPLER_PROFILES), nargs='+', choices=list(SAMPLER_PROFILES))
+parser.add_argument('--scheduler', default=None, type=str, choices=SCHEDULERS,
+                    help='Override the scheduler of every profile')
+parser.add_argument('--steps', default=None, type=int, nargs='+',
+                    help='Run every profile once per step count instead of its own')
+parser.add_argument('--candidates', default=None, type=int, help='Override the candidates of every profile')
+parser.add_argument('--scoring', default=None, type=str, choices=SCORING, help='Override the scoring of every profile')
+parser.add_argument('--prompts', default=list(FIXTURE_PROMPTS), nargs='+', type=str)
+parser.add_argument('--audio_length_in_s', default=5., type=float)
+parser.add_argument('--device', default="cuda" if torch.cuda.is_available() else "cpu", type=str)
+parser.add_argument('--dtype', default=None, type=str, choices=['float32', 'float16', 'bfloat16'],
+                    help='Default: float16 on cuda, float32 on cpu')
+parser.add_argument('--seed', default=0, type=int)
+args = parser.parse_args()
+
+dtype = getattr(torch, args.dtype or ("float16" if args.device.startswith("cuda") else "float32"))
+pipe = AudioLDM2Pipeline.from_pretrained(args.music_decoder_path, torch_dtype=dtype).to(args.device)
+pipe.set_progress_bar_config(disable=True)
+print(f"{args.music_decoder_path} on {args.device} ({dtype}), {len(args.prompts)} prompts of "
+      f"{args.audio_length_in_s} s, torch={torch.__version__}")
+
+
+def synchronize():
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+
+def clap_score(prompt, audio):
+    # cosine similarity of the CLAP text and audio embeddings (logits_per_text / logit scale)
+    logits = pipe.clap_scores([prompt], audio[:1], args.device, dtype, resample="torch")
+    return (logits / pipe.text_encoder.logit_scale_t.exp()).item()
+
+
+def run(profile, prompt, seed):
+    generator = torch.Generator(args.device).manual_seed(seed)
+    return pipe(prompt, negative_prompt='Low quality.', audio_length_in_s=args.audio_length_in_s, output_type="pt",
+                generator=generator, **apply_profile(pipe, profile)).audios
+
+
+run(get_profile("draft", num_inference_steps=2, scoring="none"), args.prompts[0], args.seed)
+
+profiles = [get_profile(name, args.scheduler, steps, args.candidates, args.scoring)
+            for name in args.profiles for steps in (args.steps or [None])]
+for profile in profiles:
+    seconds, scores = [], []
+    for i, prompt in enumerate(args.prompts):
+        synchronize()
+        start = time.perf_counter()
+        audio = run(profile, prompt, args.seed + i)
+        synchronize()
+        seconds.append(time.perf_counter() - start)
+        scores.append(clap_score(prompt, audio))
+    unet_evals = profile.num_inference_steps * profile.num_waveforms_per_prompt
+    print(f"{profile.name:10s} {profile.scheduler:12s} steps {profile.num_inference_steps:4d}   "
+          f"candidates {profile.num_waveforms_per_prompt}   scoring {profile.scoring:10s}   "
+          f"UNet evals {unet_evals:4d}   {np.mean(seconds):8.2f} s/prompt   "
+          f"CLAP {np.mean(scores):.3f} +- {np.std(scores):.3f}")
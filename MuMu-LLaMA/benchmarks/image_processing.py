@@ -0,0 +1,93 @@
+"""Tensor preprocessing (llama.image_processing) against the HF ViT/ViViT processors.
+
+Runs the images and videos of a batch through the processors MuMu_LLaMA loads (once per sample, as before)
+and through preprocess_images/preprocess_videos (one batch, on --device), and reports the largest
+difference of the pixel values and the time of both. Inputs are synthetic and shaped like the ones the
+loaders produce: ToTensor() images in [0, 1] and 32 uint8 RGB frames per video.
+
+    python benchmarks/image_processing.py
+    python benchmarks/image_processing.py --device cuda --videos 8 --height 720 --width 1280
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+from transformers import ViTImageProcessor, VivitImageProcessor
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from llama.image_processing import preprocess_images, preprocess_videos  # noqa: E402
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--vit_path', default="google/vit-base-patch16-224-in21k", type=str)
+parser.add_argument('--vivit_path', default="google/vivit-b-16x2-kinetics400", type=str)
+parser.add_argument('--images', default=8, type=int)
+parser.add_argument('--videos', default=4, type=int)
+parser.add_argument('--frames', default=32, type=int)
+parser.add_argument('--height', default=360, type=int)
+parser.add_argument('--width', default=640, type=int)
+parser.add_argument('--repeats', default=3, type=int)
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+args = parser.parse_args()
+
+
+def load(cls, path, **kwargs):
+    try:
+        return cls.from_pretrained(path, **kwargs)
+    except OSError:
+        # the settings of the default checkpoints, without network access
+        print(f"{path} not found, using the {cls.__name__} defaults of the checkpoint")
+        if cls is ViTImageProcessor:
+            return cls(size={"height": 224, "width": 224}, image_mean=[0.5] * 3, image_std=[0.5] * 3, **kwargs)
+        return cls(**kwargs)
+
+
+def sync():
+    if args.device.startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+def timed(fn):
+    fn()
+    sync()
+    start = time.perf_counter()
+    for _ in range(args.repeats):
+        out = fn()
+    sync()
+    return out, (time.perf_counter() - start) / args.repeats
+
+
+def synthetic(shape, rng):
+    # smooth pattern plus noise, so that resampling differences show up as they would on real frames
+    y, x = np.mgrid[0:shape[-3], 0:shape[-2]]
+    pattern = np.stack([np.sin(x / 17 + c) * np.cos(y / 23 - c) for c in range(3)], -1)
+    return np.clip(128 + 100 * pattern + rng.normal(0, 20, shape), 0, 255).astype(np.uint8)
+
+
+vit_processor = load(ViTImageProcessor, args.vit_path, do_rescale=False)
+vivit_processor = load(VivitImageProcessor, args.vivit_path)
+rng = np.random.default_rng(0)
+images = [torch.from_numpy(synthetic((args.height, args.width, 3), rng)).permute(2, 0, 1).float().div(255)
+          for _ in range(args.images)]
+videos = [synthetic((args.frames, args.height, args.width, 3), rng) for _ in range(args.videos)]
+print(f"{args.images} images and {args.videos} videos of {args.frames} frames, {args.height}x{args.width}, "
+      f"device={args.device} torch={torch.__version__}")
+
+cases = [
+    ("ViT", 1 / 255 / vit_processor.image_std[0],
+     lambda: torch.cat([vit_processor(images=x, return_tensors="pt").pixel_values.to(args.device) for x in images]),
+     lambda: preprocess_images(images, vit_processor, device=args.device)),
+    ("ViViT", vivit_processor.rescale_factor / vivit_processor.image_std[0],
+     lambda: torch.cat([vivit_processor(list(x), return_tensors="pt").pixel_values.to(args.device) for x in videos]),
+     lambda: preprocess_videos(videos, vivit_processor, device=args.device)),
+]
+for name, level, hf, tensor in cases:
+    reference, t_hf = timed(hf)
+    with torch.no_grad():
+        pixel_values, t_tensor = timed(tensor)
+    err = (pixel_values - reference).abs()
+    print(f"{name:6s} {tuple(pixel_values.shape)}   HF {t_hf * 1e3:9.1f} ms   tensor {t_tensor * 1e3:9.1f} ms "
+          f"(x{t_hf / t_tensor:.2f})   max abs diff {err.max().item() / level:.2f} uint8 levels, "
+          f"mean {err.mean().item() / level:.3f}")
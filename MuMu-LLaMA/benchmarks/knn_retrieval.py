@@ -0,0 +1,111 @@
+"""kNN retrieval (llama.retrieval) against the per-id reconstruct loop it replaces, and exact against approximate
+indexes.
+
+The fixture is --num_prototypes normalised prototypes drawn around --clusters centres, and queries are perturbed
+prototypes. For every index type the script reports build time, memory (prototype array and faiss index), the
+time of search + mix per batch, recall@k of the neighbour ids and the largest difference of the mixed features,
+both against exact search.
+"loop" is the previous forward_* code: faiss IndexFlatIP search, then reconstruct() per id and np.vstack.
+
+    python benchmarks/knn_retrieval.py
+    python benchmarks/knn_retrieval.py --num_prototypes 1000000 --index_types flat ivfpq --nprobe 32
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from llama.retrieval import INDEX_TYPES, PrototypeIndex, evaluate_index  # noqa: E402
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_prototypes', default=100000, type=int)
+parser.add_argument('--dim', default=1024, type=int)
+parser.add_argument('--clusters', default=1000, type=int)
+parser.add_argument('--queries', default=256, type=int)
+parser.add_argument('--batch_size', default=16, type=int)
+parser.add_argument('--k', default=10, type=int, help='cache_size')
+parser.add_argument('--index_types', default=list(INDEX_TYPES), nargs='+', choices=INDEX_TYPES)
+parser.add_argument('--nprobe', default=16, type=int)
+parser.add_argument('--ef_search', default=64, type=int)
+parser.add_argument('--pq_m', default=64, type=int)
+parser.add_argument('--rerank', default=1, type=int, help='rerank factor of the faiss indexes')
+parser.add_argument('--train_size', default=50000, type=int)
+parser.add_argument('--device', default='cpu', type=str, help='device of the prototypes and queries')
+parser.add_argument('--seed', default=0, type=int)
+args = parser.parse_args()
+
+rng = np.random.default_rng(args.seed)
+centres = rng.normal(size=(args.clusters, args.dim)).astype(np.float32)
+prototypes = centres[rng.integers(0, args.clusters, args.num_prototypes)]
+prototypes += rng.normal(0, 0.5, prototypes.shape).astype(np.float32)
+prototypes /= np.linalg.norm(prototypes, axis=-1, keepdims=True)
+queries = prototypes[rng.choice(args.num_prototypes, args.queries, replace=False)]
+queries = queries + rng.normal(0, 0.5 / np.sqrt(args.dim), queries.shape).astype(np.float32)
+queries = torch.from_numpy(queries / np.linalg.norm(queries, axis=-1, keepdims=True)).to(args.device)
+print(f"{args.num_prototypes} prototypes of dimension {args.dim} in {args.clusters} clusters, {args.queries} "
+      f"queries in batches of {args.batch_size}, k={args.k}, device={args.device} torch={torch.__version__}")
+
+exact = PrototypeIndex(prototypes, device=args.device)
+
+
+def loop_mix(index, feats, k, temperature=20, weight=0.5):
+    # forward_audio/forward_image/forward_video before llama.retrieval
+    sims, indices = index.search(feats.cpu().numpy(), k)
+    B = sims.shape[0]
+    retrieved = [index.reconstruct(x) for x in indices.reshape(-1, ).tolist()]
+    retrieved = np.vstack(retrieved).reshape(B, k, -1)
+    sims = torch.tensor(sims, device=feats.device)
+    retrieved = torch.tensor(retrieved, device=feats.device)
+    sims = (sims * temperature).softmax(dim=-1)
+    mixed = (sims.unsqueeze(1) @ retrieved).squeeze(1)
+    mixed = mixed / mixed.norm(dim=-1, keepdim=True)
+    mixed = (1 - weight) * feats + weight * mixed
+    return mixed / mixed.norm(dim=-1, keepdim=True)
+
+
+def row(name, build_seconds, prototype_bytes, index_bytes, result):
+    print(f"{name:6s} build {build_seconds:7.1f} s   prototypes {prototype_bytes / 2 ** 20:8.1f} MiB   "
+          f"index {index_bytes / 2 ** 20:8.1f} MiB   "
+          f"{result['ms_per_batch']:8.2f} ms/batch   recall@{args.k} {result['recall']:.3f}   "
+          f"max mix diff {result['max_mix_diff']:.2e}")
+
+
+try:
+    import faiss
+    start = time.perf_counter()
+    flat = faiss.IndexFlatIP(args.dim)
+    flat.add(prototypes)
+    build_seconds = time.perf_counter() - start
+    seconds, max_diff = 0., 0.
+    for i in range(0, args.queries, args.batch_size):
+        batch = queries[i:i + args.batch_size]
+        start = time.perf_counter()
+        mixed = loop_mix(flat, batch, args.k)
+        seconds += time.perf_counter() - start
+        max_diff = max(max_diff, (mixed - exact.mix(batch, args.k)).abs().max().item())
+    num_batches = -(-args.queries // args.batch_size)
+    row("loop", build_seconds, 0, flat.ntotal * args.dim * 4,
+        {"ms_per_batch": seconds / num_batches * 1e3, "recall": 1., "max_mix_diff": max_diff})
+    del flat
+except ImportError:
+    print("faiss is not installed, only flat (torch) search is measured")
+    args.index_types = ["flat"]
+
+for index_type in args.index_types:
+    start = time.perf_counter()
+    if index_type == "flat":
+        index = exact
+    else:
+        index = PrototypeIndex.build(prototypes, index_type, device=args.device, nprobe=args.nprobe,
+                                     ef_search=args.ef_search, rerank=args.rerank, pq_m=args.pq_m,
+                                     train_size=args.train_size, seed=args.seed)
+    build_seconds = time.perf_counter() - start
+    result = evaluate_index(index, exact, queries, args.k, args.batch_size)
+    # the prototypes are memory-mapped once saved, only the k neighbours of each query are read
+    memory = index.memory_bytes()
+    row(index_type, build_seconds, memory["prototypes"], memory["index"], result)
+    del index
@@ -0,0 +1,83 @@
+"""Decode latency with the LoRA branches of wq/wk/wv/wo/w1/w2/w3 separate and merged (Transformer.merge_lora()).
+
+Also checks that merging does not change the outputs (including the adapter projections, which use the
+weights without LoRA), that state_dict() still returns the unmerged weights, and how far an
+unmerge_lora() round trip moves the base weights.
+
+    python benchmarks/lora_merge.py
+    python benchmarks/lora_merge.py --device cuda --dtype float16 --dim 4096 --n_heads 32 --n_layers 32
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import torch
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from llama.llama import ModelArgs, Transformer  # noqa: E402
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--dim', default=1024, type=int)
+parser.add_argument('--n_heads', default=8, type=int)
+parser.add_argument('--n_layers', default=8, type=int)
+parser.add_argument('--batch_size', default=1, type=int)
+parser.add_argument('--prompt_len', default=32, type=int)
+parser.add_argument('--steps', default=64, type=int)
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+parser.add_argument('--dtype', default='float32', type=str)
+args = parser.parse_args()
+
+dtype = getattr(torch, args.dtype)
+torch.manual_seed(0)
+model_args = ModelArgs(dim=args.dim, n_heads=args.n_heads, n_layers=args.n_layers, vocab_size=32008,
+                       max_seq_len=args.prompt_len + args.steps + 1, max_batch_size=args.batch_size)
+model = Transformer(model_args)
+for name, p in model.named_parameters():
+    if 'lora' in name or 'gate' in name:
+        torch.nn.init.normal_(p, std=0.02)
+model = model.to(args.device, dtype).eval()
+tokens = torch.randint(0, 32000, (args.batch_size, args.prompt_len + args.steps), device=args.device)
+adapter = torch.randn(args.batch_size, 1, args.dim, device=args.device, dtype=dtype)
+
+
+def sync():
+    if args.device.startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+@torch.inference_mode()
+def run():
+    # full-model decode, plus the adapter projection of the last layer
+    logits = [model(tokens[:, :args.prompt_len], 0)[:, -1]]
+    sync()
+    start = time.time()
+    for pos in range(args.prompt_len, args.prompt_len + args.steps):
+        logits.append(model(tokens[:, pos:pos + 1], pos)[:, -1])
+    sync()
+    elapsed = (time.time() - start) / args.steps
+    adapter_v = model.layers[-1].attention.project_adapter(adapter)[1]
+    return elapsed, torch.stack(logits, dim=1).float(), adapter_v.float()
+
+
+def base_weights():
+    return {k: v.clone() for k, v in model.state_dict().items() if k.endswith(('wq.weight', 'wk.weight',
+            'wv.weight', 'wo.weight', 'w1.weight', 'w2.weight', 'w3.weight'))}
+
+
+saved = base_weights()
+run()  # warm up
+t_lora, ref, ref_adapter = run()
+model.merge_lora()
+t_merged, merged, merged_adapter = run()
+same_state_dict = max((saved[k].float() - v.float()).abs().max().item() for k, v in base_weights().items())
+model.unmerge_lora()
+round_trip = max((saved[k].float() - model.state_dict()[k].float()).abs().max().item() for k in saved)
+
+print(f"layers={args.n_layers} dim={args.dim} batch={args.batch_size} device={args.device} dtype={args.dtype}")
+print(f"LoRA branches separate: {t_lora * 1000:.3f} ms/token")
+print(f"LoRA merged:            {t_merged * 1000:.3f} ms/token ({(1 - t_merged / t_lora) * 100:.1f}% less)")
+print(f"max abs difference: logits {(ref - merged).abs().max().item():.3e} "
+      f"(logits up to {ref.abs().max().item():.1f}), adapter values {(ref_adapter - merged_adapter).abs().max().item():.3e}")
+print(f"state_dict() while merged vs before merging: max abs difference {same_state_dict:.3e}")
+print(f"weights after merge + unmerge vs before: max abs difference {round_trip:.3e}")
@@ -0,0 +1,108 @@
+"""Batched windowed MERT encoding (MuMu_LLaMA._encode_audio) against encoding the windows one by one.
+
+Encodes a batch of waveforms of different lengths both ways, checks that the stitched [T, 1024] features
+agree and times them. Without --mert_path a randomly initialised HuBERT with the MERT-v1 conv front end
+(320x downsampling at 24 kHz) and a reduced hidden size stands in for MERT.
+
+    python benchmarks/mert_windows.py
+    python benchmarks/mert_windows.py --mert_path m-a-p/MERT-v1-330M --device cuda --seconds 200 45 75
+    python benchmarks/mert_windows.py --window_s 30 --overlap_s 5 --max_windows 8
+"""
+import argparse
+import math
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch import nn
+from transformers import AutoModel, HubertConfig, HubertModel, Wav2Vec2FeatureExtractor
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from llama.mumu_llama import MuMu_LLaMA  # noqa: E402
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--mert_path', default=None, type=str)
+parser.add_argument('--hidden_size', default=256, type=int, help='of the random stand-in model')
+parser.add_argument('--seconds', default=[95, 20, 130], type=float, nargs='+', help='length of each waveform')
+parser.add_argument('--window_s', default=60, type=float)
+parser.add_argument('--overlap_s', default=0, type=float)
+parser.add_argument('--max_windows', default=4, type=int)
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+parser.add_argument('--dtype', default='float32', type=str)
+args = parser.parse_args()
+
+
+class Encoder(nn.Module):
+    # the audio path of MuMu_LLaMA without the rest of the model
+    _mert_window = MuMu_LLaMA._mert_window
+    _mert_frames = MuMu_LLaMA._mert_frames
+    _encode_audio = MuMu_LLaMA._encode_audio
+
+    def __init__(self, mert_model, mert_processor, args):
+        super().__init__()
+        self.mert_model = mert_model
+        self.mert_processor = mert_processor
+        self.mu_mert_agg = nn.Conv1d(in_channels=mert_model.config.num_hidden_layers + 1, out_channels=1,
+                                     kernel_size=1)
+        self.args = args
+        self.device = args.device
+
+
+torch.manual_seed(0)
+dtype = getattr(torch, args.dtype)
+if args.mert_path is None:
+    config = HubertConfig(hidden_size=args.hidden_size, num_hidden_layers=24, num_attention_heads=4,
+                          intermediate_size=4 * args.hidden_size, feat_extract_norm="layer",
+                          do_stable_layer_norm=True, conv_bias=True)
+    mert_model = HubertModel(config)
+    mert_processor = Wav2Vec2FeatureExtractor(feature_size=1, sampling_rate=24000, padding_value=0.0,
+                                              do_normalize=True, return_attention_mask=True)
+else:
+    mert_model = AutoModel.from_pretrained(args.mert_path, trust_remote_code=True)
+    mert_processor = Wav2Vec2FeatureExtractor.from_pretrained(args.mert_path, trust_remote_code=True)
+args.mert_window_s, args.mert_overlap_s, args.mert_max_windows = args.window_s, args.overlap_s, args.max_windows
+encoder = Encoder(mert_model, mert_processor, args).to(args.device, dtype).eval()
+sr = mert_processor.sampling_rate
+rng = np.random.default_rng(0)
+waveforms = [rng.standard_normal(int(s * sr)).astype(np.float32) for s in args.seconds]
+
+
+def one_by_one():
+    # every window in its own MERT pass
+    max_windows, args.mert_max_windows = args.mert_max_windows, 1
+    try:
+        return encoder._encode_audio(waveforms)
+    finally:
+        args.mert_max_windows = max_windows
+
+
+def sync():
+    if args.device.startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+def timed(fn, repeats=3):
+    with torch.no_grad():
+        fn()
+        sync()
+        start = time.perf_counter()
+        for _ in range(repeats):
+            out = fn()
+        sync()
+    return out, (time.perf_counter() - start) / repeats
+
+
+window, overlap = encoder._mert_window()
+n_windows = sum(len(range(0, max(len(w) - overlap, 1), window - overlap)) for w in waveforms)
+print(f"{len(waveforms)} waveforms of {args.seconds} s, {n_windows} windows of {window / sr:g} s "
+      f"(overlap {overlap / sr:g} s), device={args.device} dtype={args.dtype} torch={torch.__version__}")
+reference, t_reference = timed(one_by_one)
+batched, t_batched = timed(lambda: encoder._encode_audio(waveforms))
+err = max((a - b).abs().max().item() for a, b in zip(reference, batched))
+full = [len(w) // math.prod(mert_model.config.conv_stride) for w in waveforms]
+print(f"frames per waveform {[len(f) for f in batched]} (full length {full})")
+print(f"one window per pass          {t_reference * 1e3:9.1f} ms")
+print(f"<= {args.max_windows} windows per pass       {t_batched * 1e3:9.1f} ms (x{t_reference / t_batched:.2f})"
+      f"   max abs diff {err:.2e}")
@@ -0,0 +1,81 @@
+"""MusicGen decoding speed with the tuple KV cache (grown with torch.cat every frame) against MusicgenStaticCache
+(preallocated for max_length, written in place, cross-attention keys/values projected once).
+
+The model is a randomly initialised MusicgenForConditionalGeneration of the given decoder size, generating greedily
+with classifier free guidance from random encoder outputs, as generate_music(conditioning="embeddings") does.
+Frames/s counts generated frames (all codebooks of one step) over the whole generate() call, and the two caches
+must produce the same codes.
+
+    python benchmarks/musicgen_kv_cache.py
+    python benchmarks/musicgen_kv_cache.py --hidden_size 1024 --num_layers 24 --heads 16 --max_new_tokens 256
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import torch
+from transformers import EncodecConfig, T5Config
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from llama.musicgen.configuration_musicgen import MusicgenConfig, MusicgenDecoderConfig  # noqa: E402
+from llama.musicgen.musicgen import MusicgenForConditionalGeneration  # noqa: E402
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--hidden_size', default=256, type=int)
+parser.add_argument('--num_layers', default=8, type=int)
+parser.add_argument('--heads', default=4, type=int)
+parser.add_argument('--codebooks', default=4, type=int)
+parser.add_argument('--text_len', default=128, type=int, help='length of the encoder outputs')
+parser.add_argument('--max_new_tokens', default=[250, 750, 1500], type=int, nargs='+',
+                    help='frames to generate (50 per second of audio)')
+parser.add_argument('--batch_size', default=1, type=int)
+parser.add_argument('--guidance_scale', default=3.0, type=float)
+parser.add_argument('--repeats', default=2, type=int)
+parser.add_argument('--device', default='cpu', type=str)
+args = parser.parse_args()
+
+torch.manual_seed(0)
+text_config = T5Config(vocab_size=100, d_model=args.hidden_size, d_kv=16, d_ff=64, num_layers=1, num_heads=4)
+audio_config = EncodecConfig(target_bandwidths=[0.8], sampling_rate=320, audio_channels=1, num_filters=4,
+                             num_residual_layers=1, upsampling_ratios=[4, 4], hidden_size=16, codebook_size=64,
+                             codebook_dim=16, num_lstm_layers=1)
+decoder_config = MusicgenDecoderConfig(vocab_size=64, hidden_size=args.hidden_size, num_hidden_layers=args.num_layers,
+                                       num_attention_heads=args.heads, ffn_dim=4 * args.hidden_size,
+                                       num_codebooks=args.codebooks, max_position_embeddings=4096, pad_token_id=64,
+                                       bos_token_id=64, decoder_start_token_id=64)
+model = MusicgenForConditionalGeneration(
+    MusicgenConfig.from_sub_models_config(text_config, audio_config, decoder_config)).eval().to(args.device)
+model.generation_config.update(pad_token_id=64, decoder_start_token_id=64, bos_token_id=64, do_sample=False)
+encoder_outputs = torch.randn(args.batch_size, args.text_len, args.hidden_size, device=args.device)
+attention_mask = torch.ones(args.batch_size, args.text_len, dtype=torch.long, device=args.device)
+print(f"decoder {args.num_layers} layers x {args.hidden_size} ({args.heads} heads, {args.codebooks} codebooks), "
+      f"batch {args.batch_size}, guidance {args.guidance_scale}, device={args.device} torch={torch.__version__}")
+
+
+def sync():
+    if args.device.startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+def run(max_new_tokens, static_cache):
+    return model.generate(encoder_outputs=(encoder_outputs,), attention_mask=attention_mask,
+                          max_new_tokens=max_new_tokens, guidance_scale=args.guidance_scale, static_cache=static_cache)
+
+
+run(8, False), run(8, True)
+for max_new_tokens in args.max_new_tokens:
+    result = {}
+    for static_cache in (False, True):
+        seconds = []
+        for _ in range(args.repeats):
+            sync()
+            start = time.perf_counter()
+            audio = run(max_new_tokens, static_cache)
+            sync()
+            seconds.append(time.perf_counter() - start)
+        result[static_cache] = (min(seconds), audio)
+    (tuple_seconds, tuple_audio), (static_seconds, static_audio) = result[False], result[True]
+    print(f"{max_new_tokens:5d} frames   tuple cache {max_new_tokens / tuple_seconds:8.1f} frames/s   "
+          f"static cache {max_new_tokens / static_seconds:8.1f} frames/s   "
+          f"speedup {tuple_seconds / static_seconds:.2f}x   same audio {torch.equal(tuple_audio, static_audio)}")
@@ -0,0 +1,93 @@
+"""Memory, decode latency and output error of the weight-only quantised LLaMA projections (Transformer.quantize())
+against the unquantised model, on a randomly initialised Transformer (LoRA branches and gates non-zero).
+
+Accuracy on real prompts is checked by quantize.py, which needs a trained checkpoint; here the errors are only
+relative to the same random model.
+
+    python benchmarks/quantization.py
+    python benchmarks/quantization.py --dim 4096 --n_heads 32 --n_layers 4 --compute_dtype bfloat16
+    python benchmarks/quantization.py --device cuda --dtype float16 --dim 4096 --n_heads 32 --n_layers 32
+"""
+import argparse
+import copy
+import sys
+import time
+from pathlib import Path
+
+import torch
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from llama.llama import ModelArgs, Transformer  # noqa: E402
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--dim', default=1024, type=int)
+parser.add_argument('--n_heads', default=8, type=int)
+parser.add_argument('--n_layers', default=8, type=int)
+parser.add_argument('--batch_size', default=1, type=int)
+parser.add_argument('--prompt_len', default=32, type=int)
+parser.add_argument('--steps', default=32, type=int)
+parser.add_argument('--group_size', default=128, type=int)
+parser.add_argument('--compute_dtype', default=None, type=str,
+                    help='dtype of the quantised matmuls (default: bfloat16 on CPU, else the activation dtype)')
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+parser.add_argument('--dtype', default='float32', type=str)
+args = parser.parse_args()
+
+dtype = getattr(torch, args.dtype)
+if args.compute_dtype is None:
+    args.compute_dtype = 'bfloat16' if args.device == 'cpu' else None
+compute_dtype = None if args.compute_dtype is None else getattr(torch, args.compute_dtype)
+torch.manual_seed(0)
+model_args = ModelArgs(dim=args.dim, n_heads=args.n_heads, n_layers=args.n_layers, vocab_size=32008,
+                       max_seq_len=args.prompt_len + args.steps + 1, max_batch_size=args.batch_size)
+base = Transformer(model_args)
+for name, p in base.named_parameters():
+    if p.dim() == 2 or 'gate' in name:
+        torch.nn.init.normal_(p, std=0.02)
+base = base.to(args.device, dtype).eval()
+tokens = torch.randint(0, 32000, (args.batch_size, args.prompt_len + args.steps), device=args.device)
+
+
+def sync():
+    if args.device.startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+def projection_bytes(model):
+    # parameters and buffers of wq/wk/wv/wo/w1/w2/w3/output, LoRA excluded
+    return sum(t.numel() * t.element_size() for name, t in list(model.named_parameters()) + list(model.named_buffers())
+               if name.split('.')[-2] in ('wq', 'wk', 'wv', 'wo', 'w1', 'w2', 'w3', 'output'))
+
+
+@torch.inference_mode()
+def run(model):
+    # prefill, then decode the remaining tokens one by one (teacher forced)
+    logits = [model(tokens[:, :args.prompt_len], 0)]
+    sync()
+    start = time.time()
+    for pos in range(args.prompt_len, args.prompt_len + args.steps):
+        logits.append(model(tokens[:, pos:pos + 1], pos))
+    sync()
+    return (time.time() - start) / args.steps, torch.cat([l[:, -1:] for l in logits], dim=1)
+
+
+run(base)  # warm up
+t_ref, ref = run(base)
+ref_bytes = projection_bytes(base)
+print(f"layers={args.n_layers} dim={args.dim} batch={args.batch_size} device={args.device} dtype={args.dtype} "
+      f"compute_dtype={args.compute_dtype} torch={torch.__version__}")
+print(f"{args.dtype:9s} projections {ref_bytes / 2 ** 20:8.1f} MiB   decode {t_ref * 1e3:8.3f} ms/token")
+for bits in (8, 4):
+    model = copy.deepcopy(base)
+    model.quantize(bits, args.group_size, compute_dtype=compute_dtype)
+    run(model)
+    t, out = run(model)
+    top1 = (out.argmax(-1) == ref.argmax(-1)).float().mean().item()
+    kl = torch.nn.functional.kl_div(out.log_softmax(-1), ref.log_softmax(-1), log_target=True,
+                                    reduction='none').sum(-1).mean().item()
+    name = f"int{bits}" + (f"/g{args.group_size}" if bits == 4 else "")
+    print(f"{name:9s} projections {projection_bytes(model) / 2 ** 20:8.1f} MiB "
+          f"(x{ref_bytes / projection_bytes(model):.2f} smaller)   decode {t * 1e3:8.3f} ms/token "
+          f"(x{t_ref / t:.2f})   max abs logit diff {(out - ref).abs().max().item():.3e} "
+          f"(logits up to {ref.abs().max().item():.1f}), top-1 agreement {top1:.3f}, mean KL {kl:.2e}")
+    del model
@@ -0,0 +1,121 @@
+"""Rotary embedding: the former implementation (q/k cast to float32, view_as_complex/view_as_real with a
+table moved to the device in every call) against llama.llama.RotaryEmbedding (tables cached per device
+and dtype, rotation in place in the activation dtype).
+
+Checks that both agree (exactly in float32, within rounding of the activation dtype in float16/bfloat16)
+and times apply_rotary_emb alone and a full TransformerBlock for prefill and decode.
+
+    python benchmarks/rotary.py
+    python benchmarks/rotary.py --device cuda --dtype float16 --dim 4096 --n_heads 32
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import torch
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import llama.llama as llama_module  # noqa: E402
+from llama.llama import ModelArgs, RotaryEmbedding, TransformerBlock  # noqa: E402
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--dim', default=1024, type=int)
+parser.add_argument('--n_heads', default=8, type=int)
+parser.add_argument('--batch_size', default=1, type=int)
+parser.add_argument('--prompt_len', default=256, type=int)
+parser.add_argument('--start_pos', default=300, type=int, help='position offset of the decode step')
+parser.add_argument('--steps', default=100, type=int)
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+parser.add_argument('--dtype', default='float32', type=str)
+args = parser.parse_args()
+
+dtype = getattr(torch, args.dtype)
+head_dim = args.dim // args.n_heads
+max_len = 2 * (args.start_pos + args.prompt_len)
+torch.manual_seed(0)
+
+
+def precompute_freqs_cis(dim, end, theta=10000.0):
+    freqs = 1.0 / (theta ** (torch.arange(0, dim, 2)[: (dim // 2)].float() / dim))
+    freqs = torch.outer(torch.arange(end), freqs).float()
+    return torch.polar(torch.ones_like(freqs), freqs).to(args.device)
+
+
+freqs_cis = precompute_freqs_cis(head_dim, max_len)
+
+
+def reference_apply_rotary_emb(xq, xk, rope):
+    # the previous implementation, fed the same positions
+    f = freqs_cis[rope.start_pos:rope.start_pos + rope.seqlen]
+    xq_ = torch.view_as_complex(xq.float().reshape(*xq.shape[:-1], -1, 2))
+    xk_ = torch.view_as_complex(xk.float().reshape(*xk.shape[:-1], -1, 2))
+    f = f.view(1, xq_.shape[1], 1, xq_.shape[-1])
+    xq_out = torch.view_as_real(xq_ * f).flatten(3)
+    xk_out = torch.view_as_real(xk_ * f).flatten(3)
+    return xq_out.type_as(xq), xk_out.type_as(xk)
+
+
+cached_apply_rotary_emb = llama_module.apply_rotary_emb
+rope = RotaryEmbedding(head_dim, max_len)
+
+
+def sync():
+    if args.device.startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+def timeit(fn, steps=args.steps):
+    for _ in range(3):
+        fn()
+    sync()
+    start = time.time()
+    for _ in range(steps):
+        fn()
+    sync()
+    return (time.time() - start) / steps
+
+
+print(f"head_dim={head_dim} n_heads={args.n_heads} batch={args.batch_size} device={args.device} dtype={args.dtype}")
+
+# numerics, against the float32 reference
+with torch.inference_mode():
+    for seqlen, start_pos in [(args.prompt_len, 0), (1, args.start_pos)]:
+        xq = torch.randn(args.batch_size, seqlen, args.n_heads, head_dim, device=args.device, dtype=dtype)
+        xk = torch.randn_like(xq)
+        positions = rope(start_pos, seqlen, args.device)
+        # the reference rotates in float32 and rounds once, so half precision differs by about one ulp
+        ref_q, ref_k = reference_apply_rotary_emb(xq.float(), xk.float(), positions)
+        out_q, out_k = cached_apply_rotary_emb(xq.clone(), xk.clone(), positions)
+        err = max((ref_q - out_q.float()).abs().max().item(), (ref_k - out_k.float()).abs().max().item())
+        print(f"seqlen {seqlen:4d} start_pos {start_pos:4d}: max abs error {err:.2e} "
+              f"(inputs up to {xq.abs().max().item():.1f})")
+
+# apply_rotary_emb alone and one transformer block
+model_args = ModelArgs(dim=args.dim, n_heads=args.n_heads, max_seq_len=max_len, max_batch_size=args.batch_size)
+block = TransformerBlock(0, model_args).to(args.device, dtype).eval()
+for seqlen, start_pos, name in [(args.prompt_len, 0, 'prefill'), (1, args.start_pos, 'decode')]:
+    x = torch.randn(args.batch_size, seqlen, args.dim, device=args.device, dtype=dtype)
+    xq = torch.randn(args.batch_size, seqlen, args.n_heads, head_dim, device=args.device, dtype=dtype)
+    mask = None
+    if seqlen > 1:
+        mask = torch.triu(torch.full((seqlen, seqlen), float("-inf"), device=args.device), diagonal=1).to(dtype)
+    timings = {}
+    for impl_name, impl in [('complex', reference_apply_rotary_emb), ('cached', cached_apply_rotary_emb)]:
+        llama_module.apply_rotary_emb = impl
+
+        @torch.inference_mode()
+        def rotary_only():
+            # the cached version works in place, rotate fresh copies in both cases
+            impl(xq.clone(), xq.clone(), rope(start_pos, seqlen, args.device))
+
+        @torch.inference_mode()
+        def layer():
+            # no KV cache is bound, so the block attends to the new tokens only
+            block(x, 0, rope(start_pos, seqlen, args.device), mask)
+
+        timings[impl_name] = timeit(rotary_only), timeit(layer)
+    llama_module.apply_rotary_emb = cached_apply_rotary_emb
+    (rot_ref, layer_ref), (rot_new, layer_new) = timings['complex'], timings['cached']
+    print(f"{name:8s} apply_rotary_emb {rot_ref * 1e3:7.3f} -> {rot_new * 1e3:7.3f} ms (x{rot_ref / rot_new:.2f})   "
+          f"block {layer_ref * 1e3:7.3f} -> {layer_new * 1e3:7.3f} ms (x{layer_ref / layer_new:.2f})")
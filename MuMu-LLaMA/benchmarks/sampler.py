@@ -0,0 +1,77 @@
+"""Cost of one sampling step: softmax + sample_top_p (full sort of the vocabulary) against llama.sampling.sample
+(top-k candidates, nucleus cut on those).
+
+Logits are random with a peakedness similar to LLaMA's next-token distributions (--scale); the fraction of
+rows that needed the full-sort fallback is reported alongside.
+
+    python benchmarks/sampler.py
+    python benchmarks/sampler.py --batch_sizes 1 8 32 --top_k 40 --repetition_penalty 1.1
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import torch
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from llama.utils import sample_top_p  # noqa: E402
+from llama.sampling import sample, _candidates  # noqa: E402
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--vocab_size', default=32008, type=int)
+parser.add_argument('--batch_sizes', default=[1, 4, 16], type=int, nargs='+')
+parser.add_argument('--temperature', default=0.1, type=float)
+parser.add_argument('--top_p', default=0.75, type=float)
+parser.add_argument('--top_k', default=0, type=int)
+parser.add_argument('--repetition_penalty', default=1.0, type=float)
+parser.add_argument('--num_candidates', default=64, type=int)
+parser.add_argument('--scale', default=2.0, type=float, help='std of the random logits')
+parser.add_argument('--steps', default=200, type=int)
+parser.add_argument('--device', default='cpu', type=str)
+args = parser.parse_args()
+
+torch.manual_seed(0)
+
+
+def sync():
+    if args.device.startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+def timeit(fn, logits):
+    for _ in range(5):
+        fn(logits.clone())
+    inputs = [logits.clone() for _ in range(args.steps)]
+    sync()
+    start = time.time()
+    for x in inputs:
+        fn(x)
+    sync()
+    return (time.time() - start) / args.steps
+
+
+def reference(logits):
+    probs = torch.softmax(logits / args.temperature, dim=-1)
+    return sample_top_p(probs, args.top_p)
+
+
+print(f"vocab={args.vocab_size} temperature={args.temperature} top_p={args.top_p} top_k={args.top_k} "
+      f"repetition_penalty={args.repetition_penalty} device={args.device}")
+for bsz in args.batch_sizes:
+    logits = torch.randn(bsz, args.vocab_size, device=args.device) * args.scale
+    prev_tokens = torch.randint(0, args.vocab_size, (bsz, 128), device=args.device)
+
+    def fused(x):
+        return sample(x, args.temperature, args.top_p, args.top_k, args.repetition_penalty, prev_tokens,
+                      num_candidates=args.num_candidates)
+
+    scaled = logits / args.temperature
+    k = min(args.vocab_size, max(args.num_candidates, args.top_k))
+    top_k = torch.full((bsz,), args.top_k, device=args.device)
+    top_p = torch.full((bsz,), args.top_p, device=args.device)
+    fallback = (~_candidates(scaled, k, top_k, top_p)[2]).float().mean().item()
+
+    t_ref, t_new = timeit(reference, logits), timeit(fused, logits)
+    print(f"batch {bsz:3d}: sample_top_p {t_ref * 1000:8.3f} ms   sample {t_new * 1000:8.3f} ms   "
+          f"x{t_ref / t_new:5.1f}   full-sort rows {fallback * 100:.0f}%")
@@ -0,0 +1,129 @@
+"""Build the kNN prototype index of a modality from cached encoder features, offline.
+
+--features are .npy files or directories of them, e.g. a --feature_cache_dir filled by encoding a dataset of
+one modality (FeatureCache entries: [frames, 1024] MERT features per audio, [768] ViT/ViViT features per
+image/video). Every file is pooled into one prototype the way forward_audio/forward_image/forward_video pool
+their inputs before retrieval: with the mu_mert_*/iu_vivit_* RNN and attention of --checkpoint for audio and
+video, as the mean of the normalised frames without one. With --pooled every file already holds [N, D]
+prototypes. The index is written to <output>/<modality>, where MuMu_LLaMA(knn=True, knn_dir=<output>) loads it,
+followed by a comparison with exact search on --eval_queries perturbed prototypes.
+
+    python build_knn_index.py --modality audio --features ./cache/mert --checkpoint ./ckpts/checkpoint.pth \
+        --output ./ckpts/knn --index_type ivfpq --nprobe 16
+"""
+import argparse
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from llama.retrieval import INDEX_TYPES, MODALITIES, PrototypeIndex, evaluate_index
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--modality", required=True, type=str, choices=MODALITIES)
+parser.add_argument("--features", required=True, type=str, nargs="+",
+                    help=".npy files or directories of .npy files with the cached features")
+parser.add_argument("--pooled", action="store_true", help="The files hold [N, D] prototypes")
+parser.add_argument("--checkpoint", default=None, type=str,
+                    help="MuMu_LLaMA checkpoint (full or adapter) whose RNN/attention pools audio and video")
+parser.add_argument("--no_normalize", action="store_true", help="Keep the prototypes unnormalised")
+parser.add_argument("--output", required=True, type=str, help="knn_dir to write <modality>/ to")
+parser.add_argument("--index_type", default="flat", type=str, choices=INDEX_TYPES,
+                    help="flat: exact search in torch, else a faiss IVF/HNSW/PQ index")
+parser.add_argument("--nlist", default=None, type=int, help="IVF lists (default about 4 sqrt(N))")
+parser.add_argument("--pq_m", default=16, type=int, help="PQ sub-quantizers")
+parser.add_argument("--hnsw_m", default=32, type=int, help="HNSW neighbours per node")
+parser.add_argument("--train_size", default=None, type=int, help="Prototypes to train IVF/PQ on")
+parser.add_argument("--nprobe", default=None, type=int, help="IVF lists searched, saved with the index")
+parser.add_argument("--ef_search", default=None, type=int, help="HNSW search depth, saved with the index")
+parser.add_argument("--rerank", default=1, type=int,
+                    help="Candidates per neighbour reordered by exact similarity, saved with the index (e.g. 4 "
+                         "for PQ)")
+parser.add_argument("--eval_queries", default=256, type=int)
+parser.add_argument("--k", default=10, type=int, help="cache_size of the comparison")
+parser.add_argument("--seed", default=0, type=int)
+args = parser.parse_args()
+
+
+def feature_files(paths):
+    files = []
+    for path in map(Path, paths):
+        files.extend(sorted(path.glob("*.npy")) if path.is_dir() else [path])
+    return files
+
+
+def load_pooling(checkpoint_path, prefix):
+    # the RNN + attention pooling of forward_audio (mu_mert_) / forward_video (iu_vivit_) of a checkpoint
+    state_dict = torch.load(checkpoint_path, map_location="cpu", mmap=True)["model"]
+    state_dict = {key.replace("module.", ""): value for key, value in state_dict.items()}
+    rnn_state = {key[len(f"{prefix}rnn."):]: value for key, value in state_dict.items()
+                 if key.startswith(f"{prefix}rnn.")}
+    attention_state = {key[len(f"{prefix}attention."):]: value for key, value in state_dict.items()
+                       if key.startswith(f"{prefix}attention.")}
+    rnn = nn.RNN(rnn_state["weight_ih_l0"].shape[1], rnn_state["weight_ih_l0"].shape[0], batch_first=True)
+    attention = nn.Linear(attention_state["weight"].shape[1], 1)
+    rnn.load_state_dict({key: value.float() for key, value in rnn_state.items()})
+    attention.load_state_dict({key: value.float() for key, value in attention_state.items()})
+    return rnn.eval(), attention.eval()
+
+
+@torch.no_grad()
+def pool(features, pooling):
+    frames = torch.from_numpy(np.array(features, dtype=np.float32)).reshape(-1, features.shape[-1])
+    frames = F.normalize(frames, dim=-1)
+    if pooling is None:
+        return frames.mean(0)
+    rnn, attention = pooling
+    frames, _ = rnn(frames[None])
+    scores = attention(frames).squeeze(-1).softmax(dim=1)
+    return (scores.unsqueeze(1) @ frames).squeeze(1)[0]
+
+
+start = time.perf_counter()
+files = feature_files(args.features)
+assert files, f"No .npy files in {args.features}"
+pooling = None
+if not args.pooled and args.modality != "image":
+    if args.checkpoint is not None:
+        pooling = load_pooling(args.checkpoint, "mu_mert_" if args.modality == "audio" else "iu_vivit_")
+    else:
+        print("No --checkpoint, pooling frames by their mean instead of the trained RNN + attention")
+if args.pooled:
+    prototypes = [np.load(f) for f in files]
+    prototypes = np.concatenate([p.reshape(-1, p.shape[-1]) for p in prototypes])
+else:
+    prototypes = np.stack([pool(np.load(f, mmap_mode="r"), pooling).numpy() for f in files])
+prototypes = prototypes.astype(np.float32)
+if not args.no_normalize:
+    prototypes /= np.linalg.norm(prototypes, axis=-1, keepdims=True) + 1e-12
+print(f"{len(prototypes)} prototypes of dimension {prototypes.shape[1]} from {len(files)} files "
+      f"in {time.perf_counter() - start:.1f} s")
+
+start = time.perf_counter()
+index = PrototypeIndex.build(prototypes, args.index_type, nprobe=args.nprobe, ef_search=args.ef_search,
+                             rerank=args.rerank,
+                             **({} if args.index_type == "flat" else
+                                {"nlist": args.nlist, "pq_m": args.pq_m, "hnsw_m": args.hnsw_m,
+                                 "train_size": args.train_size, "seed": args.seed}))
+print(f"Built {args.index_type} index in {time.perf_counter() - start:.1f} s")
+directory = os.path.join(args.output, args.modality)
+if pooling is not None:
+    pooling_name = "checkpoint"
+else:
+    pooling_name = "none" if args.pooled or args.modality == "image" else "mean"
+index.save(directory, modality=args.modality, sources=[str(p) for p in args.features],
+           normalized=not args.no_normalize, pooling=pooling_name)
+print(f"Wrote {directory}: {index.stats()}")
+
+if args.eval_queries > 0:
+    rng = np.random.default_rng(args.seed)
+    queries = prototypes[rng.choice(len(prototypes), min(args.eval_queries, len(prototypes)), replace=False)]
+    queries = torch.from_numpy(queries + rng.normal(0, 0.5 / np.sqrt(queries.shape[1]), queries.shape)).float()
+    loaded = PrototypeIndex.load(directory)
+    exact = PrototypeIndex(loaded.prototypes)
+    print(f"exact:          {evaluate_index(exact, exact, queries, args.k)}")
+    print(f"{args.index_type + ':':15s} {evaluate_index(loaded, exact, queries, args.k)}")
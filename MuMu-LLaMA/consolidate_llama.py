@@ -0,0 +1,86 @@
+"""Merge the LLaMA shards MuMu_LLaMA starts from into a single checkpoint, once.
+
+The result holds every pretrained weight unsharded, already in --dtype and in the shapes of the MuMu_LLaMA
+Transformer: tok_embeddings and output include the [AUD*] rows (tok_embeddings rows set to 1, output rows
+randomly initialised, as when loading the original shards). The output directory has the layout of
+--llama_dir (tokenizer.model next to <llama_type>/params.json), so it can be passed as --llama_dir /
+--llama_path instead. safetensors checkpoints are memory-mapped without unpickling.
+
+    python consolidate_llama.py --llama_dir ./ckpts/LLaMA --llama_type 7B --output ./ckpts/LLaMA-consolidated
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import time
+
+import torch
+from transformers import LlamaTokenizer
+
+from llama.checkpoint import checkpoint_files, load_llama_checkpoint, pretrained_parameters
+from llama.llama import ModelArgs, Transformer
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--llama_dir", default="/path/to/llama", type=str,
+    help="Directory with the tokenizer and a subdirectory per LLaMA type",
+)
+parser.add_argument(
+    "--llama_type", default="7B", type=str,
+    help="Type of llama original weight",
+)
+parser.add_argument(
+    "--output", required=True, type=str,
+    help="Directory to write the consolidated LLaMA to, laid out like --llama_dir",
+)
+parser.add_argument(
+    "--dtype", default="float16", type=str, choices=["float16", "bfloat16", "float32"],
+    help="dtype of the consolidated weights",
+)
+parser.add_argument(
+    "--format", default="safetensors", type=str, choices=["safetensors", "pth"],
+)
+parser.add_argument(
+    "--num_gen_audio_tokens", default=ModelArgs.num_gen_audio_tokens, type=int,
+    help="Number of [AUD*] tokens added to the vocabulary",
+)
+args = parser.parse_args()
+
+start = time.perf_counter()
+llama_ckpt_dir = os.path.join(args.llama_dir, args.llama_type)
+with open(os.path.join(llama_ckpt_dir, "params.json"), "r") as f:
+    params = json.loads(f.read())
+
+# the vocabulary of MuMu_LLaMA: the LLaMA tokenizer plus the [AUD*] tokens
+tokenizer = LlamaTokenizer.from_pretrained(args.llama_dir)
+tokenizer.add_tokens([f"[AUD{i}]" for i in range(args.num_gen_audio_tokens)])
+model_args = ModelArgs(w_bias=False, w_lora=False, num_gen_audio_tokens=args.num_gen_audio_tokens,
+                       **{k: v for k, v in params.items() if k != "vocab_size"})
+model_args.vocab_size = len(tokenizer)
+
+with torch.device("meta"):
+    model = Transformer(model_args)
+model.materialize_("cpu", getattr(torch, args.dtype))
+shards = checkpoint_files(llama_ckpt_dir)
+print(f"Loading {len(shards)} shard(s) from {llama_ckpt_dir}")
+load_llama_checkpoint(model, llama_ckpt_dir, args.num_gen_audio_tokens)
+state_dict = {name: parameter.detach().contiguous() for name, parameter in pretrained_parameters(model).items()}
+
+output_ckpt_dir = os.path.join(args.output, args.llama_type)
+os.makedirs(output_ckpt_dir, exist_ok=True)
+if args.format == "safetensors":
+    from safetensors.torch import save_file
+    path = os.path.join(output_ckpt_dir, "consolidated.safetensors")
+    save_file(state_dict, path, metadata={"format": "pt"})
+else:
+    path = os.path.join(output_ckpt_dir, "consolidated.pth")
+    torch.save(state_dict, path)
+shutil.copy(os.path.join(llama_ckpt_dir, "params.json"), os.path.join(output_ckpt_dir, "params.json"))
+for name in os.listdir(args.llama_dir):
+    if name.startswith("tokenizer"):
+        shutil.copy(os.path.join(args.llama_dir, name), os.path.join(args.output, name))
+
+print(f"Wrote {path}: {len(state_dict)} tensors, vocabulary {model_args.vocab_size}, "
+      f"{os.path.getsize(path) / 2 ** 30:.2f} GiB in {time.perf_counter() - start:.1f} s "
+      f"(peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 20:.2f} GiB)")
@@ -0,0 +1,113 @@
+"""Convert MuMu_LLaMA checkpoints between the full format and the adapter format.
+
+Full checkpoints hold the whole state_dict of MuMu_LLaMA. Adapter checkpoints (what main_train.py saves unless
+--full_checkpoint is given) leave out the pretrained LLaMA weights that are frozen in their stage and hold a
+manifest of the base checkpoint they belong to instead, see MuMu_LLaMA.adapter_checkpoint(). Both directions
+only read the LLaMA shards of --llama_dir, the rest of the model is not built.
+
+    python convert_checkpoint.py --to adapter --input ./ckpts/checkpoint.pth --output ./ckpts/adapter.pth \
+        --llama_dir ./ckpts/LLaMA --stage 3
+    python convert_checkpoint.py --to full --input ./ckpts/adapter.pth --output ./ckpts/checkpoint.pth \
+        --llama_dir ./ckpts/LLaMA
+"""
+import argparse
+import json
+import os
+import time
+
+import torch
+
+from llama.checkpoint import llama_manifest, verify_llama_manifest, load_llama_checkpoint, pretrained_parameters
+from llama.llama import ModelArgs, Transformer
+from llama.mumu_llama import (ADAPTER_FORMAT, BASE_COMPONENT_ARGS, FROZEN_COMPONENTS, base_parameter_names,
+                              is_adapter_checkpoint)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--to", required=True, type=str, choices=["adapter", "full"])
+parser.add_argument("--input", required=True, type=str, help="Checkpoint to convert")
+parser.add_argument("--output", required=True, type=str, help="Path to write the converted checkpoint to")
+parser.add_argument(
+    "--llama_dir", default="/path/to/llama", type=str,
+    help="Path to LLaMA pretrained checkpoint",
+)
+parser.add_argument(
+    "--llama_type", default="7B", type=str,
+    help="Type of llama original weight",
+)
+parser.add_argument(
+    "--stage", default=None, type=int,
+    help="Training stage of a full checkpoint (default: the stage in its args), decides which LLaMA weights "
+         "are frozen base weights",
+)
+parser.add_argument(
+    "--num_gen_audio_tokens", default=ModelArgs.num_gen_audio_tokens, type=int,
+    help="Number of [AUD*] tokens of a full checkpoint",
+)
+parser.add_argument(
+    "--dtype", default="float16", type=str, choices=["float16", "bfloat16", "float32"],
+    help="dtype of the base weights written to full checkpoints",
+)
+parser.add_argument(
+    "--no_base_hashes", action="store_true",
+    help="Record only the sizes of the LLaMA shards in the manifest, not their sha256",
+)
+parser.add_argument(
+    "--verify_base_hashes", action="store_true",
+    help="Compare the sha256 of the LLaMA shards with the manifest of the adapter checkpoint",
+)
+args = parser.parse_args()
+
+start = time.perf_counter()
+llama_ckpt_dir = os.path.join(args.llama_dir, args.llama_type)
+checkpoint = torch.load(args.input, map_location="cpu", mmap=True)
+state_dict = {key.replace("module.", ""): value for key, value in checkpoint["model"].items()
+              if not key.replace("module.", "").startswith(FROZEN_COMPONENTS)}
+# optimizer, scaler, epoch, args, ... are carried over
+extra = {key: value for key, value in checkpoint.items()
+         if key not in ("model", "format", "stage", "audio_rows", "base")}
+
+if args.to == "adapter":
+    assert not is_adapter_checkpoint(checkpoint), f"{args.input} is already an adapter checkpoint"
+    assert "quantization" not in checkpoint, "Quantized checkpoints cannot be converted, convert the original"
+    train_args = checkpoint.get("args")
+    stage = args.stage if args.stage is not None else getattr(train_args, "stage", None)
+    assert stage is not None, f"{args.input} does not record its training stage, pass --stage"
+    base = base_parameter_names(state_dict, stage)
+    audio_rows = {}
+    if "llama.output.weight" in base:
+        audio_rows["llama.output.weight"] = state_dict["llama.output.weight"][-args.num_gen_audio_tokens:].clone()
+    manifest = {"llama": llama_manifest(llama_ckpt_dir, hashes=not args.no_base_hashes),
+                "num_gen_audio_tokens": args.num_gen_audio_tokens}
+    for key in BASE_COMPONENT_ARGS:
+        manifest[key] = getattr(train_args, key, None)
+    converted = {"format": ADAPTER_FORMAT, "stage": stage,
+                 "model": {key: value for key, value in state_dict.items() if key not in base},
+                 "audio_rows": audio_rows, "base": manifest, **extra}
+    print(f"Stage {stage}: dropped {len(base)} base weights, kept {len(converted['model'])} tensors")
+else:
+    assert is_adapter_checkpoint(checkpoint), f"{args.input} is not an adapter checkpoint"
+    manifest = checkpoint["base"]
+    for problem in verify_llama_manifest(manifest["llama"], llama_ckpt_dir, hashes=args.verify_base_hashes):
+        print(f"WARNING: base weights differ from the adapter checkpoint: {problem}")
+    with open(os.path.join(llama_ckpt_dir, "params.json"), "r") as f:
+        params = json.loads(f.read())
+    model_args = ModelArgs(w_bias=False, w_lora=False, num_gen_audio_tokens=manifest["num_gen_audio_tokens"],
+                           **{k: v for k, v in params.items() if k != "vocab_size"})
+    model_args.vocab_size = state_dict["llama.tok_embeddings.weight"].shape[0]
+    with torch.device("meta"):
+        llama = Transformer(model_args)
+    llama.materialize_("cpu", getattr(torch, args.dtype))
+    load_llama_checkpoint(llama, llama_ckpt_dir, model_args.num_gen_audio_tokens)
+    full = {f"llama.{name}": parameter.detach() for name, parameter in pretrained_parameters(llama).items()}
+    with torch.no_grad():
+        for name, rows in checkpoint["audio_rows"].items():
+            full[name][-rows.shape[0]:] = rows.to(full[name].dtype)
+    base = base_parameter_names(full, checkpoint["stage"])
+    full = {key: value for key, value in full.items() if key in base}
+    full.update(state_dict)
+    converted = {"model": full, **extra}
+    print(f"Added {len(base)} base weights to {len(state_dict)} adapter tensors")
+
+torch.save(converted, args.output)
+print(f"Wrote {args.output}: {os.path.getsize(args.output) / 2 ** 30:.2f} GiB "
+      f"(input {os.path.getsize(args.input) / 2 ** 30:.2f} GiB) in {time.perf_counter() - start:.1f} s")
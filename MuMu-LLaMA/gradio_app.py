@@ -7,7 +7,9 @@ from PIL import Image
 import scipy
 import argparse
 
-from llama.mumu_llama import MuMu_LLaMA
+from llama.mumu_llama import MuMu_LLaMA, is_adapter_checkpoint
+from llama.audioldm2.profiles import SAMPLER_PROFILES, SCHEDULERS, SCORING
+from llama.scheduler import Scheduler
 import llama
 import numpy as np
 import os
@@ -23,6 +25,15 @@ parser.add_argument(
     "--model", default="./ckpts/checkpoint.pth", type=str,
     help="Name of or path to MuMu_LLaMA pretrained checkpoint",
 )
+parser.add_argument(
+    "--music_conditioning", default="text", type=str, choices=["text", "embeddings"],
+    help="Condition MusicGen on the T5 encoding of the generated text, or directly on the projected [AUD*] "
+         "embeddings (no T5 pass)",
+)
+parser.add_argument(
+    "--verify_base_hashes", action="store_true",
+    help="For adapter checkpoints, compare the sha256 of the LLaMA shards with the ones the adapter was trained on",
+)
 parser.add_argument(
     "--llama_type", default="7B", type=str,
     help="Type of llama original weight",
@@ -55,27 +66,130 @@ parser.add_argument(
     '--music_decoder_path', default="facebook/musicgen-small", type=str,
     help='Path to decoder to use musicgen/audioldm2')
 
-args = parser.parse_args()
+parser.add_argument(
+    '--music_profile', default="reference", type=str, choices=list(SAMPLER_PROFILES),
+    help='AudioLDM2 quality/latency profile (scheduler, steps, candidates, CLAP scoring), see '
+         'benchmarks/audioldm2_profiles.py')
+parser.add_argument(
+    '--music_scheduler', default=None, type=str, choices=SCHEDULERS, help='Override the scheduler of --music_profile')
+parser.add_argument(
+    '--music_steps', default=None, type=int, help='Override the inference steps of --music_profile')
+parser.add_argument(
+    '--music_candidates', default=None, type=int,
+    help='Override the waveforms generated per prompt of --music_profile')
+parser.add_argument(
+    '--music_scoring', default=None, type=str, choices=SCORING,
+    help='Override how --music_profile ranks the candidates: CLAP with librosa or torchaudio resampling, or none')
+
+parser.add_argument(
+    '--max_batch_size', default=4, type=int,
+    help='Number of conversations decoded concurrently by the scheduler')
 
-generated_audio_files = []
+parser.add_argument(
+    '--kv_cache_blocks', default=None, type=int,
+    help='KV cache budget in blocks of 16 tokens (default: max_batch_size full-length conversations)')
+
+parser.add_argument(
+    '--no_merge_lora', action='store_true',
+    help='Keep the LoRA branches separate instead of folding them into the LLaMA weights')
+
+parser.add_argument(
+    '--attention_backend', default='sdpa', type=str, choices=['sdpa', 'reference'],
+    help='Attention implementation of the LLaMA layers, reference is the explicit matmul/softmax path')
+
+parser.add_argument(
+    '--no_feature_cache', action='store_true',
+    help='Always rerun MERT/ViT/ViViT instead of reusing the features of inputs seen before')
+
+parser.add_argument(
+    '--feature_cache_dir', default=None, type=str,
+    help='Also keep encoder features on disk (.npy files) in this directory, shared across runs')
+
+parser.add_argument(
+    '--feature_cache_memory_mb', default=256, type=int,
+    help='Memory budget of the encoder feature cache')
+
+parser.add_argument(
+    '--feature_cache_disk_mb', default=4096, type=int,
+    help='Disk budget of the encoder feature cache')
+
+parser.add_argument(
+    '--disable_components', default=[], nargs='*', choices=['mert', 'vit', 'vivit', 'music_decoder'],
+    help='Pretrained sub-models that are never loaded, inputs/outputs needing them raise an error')
+
+parser.add_argument(
+    '--preload_components', default=[], nargs='*',
+    choices=['mert', 'mert_processor', 'vit', 'vit_processor', 'vivit', 'vivit_processor', 'music_decoder',
+             'music_processor'],
+    help='Load these sub-models at startup instead of on first use')
+
+parser.add_argument(
+    '--mert_window_s', default=60, type=float,
+    help='Length of the windows long audio is cut into for MERT, in seconds')
+
+parser.add_argument(
+    '--mert_overlap_s', default=0, type=float,
+    help='Overlap of consecutive MERT windows, in seconds; each window keeps the frames up to the middle')
+
+parser.add_argument(
+    '--mert_max_windows', default=4, type=int,
+    help='Maximum number of windows (across all audio inputs) per MERT forward pass')
+
+parser.add_argument(
+    '--quantize', default='none', type=str, choices=['none', 'int8', 'int4'],
+    help='Weight-only quantisation of the LLaMA projections (LoRA, biases, norms and bridges stay as they are). '
+         'Checkpoints written by quantize.py are loaded quantised without this flag. int4 runs a packed kernel '
+         'only in bfloat16 on CPU with torch >= 2.6; elsewhere it dequantises the whole weight for every '
+         'matmul, which only saves memory and is slower than the unquantised model')
+
+parser.add_argument(
+    '--quant_group_size', default=128, type=int,
+    help='Input columns per int4 scale/zero group')
+
+parser.add_argument(
+    '--quant_compute_dtype', default=None, type=str, choices=['float32', 'bfloat16', 'float16'],
+    help='dtype of the quantised matmuls (default: bfloat16 on CPU, where the int8 kernel does not support '
+         'float32, else the activation dtype)')
+
+args = parser.parse_args()
 
 llama_type = args.llama_type
 llama_ckpt_dir = os.path.join(args.llama_dir, llama_type)
 llama_tokenzier_path = args.llama_dir
-model = MuMu_LLaMA(llama_ckpt_dir, llama_tokenzier_path, args, knn=False, stage=3, load_llama=False)
-
 print("Loading Model Checkpoint")
 checkpoint = torch.load(args.model, map_location='cpu')
+# adapter checkpoints only hold what was trained, the LLaMA base weights are loaded from --llama_dir
+adapter = is_adapter_checkpoint(checkpoint)
+model = MuMu_LLaMA(llama_ckpt_dir, llama_tokenzier_path, args, knn=False, stage=3, load_llama=adapter)
 
 new_ckpt = {}
 for key, value in checkpoint['model'].items():
     key = key.replace("module.", "")
     new_ckpt[key] = value
 
-load_result = model.load_state_dict(new_ckpt, strict=True)
+if args.quant_compute_dtype is not None:
+    quant_compute_dtype = getattr(torch, args.quant_compute_dtype)
+else:
+    quant_compute_dtype = torch.bfloat16 if torch.device(model.device).type == "cpu" else None
+quantization = checkpoint.get('quantization')
+if quantization is not None:
+    model.quantize(**quantization, compute_dtype=quant_compute_dtype, empty=True)
+if adapter:
+    load_result = model.load_adapter_checkpoint({**checkpoint, 'model': new_ckpt},
+                                                verify_hashes=args.verify_base_hashes)
+else:
+    load_result = model.load_state_dict(new_ckpt, strict=True)
 assert len(load_result.unexpected_keys) == 0, f"Unexpected keys: {load_result.unexpected_keys}"
 model.eval()
-model.to("cuda")
+model.to(model.device)
+if quantization is None and args.quantize != 'none':
+    quantization = {'bits': 8 if args.quantize == 'int8' else 4, 'group_size': args.quant_group_size}
+    model.quantize(**quantization, compute_dtype=quant_compute_dtype)
+if not args.no_merge_lora and quantization is None:
+    model.merge_lora()
+print(model.components.report())
+
+scheduler = Scheduler(model).start()
 
 transform = transforms.Compose(
     [transforms.ToTensor(), transforms.Lambda(lambda x: x.repeat(3, 1, 1) if x.size(0) == 1 else x)])
@@ -140,8 +254,7 @@ def parse_text(text, image_path, video_path, audio_path):
     return text, outputs
 
 
-def save_audio_to_local(audio, sec):
-    global generated_audio_files
+def save_audio_to_local(audio, sec, generated_audio_files):
     if not os.path.exists('temp'):
         os.mkdir('temp')
     filename = os.path.join('temp', next(tempfile._get_candidate_names()) + '.wav')
@@ -149,11 +262,12 @@ def save_audio_to_local(audio, sec):
         scipy.io.wavfile.write(filename, rate=16000, data=audio[0])
     else:
         scipy.io.wavfile.write(filename, rate=model.generation_model.config.audio_encoder.sampling_rate, data=audio)
-    generated_audio_files.append(filename)
+    if generated_audio_files is not None:
+        generated_audio_files.append(filename)
     return filename
 
 
-def parse_reponse(model_outputs, audio_length_in_s):
+def parse_reponse(model_outputs, audio_length_in_s, generated_audio_files=None):
     response = ''
     text_outputs = []
     for output_i, p in enumerate(model_outputs):
@@ -169,7 +283,7 @@ def parse_reponse(model_outputs, audio_length_in_s):
                     response += '<br>'
                     _temp_output += m.replace(' '.join([f'[AUD{i}]' for i in range(8)]), '')
                 else:
-                    filename = save_audio_to_local(m, audio_length_in_s)
+                    filename = save_audio_to_local(m, audio_length_in_s, generated_audio_files)
                     print(filename)
                     _temp_output = f'<Audio>{filename}</Audio> ' + _temp_output
                     response += f'<audio controls playsinline><source src="./file={filename}" type="audio/wav"></audio>'
@@ -189,8 +303,6 @@ def reset_dialog():
 
 
 def reset_state():
-    global generated_audio_files
-    generated_audio_files = []
     return None, None, None, None, [], [], []
 
 
@@ -248,8 +360,9 @@ def predict(
         temperature,
         history,
         modality_cache,
-        audio_length_in_s):
-    global generated_audio_files
+        audio_length_in_s,
+        generated_audio_files):
+    # generated_audio_files is per session (gr.State), sessions run concurrently
     prompts = [llama.format_prompt(prompt_input)]
     prompts = [model.tokenizer(x).input_ids for x in prompts]
     image, audio, video = None, None, None
@@ -275,15 +388,24 @@ def predict(
         audio = torch.mean(waveform, 0)
 
     print(image, video, audio)
-    response = model.generate(prompts, audio, image, video, 512, temperature, top_p,
-                              audio_length_in_s=audio_length_in_s)
-    print(response)
-    response_chat, response_outputs = parse_reponse(response, audio_length_in_s)
-    print('text_outputs: ', response_outputs)
     user_chat, user_outputs = parse_text(prompt_input, image_path, video_path, audio_path)
-    chatbot.append((user_chat, response_chat))
-    history.append((user_outputs, ''.join(response_outputs).replace('\n###', '')))
-    return chatbot, history, modality_cache, None, None, None,
+    chatbot.append((user_chat, ''))
+    partial = ''
+    for event in scheduler.stream(prompts[0], audio=audio, image=image, video=video, max_gen_len=512,
+                                  temperature=temperature, top_p=top_p, audio_length_in_s=audio_length_in_s):
+        if event['type'] == 'text':
+            partial += event['text']
+            chatbot[-1] = (user_chat, parse_reponse([partial], audio_length_in_s)[0])
+        elif event['type'] == 'music_pending':
+            chatbot[-1] = (user_chat, parse_reponse([partial], audio_length_in_s)[0] + '<br><i>Generating music...</i>')
+        elif event['type'] == 'done':
+            response = event['result']
+            print(response, scheduler.stats())
+            response_chat, response_outputs = parse_reponse(response, audio_length_in_s, generated_audio_files)
+            print('text_outputs: ', response_outputs)
+            chatbot[-1] = (user_chat, response_chat)
+            history.append((user_outputs, ''.join(response_outputs).replace('\n###', '')))
+        yield chatbot, history, modality_cache, None, None, None, generated_audio_files
 
 
 with gr.Blocks() as demo:
@@ -328,6 +450,7 @@ with gr.Blocks() as demo:
 
     history = gr.State([])
     modality_cache = gr.State([])
+    generated_audio_files = gr.State([])
 
     submitBtn.click(
         predict, [
@@ -340,14 +463,16 @@ with gr.Blocks() as demo:
             temperature,
             history,
             modality_cache,
-            audio_length_in_s
+            audio_length_in_s,
+            generated_audio_files
         ], [
             chatbot,
             history,
             modality_cache,
             image_path,
             audio_path,
-            video_path
+            video_path,
+            generated_audio_files
         ],
         show_progress=True
     )
@@ -359,7 +484,8 @@ with gr.Blocks() as demo:
         video_path,
         chatbot,
         history,
-        modality_cache
+        modality_cache,
+        generated_audio_files
     ], show_progress=True)
 
-demo.queue().launch(share=True, inbrowser=True, server_name='0.0.0.0', server_port=24000)
+demo.queue(concurrency_count=args.max_batch_size).launch(share=True, inbrowser=True, server_name='0.0.0.0', server_port=24000)
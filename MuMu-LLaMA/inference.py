@@ -5,7 +5,8 @@ from PIL import Image
 import scipy
 import argparse
 
-from llama.mumu_llama import MuMu_LLaMA
+from llama.mumu_llama import MuMu_LLaMA, is_adapter_checkpoint
+from llama.audioldm2.profiles import SAMPLER_PROFILES, SCHEDULERS, SCORING
 import llama
 import numpy as np
 import os
@@ -21,6 +22,15 @@ parser.add_argument(
     "--model", default="./ckpts/checkpoint.pth", type=str,
     help="Name of or path to MuMu_LLaMA pretrained checkpoint",
 )
+parser.add_argument(
+    "--music_conditioning", default="text", type=str, choices=["text", "embeddings"],
+    help="Condition MusicGen on the T5 encoding of the generated text, or directly on the projected [AUD*] "
+         "embeddings (no T5 pass)",
+)
+parser.add_argument(
+    "--verify_base_hashes", action="store_true",
+    help="For adapter checkpoints, compare the sha256 of the LLaMA shards with the ones the adapter was trained on",
+)
 parser.add_argument(
     "--llama_type", default="7B", type=str,
     help="Type of llama original weight",
@@ -34,11 +44,11 @@ parser.add_argument(
     help="Path to MERT pretrained checkpoint",
 )
 parser.add_argument(
-    "--vit_path", default="m-a-p/MERT-v1-330M", type=str,
+    "--vit_path", default="google/vit-base-patch16-224-in21k", type=str,
     help="Path to ViT pretrained checkpoint",
 )
 parser.add_argument(
-    "--vivit_path", default="m-a-p/MERT-v1-330M", type=str,
+    "--vivit_path", default="google/vivit-b-16x2-kinetics400", type=str,
     help="Path to ViViT pretrained checkpoint",
 )
 parser.add_argument(
@@ -53,6 +63,87 @@ parser.add_argument(
     '--music_decoder_path', default="facebook/musicgen-medium", type=str,
     help='Path to decoder to use musicgen/audioldm2')
 
+parser.add_argument(
+    '--music_profile', default="reference", type=str, choices=list(SAMPLER_PROFILES),
+    help='AudioLDM2 quality/latency profile (scheduler, steps, candidates, CLAP scoring), see '
+         'benchmarks/audioldm2_profiles.py')
+parser.add_argument(
+    '--music_scheduler', default=None, type=str, choices=SCHEDULERS, help='Override the scheduler of --music_profile')
+parser.add_argument(
+    '--music_steps', default=None, type=int, help='Override the inference steps of --music_profile')
+parser.add_argument(
+    '--music_candidates', default=None, type=int,
+    help='Override the waveforms generated per prompt of --music_profile')
+parser.add_argument(
+    '--music_scoring', default=None, type=str, choices=SCORING,
+    help='Override how --music_profile ranks the candidates: CLAP with librosa or torchaudio resampling, or none')
+
+parser.add_argument(
+    '--draft_llama_dir', default=None, type=str,
+    help='Path to a small LLaMA checkpoint (params.json + .pth) used as draft model for speculative decoding')
+
+parser.add_argument(
+    '--no_merge_lora', action='store_true',
+    help='Keep the LoRA branches separate instead of folding them into the LLaMA weights')
+
+parser.add_argument(
+    '--attention_backend', default='sdpa', type=str, choices=['sdpa', 'reference'],
+    help='Attention implementation of the LLaMA layers, reference is the explicit matmul/softmax path')
+
+parser.add_argument(
+    '--no_feature_cache', action='store_true',
+    help='Always rerun MERT/ViT/ViViT instead of reusing the features of inputs seen before')
+
+parser.add_argument(
+    '--feature_cache_dir', default=None, type=str,
+    help='Also keep encoder features on disk (.npy files) in this directory, shared across runs')
+
+parser.add_argument(
+    '--feature_cache_memory_mb', default=256, type=int,
+    help='Memory budget of the encoder feature cache')
+
+parser.add_argument(
+    '--feature_cache_disk_mb', default=4096, type=int,
+    help='Disk budget of the encoder feature cache')
+
+parser.add_argument(
+    '--disable_components', default=[], nargs='*', choices=['mert', 'vit', 'vivit', 'music_decoder'],
+    help='Pretrained sub-models that are never loaded, inputs/outputs needing them raise an error')
+
+parser.add_argument(
+    '--preload_components', default=[], nargs='*',
+    choices=['mert', 'mert_processor', 'vit', 'vit_processor', 'vivit', 'vivit_processor', 'music_decoder',
+             'music_processor'],
+    help='Load these sub-models at startup instead of on first use')
+
+parser.add_argument(
+    '--mert_window_s', default=60, type=float,
+    help='Length of the windows long audio is cut into for MERT, in seconds')
+
+parser.add_argument(
+    '--mert_overlap_s', default=0, type=float,
+    help='Overlap of consecutive MERT windows, in seconds; each window keeps the frames up to the middle')
+
+parser.add_argument(
+    '--mert_max_windows', default=4, type=int,
+    help='Maximum number of windows (across all audio inputs) per MERT forward pass')
+
+parser.add_argument(
+    '--quantize', default='none', type=str, choices=['none', 'int8', 'int4'],
+    help='Weight-only quantisation of the LLaMA projections (LoRA, biases, norms and bridges stay as they are). '
+         'Checkpoints written by quantize.py are loaded quantised without this flag. int4 runs a packed kernel '
+         'only in bfloat16 on CPU with torch >= 2.6; elsewhere it dequantises the whole weight for every '
+         'matmul, which only saves memory and is slower than the unquantised model')
+
+parser.add_argument(
+    '--quant_group_size', default=128, type=int,
+    help='Input columns per int4 scale/zero group')
+
+parser.add_argument(
+    '--quant_compute_dtype', default=None, type=str, choices=['float32', 'bfloat16', 'float16'],
+    help='dtype of the quantised matmuls (default: bfloat16 on CPU, where the int8 kernel does not support '
+         'float32, else the activation dtype)')
+
 # Input Arguments
 parser.add_argument(
     "--prompt", default="Generate a music", type=str,
@@ -78,20 +169,40 @@ generated_audio_files = []
 llama_type = args.llama_type
 llama_ckpt_dir = os.path.join(args.llama_dir, llama_type)
 llama_tokenzier_path = args.llama_dir
-model = MuMu_LLaMA(llama_ckpt_dir, llama_tokenzier_path, args, knn=False, stage=3, load_llama=False)
-
 print("Loading Model Checkpoint")
 checkpoint = torch.load(args.model, map_location='cpu')
+# adapter checkpoints only hold what was trained, the LLaMA base weights are loaded from --llama_dir
+adapter = is_adapter_checkpoint(checkpoint)
+model = MuMu_LLaMA(llama_ckpt_dir, llama_tokenzier_path, args, knn=False, stage=3, load_llama=adapter)
 
 new_ckpt = {}
 for key, value in checkpoint['model'].items():
     key = key.replace("module.", "")
     new_ckpt[key] = value
 
-load_result = model.load_state_dict(new_ckpt, strict=True)
+if args.quant_compute_dtype is not None:
+    quant_compute_dtype = getattr(torch, args.quant_compute_dtype)
+else:
+    quant_compute_dtype = torch.bfloat16 if torch.device(model.device).type == "cpu" else None
+quantization = checkpoint.get('quantization')
+if quantization is not None:
+    model.quantize(**quantization, compute_dtype=quant_compute_dtype, empty=True)
+if adapter:
+    load_result = model.load_adapter_checkpoint({**checkpoint, 'model': new_ckpt},
+                                                verify_hashes=args.verify_base_hashes)
+else:
+    load_result = model.load_state_dict(new_ckpt, strict=True)
 assert len(load_result.unexpected_keys) == 0, f"Unexpected keys: {load_result.unexpected_keys}"
 model.eval()
-model.to("cuda")
+model.to(model.device)
+if quantization is None and args.quantize != 'none':
+    quantization = {'bits': 8 if args.quantize == 'int8' else 4, 'group_size': args.quant_group_size}
+    model.quantize(**quantization, compute_dtype=quant_compute_dtype)
+if not args.no_merge_lora and quantization is None:
+    model.merge_lora()
+if args.draft_llama_dir is not None:
+    model.load_draft_model(args.draft_llama_dir)
+print(model.components.report())
 
 transform = transforms.Compose(
     [transforms.ToTensor(), transforms.Lambda(lambda x: x.repeat(3, 1, 1) if x.size(0) == 1 else x)])
@@ -1 +1,2 @@
-from .pipeline_audioldm2 import AudioLDM2Pipeline
\ No newline at end of file
+from .pipeline_audioldm2 import AudioLDM2Pipeline
+from .profiles import SAMPLER_PROFILES, SamplerProfile, apply_profile, get_profile
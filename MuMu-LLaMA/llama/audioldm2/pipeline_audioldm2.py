@@ -589,25 +589,36 @@ class AudioLDM2Pipeline(DiffusionPipeline):
         waveform = waveform.cpu().float()
         return waveform
 
-    def score_waveforms(self, text, audio, num_waveforms_per_prompt, device, dtype):
-        if not is_librosa_available():
-            logger.info(
-                "Automatic scoring of the generated audio waveforms against the input prompt text requires the "
-                "`librosa` package to resample the generated waveforms. Returning the audios in the order they were "
-                "generated. To enable automatic scoring, install `librosa` with: `pip install librosa`."
-            )
-            return audio
+    def resample_for_clap(self, audio, resample="librosa"):
+        # vocoder rate -> CLAP feature extractor rate, with librosa on numpy or torchaudio on torch tensors
+        orig_sr, target_sr = self.vocoder.config.sampling_rate, self.feature_extractor.sampling_rate
+        if resample == "torch":
+            import torchaudio
+            return torchaudio.functional.resample(audio.float(), orig_sr, target_sr).numpy()
+        return librosa.resample(audio.numpy(), orig_sr=orig_sr, target_sr=target_sr)
+
+    @torch.no_grad()
+    def clap_scores(self, text, audio, device, dtype, resample="librosa"):
+        """CLAP logits_per_text ([len(text), len(audio)]) of the waveforms audio ([N, T], vocoder rate)."""
         inputs = self.tokenizer(text, return_tensors="pt", padding=True)
-        resampled_audio = librosa.resample(
-            audio.numpy(), orig_sr=self.vocoder.config.sampling_rate, target_sr=self.feature_extractor.sampling_rate
-        )
+        resampled_audio = self.resample_for_clap(audio, resample)
         inputs["input_features"] = self.feature_extractor(
             list(resampled_audio), return_tensors="pt", sampling_rate=self.feature_extractor.sampling_rate
         ).input_features.type(dtype)
         inputs = inputs.to(device)
+        return self.text_encoder(**inputs).logits_per_text
 
+    def score_waveforms(self, text, audio, num_waveforms_per_prompt, device, dtype, resample="librosa"):
+        if resample == "librosa" and not is_librosa_available():
+            logger.info(
+                "Automatic scoring of the generated audio waveforms against the input prompt text requires the "
+                "`librosa` package to resample the generated waveforms. Returning the audios in the order they were "
+                "generated. To enable automatic scoring, install `librosa` with: `pip install librosa`, or resample "
+                "with torchaudio (`scoring=\"clap_torch\"`)."
+            )
+            return audio
         # compute the audio-text similarity score using the CLAP model
-        logits_per_text = self.text_encoder(**inputs).logits_per_text
+        logits_per_text = self.clap_scores(text, audio, device, dtype, resample)
         # sort by the highest matching generations per prompt
         indices = torch.argsort(logits_per_text, dim=1, descending=True)[:, :num_waveforms_per_prompt]
         audio = torch.index_select(audio, 0, indices.reshape(-1).cpu())
@@ -768,7 +779,8 @@ class AudioLDM2Pipeline(DiffusionPipeline):
         callback_steps: Optional[int] = 1,
         cross_attention_kwargs: Optional[Dict[str, Any]] = None,
         output_type: Optional[str] = "np",
-        return_prompts_only: Optional[bool] = False
+        return_prompts_only: Optional[bool] = False,
+        scoring: Optional[str] = "clap",
     ):
         r"""
         The call function to the pipeline for generation.
@@ -841,6 +853,10 @@ class AudioLDM2Pipeline(DiffusionPipeline):
                 The output format of the generated audio. Choose between `"np"` to return a NumPy `np.ndarray` or
                 `"pt"` to return a PyTorch `torch.Tensor` object. Set to `"latent"` to return the latent diffusion
                 model (LDM) output.
+            scoring (`str`, *optional*, defaults to `"clap"`):
+                How the `num_waveforms_per_prompt > 1` waveforms are ranked: `"clap"` resamples them with librosa for
+                the CLAP scoring, `"clap_torch"` with torchaudio, and `"none"` returns them in the order they were
+                generated without running CLAP.
 
         Examples:
 
@@ -980,13 +996,14 @@ class AudioLDM2Pipeline(DiffusionPipeline):
         audio = audio[:, :original_waveform_length]
 
         # 9. Automatic scoring
-        if num_waveforms_per_prompt > 1 and prompt is not None:
+        if num_waveforms_per_prompt > 1 and prompt is not None and scoring != "none":
             audio = self.score_waveforms(
                 text=prompt,
                 audio=audio,
                 num_waveforms_per_prompt=num_waveforms_per_prompt,
                 device=device,
                 dtype=prompt_embeds.dtype,
+                resample="torch" if scoring == "clap_torch" else "librosa",
             )
 
         if output_type == "np":
@@ -0,0 +1,65 @@
+from dataclasses import dataclass, replace
+
+SCHEDULERS = ("default", "dpmsolver++", "unipc", "ddim")
+SCORING = ("clap", "clap_torch", "none")
+
+
+@dataclass(frozen=True)
+class SamplerProfile:
+    """Quality/latency trade-off of an AudioLDM2 generation: the scheduler the UNet is sampled with, its number of
+    steps, the candidates generated per prompt and how they are ranked (scoring, see AudioLDM2Pipeline.__call__).
+    A generation costs num_inference_steps * num_waveforms_per_prompt UNet evaluations (doubled by CFG)."""
+    name: str
+    scheduler: str = "default"
+    num_inference_steps: int = 200
+    num_waveforms_per_prompt: int = 1
+    scoring: str = "clap"
+    guidance_scale: float = 3.5
+
+
+# benchmarks/audioldm2_profiles.py measures the latency and CLAP score of each on a fixture set of prompts
+SAMPLER_PROFILES = {
+    # the original hard-coded setting of generate_music
+    "reference": SamplerProfile("reference", "default", 200, 3, "clap"),
+    "quality": SamplerProfile("quality", "dpmsolver++", 50, 3, "clap_torch"),
+    "balanced": SamplerProfile("balanced", "dpmsolver++", 25, 2, "clap_torch"),
+    "fast": SamplerProfile("fast", "unipc", 20, 1, "none"),
+    "draft": SamplerProfile("draft", "dpmsolver++", 10, 1, "none"),
+}
+
+
+def get_profile(name, scheduler=None, num_inference_steps=None, num_waveforms_per_prompt=None, scoring=None,
+                guidance_scale=None):
+    """SAMPLER_PROFILES[name] with the given (not None) fields replaced."""
+    assert name in SAMPLER_PROFILES, f"Unknown sampler profile {name}, choose from {list(SAMPLER_PROFILES)}"
+    overrides = {"scheduler": scheduler, "num_inference_steps": num_inference_steps,
+                 "num_waveforms_per_prompt": num_waveforms_per_prompt, "scoring": scoring,
+                 "guidance_scale": guidance_scale}
+    profile = replace(SAMPLER_PROFILES[name], **{k: v for k, v in overrides.items() if v is not None})
+    assert profile.scheduler in SCHEDULERS, f"Unknown scheduler {profile.scheduler}, choose from {SCHEDULERS}"
+    assert profile.scoring in SCORING, f"Unknown scoring {profile.scoring}, choose from {SCORING}"
+    return profile
+
+
+def make_scheduler(name, config):
+    from diffusers import DDIMScheduler, DPMSolverMultistepScheduler, UniPCMultistepScheduler
+    if name == "dpmsolver++":
+        return DPMSolverMultistepScheduler.from_config(config, algorithm_type="dpmsolver++", solver_order=2)
+    if name == "unipc":
+        return UniPCMultistepScheduler.from_config(config)
+    return DDIMScheduler.from_config(config)
+
+
+def apply_profile(pipe, profile):
+    """Swap the scheduler of pipe (an AudioLDM2Pipeline) to the one of profile and return the __call__ kwargs of
+    profile. The schedulers are built from the config of the pipeline's own scheduler, kept as
+    pipe.default_scheduler, and cached on the pipeline."""
+    if not hasattr(pipe, "default_scheduler"):
+        pipe.default_scheduler = pipe.scheduler
+        pipe.profile_schedulers = {"default": pipe.scheduler}
+    if profile.scheduler not in pipe.profile_schedulers:
+        pipe.profile_schedulers[profile.scheduler] = make_scheduler(profile.scheduler, pipe.default_scheduler.config)
+    pipe.scheduler = pipe.profile_schedulers[profile.scheduler]
+    return {"num_inference_steps": profile.num_inference_steps,
+            "num_waveforms_per_prompt": profile.num_waveforms_per_prompt,
+            "scoring": profile.scoring, "guidance_scale": profile.guidance_scale}
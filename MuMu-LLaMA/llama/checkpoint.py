@@ -0,0 +1,150 @@
+import hashlib
+import json
+import math
+import os
+from pathlib import Path
+
+import torch
+from torch import nn
+
+# dimension the model-parallel LLaMA shards split each weight along (None: replicated), by parameter name;
+# 2 is the embedding, split along dim -1 and extended by the [AUD*] rows
+KEY_TO_DIM = {
+    "w1": 0,
+    "w2": -1,
+    "w3": 0,
+    "wo": -1,
+    "wq": 0,
+    "wk": 0,
+    "wv": 0,
+    "output": 0,
+    "tok_embeddings": 2,
+    "ffn_norm": None,
+    "attention_norm": None,
+    "norm": None,
+    "rope": None,
+}
+
+
+class _SafetensorsShard:
+    # tensors of a .safetensors file read on access, from the memory-mapped file
+    def __init__(self, path):
+        from safetensors import safe_open
+        self.file = safe_open(str(path), framework="pt", device="cpu")
+
+    def __getitem__(self, key):
+        return self.file.get_tensor(key)
+
+
+def checkpoint_files(ckpt_dir):
+    """The LLaMA checkpoint shards of ckpt_dir: *.safetensors if there are any, else *.pth."""
+    return sorted(Path(ckpt_dir).glob("*.safetensors")) or sorted(Path(ckpt_dir).glob("*.pth"))
+
+
+def open_shard(path):
+    """A shard as a mapping from names to CPU tensors backed by the memory-mapped file, so tensors are only
+    read from disk when they are copied out."""
+    if Path(path).suffix == ".safetensors":
+        return _SafetensorsShard(path)
+    return torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+
+
+def pretrained_parameters(model):
+    # the parameters of a llama.llama.Transformer that come from the pretrained checkpoints
+    return {name: parameter for name, parameter in model.named_parameters()
+            if "gate" not in name and "lora" not in name and "bias" not in name}
+
+
+@torch.no_grad()
+def load_llama_checkpoint(model, ckpt_dir, num_gen_audio_tokens):
+    """Copy the pretrained weights of ckpt_dir into model (a llama.llama.Transformer), shard by shard.
+
+    Shards are memory-mapped and every slice is copied straight into its parameter, converting to the
+    parameter's dtype and device on the way, so no second copy of the model is held in memory. ckpt_dir holds
+    either Meta's model-parallel shards, split according to KEY_TO_DIM, or a single checkpoint written by
+    consolidate_llama.py. Rows the shards do not have (the [AUD*] tokens) are set to 1 in tok_embeddings and
+    randomly initialised (as nn.Linear does) in output.
+    """
+    ckpts = checkpoint_files(ckpt_dir)
+    assert ckpts, f"No *.pth or *.safetensors LLaMA checkpoint in {ckpt_dir}"
+    parameters = pretrained_parameters(model)
+    for i, ckpt in enumerate(ckpts):
+        checkpoint = open_shard(ckpt)
+        for parameter_name, parameter in parameters.items():
+            short_name = parameter_name.split(".")[-2]
+            value = checkpoint[parameter_name]
+            if value.shape == parameter.shape:
+                # replicated (norms), or the whole weight in one file
+                if i == 0:
+                    parameter.copy_(value)
+            elif KEY_TO_DIM[short_name] == 0:
+                size = value.size(0)
+                # the shards have to tile the rows, e.g. n_kv_heads // len(ckpts) heads each for wk/wv
+                # (output has extra rows for the [AUD*] tokens)
+                assert short_name == "output" or size * len(ckpts) == parameter.shape[0], \
+                    f"{parameter_name}: {len(ckpts)} shards of {size} rows for {parameter.shape[0]} " \
+                    f"rows, check n_heads/n_kv_heads in params.json"
+                parameter[size * i: size * (i + 1), :].copy_(value)
+                if short_name == "output" and i == len(ckpts) - 1 and size * len(ckpts) < parameter.shape[0]:
+                    nn.init.kaiming_uniform_(parameter[size * len(ckpts):], a=math.sqrt(5))
+            elif KEY_TO_DIM[short_name] == -1:
+                size = value.size(-1)
+                parameter[:, size * i: size * (i + 1)].copy_(value)
+            elif KEY_TO_DIM[short_name] == 2:
+                size = value.size(-1)
+                parameter[:-num_gen_audio_tokens, size * i: size * (i + 1)].copy_(value)
+                parameter[-num_gen_audio_tokens:, :] = 1
+            else:
+                raise ValueError(f"{parameter_name}: checkpoint shape {tuple(value.shape)} does not match the "
+                                 f"model {tuple(parameter.shape)}")
+        del checkpoint
+
+
+_sha256_cache = {}
+
+
+def file_sha256(path):
+    """sha256 of a file, computed once per path, size and modification time."""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _sha256_cache:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(2 ** 24), b""):
+                h.update(chunk)
+        _sha256_cache[key] = h.hexdigest()
+    return _sha256_cache[key]
+
+
+def llama_manifest(ckpt_dir, hashes=True):
+    """Description of the LLaMA checkpoint in ckpt_dir that adapter checkpoints are trained on: its path,
+    params.json and the size (and sha256) of every shard."""
+    with open(os.path.join(ckpt_dir, "params.json"), "r") as f:
+        params = json.loads(f.read())
+    return {
+        "path": str(ckpt_dir),
+        "params": params,
+        "files": {ckpt.name: {"size": ckpt.stat().st_size, "sha256": file_sha256(ckpt) if hashes else None}
+                  for ckpt in checkpoint_files(ckpt_dir)},
+    }
+
+
+def verify_llama_manifest(manifest, ckpt_dir, hashes=False):
+    """Differences between the LLaMA checkpoint in ckpt_dir and manifest (llama_manifest()), as messages.
+    Shards are compared by name and size, and by sha256 with hashes=True."""
+    current = llama_manifest(ckpt_dir, hashes=False)
+    problems = []
+    if current["params"] != manifest["params"]:
+        problems.append(f"params.json of {ckpt_dir} is {current['params']}, the adapter was trained with "
+                        f"{manifest['params']}")
+    if set(current["files"]) != set(manifest["files"]):
+        problems.append(f"{ckpt_dir} has the shards {sorted(current['files'])}, the adapter was trained with "
+                        f"{sorted(manifest['files'])} from {manifest['path']}")
+        return problems
+    for name, expected in manifest["files"].items():
+        if current["files"][name]["size"] != expected["size"]:
+            problems.append(f"{name}: {current['files'][name]['size']} bytes, expected {expected['size']}")
+        elif hashes and expected["sha256"] is not None \
+                and file_sha256(os.path.join(ckpt_dir, name)) != expected["sha256"]:
+            problems.append(f"{name}: sha256 differs from the one the adapter was trained with")
+    return problems
@@ -0,0 +1,123 @@
+import gc
+import threading
+import time
+
+import torch
+from torch import nn
+
+
+def _tensor_bytes(value):
+    # parameters and buffers of a module, a diffusers pipeline (its .components) or a tuple of them
+    if isinstance(value, nn.Module):
+        tensors = {id(t): t for t in list(value.parameters()) + list(value.buffers())}
+        return sum(t.numel() * t.element_size() for t in tensors.values())
+    if isinstance(value, (tuple, list)):
+        return sum(_tensor_bytes(v) for v in value)
+    if hasattr(value, "components") and isinstance(value.components, dict):
+        return sum(_tensor_bytes(v) for v in value.components.values())
+    return 0
+
+
+class Component:
+    """A pretrained sub-model (or processor) that is loaded by loader() the first time it is used. Threads
+    asking for it at the same time wait for one load instead of each loading a copy."""
+
+    def __init__(self, name, loader, enabled=True):
+        self.name = name
+        self.loader = loader
+        self.enabled = enabled
+        self.value = None
+        self.load_seconds = None
+        self.memory_bytes = None
+        self.loads = 0
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self.value is not None
+
+    def get(self):
+        value = self.value
+        if value is not None:
+            return value
+        with self._lock:
+            if self.value is not None:
+                return self.value
+            if not self.enabled:
+                raise RuntimeError(f"{self.name} is disabled (--disable_components), inputs that need it "
+                                   f"cannot be processed")
+            print(f"Loading {self.name}...")
+            start = time.perf_counter()
+            self.value = self.loader()
+            self.load_seconds = time.perf_counter() - start
+            self.memory_bytes = _tensor_bytes(self.value)
+            self.loads += 1
+            print(f"{self.name} loaded in {self.load_seconds:.1f} s, {self.memory_bytes / 2 ** 20:.1f} MiB")
+        return self.value
+
+    def unload(self):
+        with self._lock:
+            if self.value is None:
+                return
+            self.value = None
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        print(f"{self.name} unloaded")
+
+
+class ComponentRegistry:
+    """Lazily loaded sub-models by name: registry[name] loads the component on first use, unload() frees it
+    again (the next use reloads it) and disabled components raise instead of loading. Parts that are built
+    eagerly can be added with record() so that report() covers the whole model."""
+
+    def __init__(self):
+        self.components = {}
+
+    def register(self, name, loader, enabled=True):
+        self.components[name] = Component(name, loader, enabled)
+
+    def record(self, name, load_seconds, value):
+        component = Component(name, None)
+        component.value = value
+        component.load_seconds = load_seconds
+        component.memory_bytes = _tensor_bytes(value)
+        component.loads = 1
+        self.components[name] = component
+
+    def __getitem__(self, name):
+        return self.components[name].get()
+
+    def __contains__(self, name):
+        return name in self.components
+
+    def is_enabled(self, name):
+        return self.components[name].enabled
+
+    def is_loaded(self, name):
+        return self.components[name].loaded
+
+    def load(self, *names):
+        for name in names:
+            self[name]
+
+    def unload(self, *names):
+        """Unload the named components, all lazily loaded ones without names."""
+        for name in names or [name for name, c in self.components.items() if c.loader is not None]:
+            self.components[name].unload()
+
+    def stats(self):
+        return {name: {'enabled': c.enabled, 'loaded': c.loaded, 'load_seconds': c.load_seconds,
+                       'memory_bytes': c.memory_bytes if c.loaded else 0, 'loads': c.loads}
+                for name, c in self.components.items()}
+
+    def report(self):
+        lines = [f"{'component':16s} {'state':9s} {'load time':>10s} {'memory':>12s}"]
+        for name, c in self.components.items():
+            state = "disabled" if not c.enabled else "loaded" if c.loaded else "lazy"
+            load_time = "" if c.load_seconds is None else f"{c.load_seconds:.1f} s"
+            memory = f"{c.memory_bytes / 2 ** 20:.1f} MiB" if c.loaded else ""
+            lines.append(f"{name:16s} {state:9s} {load_time:>10s} {memory:>12s}")
+        total = sum(c.memory_bytes for c in self.components.values() if c.loaded)
+        lines.append(f"{'total':16s} {'':9s} {'':>10s} {total / 2 ** 20:>8.1f} MiB")
+        return "\n".join(lines)
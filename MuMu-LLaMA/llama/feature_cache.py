@@ -0,0 +1,133 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+def _as_array(x):
+    if torch.is_tensor(x):
+        x = x.detach().cpu()
+        return (x.float() if x.dtype == torch.bfloat16 else x).numpy()
+    if isinstance(x, (list, tuple)):
+        return np.stack([_as_array(v) for v in x])
+    return np.asarray(x)
+
+
+class FeatureCache:
+    """Two-tier LRU cache of encoder features, keyed by content (see key()).
+
+    The memory tier holds up to max_memory_bytes of CPU tensors. With a cache_dir every entry is also written
+    to <cache_dir>/<key>.npy, read back memory-mapped on a memory miss and kept up to max_disk_bytes; the
+    files survive restarts and their modification time orders the disk LRU. bfloat16 is stored as float32
+    on disk. Both tiers evict least recently used entries first.
+    """
+
+    def __init__(self, max_memory_bytes=256 * 2 ** 20, cache_dir=None, max_disk_bytes=4 * 2 ** 30):
+        self.max_memory_bytes = max_memory_bytes
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.disk = OrderedDict()
+        self.disk_bytes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            files = [e for e in os.scandir(cache_dir) if e.name.endswith(".npy")]
+            for entry in sorted(files, key=lambda e: e.stat().st_mtime):
+                self.disk[entry.name[:-4]] = entry.stat().st_size
+                self.disk_bytes += entry.stat().st_size
+
+    @staticmethod
+    def key(*parts):
+        """sha1 of the parts: strings and numbers by value, tensors/arrays (or lists of them) by dtype, shape
+        and contents."""
+        h = hashlib.sha1()
+        for part in parts:
+            if isinstance(part, (str, int, float)) or part is None:
+                h.update(repr(part).encode())
+            else:
+                array = np.ascontiguousarray(_as_array(part))
+                h.update(f"{array.dtype}{array.shape}".encode())
+                h.update(array.data)
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npy")
+
+    def get(self, key):
+        """The cached features (a CPU tensor) or None."""
+        with self._lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return self.memory[key]
+            if key in self.disk:
+                try:
+                    value = torch.from_numpy(np.array(np.load(self._path(key), mmap_mode="r")))
+                except (OSError, ValueError):
+                    self._drop_file(key)
+                else:
+                    os.utime(self._path(key))
+                    self.disk.move_to_end(key)
+                    self.disk_hits += 1
+                    self._remember(key, value)
+                    return value
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        value = value.detach().cpu()
+        with self._lock:
+            self._remember(key, value)
+            if self.cache_dir is not None and key not in self.disk:
+                array = _as_array(value)
+                tmp = self._path(key) + f".{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp, "wb") as f:
+                    np.save(f, array)
+                os.replace(tmp, self._path(key))
+                self.disk[key] = os.path.getsize(self._path(key))
+                self.disk_bytes += self.disk[key]
+                while self.disk_bytes > self.max_disk_bytes and len(self.disk) > 1:
+                    self._drop_file(next(iter(self.disk)))
+
+    def _remember(self, key, value):
+        if key in self.memory:
+            self.memory_bytes -= self.memory.pop(key).nbytes
+        self.memory[key] = value
+        self.memory_bytes += value.nbytes
+        while self.memory_bytes > self.max_memory_bytes and self.memory:
+            self.memory_bytes -= self.memory.popitem(last=False)[1].nbytes
+
+    def _drop_file(self, key):
+        self.disk_bytes -= self.disk.pop(key)
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        with self._lock:
+            self.memory.clear()
+            self.memory_bytes = 0
+            for key in list(self.disk):
+                self._drop_file(key)
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.memory_hits + self.disk_hits) / max(lookups, 1),
+            'memory_entries': len(self.memory),
+            'memory_bytes': self.memory_bytes,
+            'disk_entries': len(self.disk),
+            'disk_bytes': self.disk_bytes,
+        }
@@ -0,0 +1,100 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+# PIL resampling filters of the HF processors -> F.interpolate modes
+_INTERPOLATION = {0: "nearest", 2: "bilinear", 3: "bicubic"}
+
+
+def _as_tensor(x, device):
+    # channels first [..., C, H, W]; uint8 stays uint8 for the copy to the device
+    x = torch.as_tensor(np.asarray(x) if not torch.is_tensor(x) else x).to(device)
+    if x.shape[-3] not in (1, 3) and x.shape[-1] in (1, 3):
+        x = x.movedim(-1, -3)
+    if x.shape[-3] == 1:
+        x = x.expand(*x.shape[:-3], 3, *x.shape[-2:])
+    return x
+
+
+def _output_size(height, width, size):
+    # transformers.image_transforms.get_resize_output_image_size
+    if "shortest_edge" in size:
+        short, long = (width, height) if width <= height else (height, width)
+        new_short, new_long = size["shortest_edge"], int(size["shortest_edge"] * long / short)
+        return (new_long, new_short) if width <= height else (new_short, new_long)
+    return size["height"], size["width"]
+
+
+def _resize(x, size, resample):
+    """Resize [N, C, H, W] like PIL does in the HF processors: on values in [0, 255], antialiased when
+    downsampling, rounded back to integers."""
+    height, width = _output_size(x.shape[-2], x.shape[-1], size)
+    if (height, width) == tuple(x.shape[-2:]):
+        return x.float()
+    mode = _INTERPOLATION[resample]
+    if mode == "nearest":
+        return F.interpolate(x.float(), size=(height, width), mode="nearest-exact")
+    x = F.interpolate(x.float(), size=(height, width), mode=mode, align_corners=False, antialias=True)
+    return x.round_().clamp_(0, 255)
+
+
+def _center_crop(x, crop_size):
+    # transformers.image_transforms.center_crop, zero padded when the image is smaller than the crop
+    crop_height, crop_width = crop_size["height"], crop_size["width"]
+    height, width = x.shape[-2:]
+    pad_height, pad_width = max(crop_height - height, 0), max(crop_width - width, 0)
+    if pad_height or pad_width:
+        x = F.pad(x, (pad_width // 2, pad_width - pad_width // 2, pad_height // 2, pad_height - pad_height // 2))
+        height, width = x.shape[-2:]
+    top, left = (height - crop_height) // 2, (width - crop_width) // 2
+    return x[..., top:top + crop_height, left:left + crop_width]
+
+
+def _preprocess(frames, processor):
+    """resize -> center crop -> rescale (and offset) -> normalise [N, C, H, W] frames of one size as the
+    processor would. Float frames are taken to be in [0, 1] and, as in the HF resize, go through uint8."""
+    scale = None
+    if processor.do_resize:
+        if frames.is_floating_point():
+            frames, scale = (frames * 255).to(torch.uint8), 1 / 255
+        frames = _resize(frames, processor.size, processor.resample)
+    frames = frames.float()
+    if getattr(processor, "do_center_crop", False):
+        frames = _center_crop(frames, processor.crop_size)
+    if scale is not None:
+        frames = frames * scale
+    if processor.do_rescale:
+        frames = frames * processor.rescale_factor
+        if getattr(processor, "offset", False):
+            frames = frames - 1
+    if processor.do_normalize:
+        mean = torch.tensor(processor.image_mean, device=frames.device)[:, None, None]
+        std = torch.tensor(processor.image_std, device=frames.device)[:, None, None]
+        frames = (frames - mean) / std
+    return frames
+
+
+def _preprocess_batched(items, processor):
+    # items of the same shape are processed together, as one [N, C, H, W] batch of frames
+    outputs = [None] * len(items)
+    shapes = {}
+    for i, item in enumerate(items):
+        shapes.setdefault((item.shape, item.dtype), []).append(i)
+    for (shape, _), indices in shapes.items():
+        frames = torch.stack([items[i] for i in indices]).flatten(0, -4)
+        frames = _preprocess(frames, processor)
+        for i, values in zip(indices, frames.reshape(len(indices), *shape[:-3], *frames.shape[-3:])):
+            outputs[i] = values
+    return torch.stack(outputs)
+
+
+def preprocess_images(images, processor, device=None):
+    """pixel_values [B, 3, H, W] of the images (uint8 or [0, 1] float, [C, H, W] or [H, W, C]) as given by
+    the HF image processor, computed with torch ops on device."""
+    return _preprocess_batched([_as_tensor(image, device) for image in images], processor)
+
+
+def preprocess_videos(videos, processor, device=None):
+    """pixel_values [B, T, 3, H, W] of the videos ([T, H, W, C] or [T, C, H, W] frames each) as given by
+    VivitImageProcessor, computed with torch ops on device."""
+    return _preprocess_batched([_as_tensor(video, device) for video in videos], processor)
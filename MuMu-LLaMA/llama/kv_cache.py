@@ -0,0 +1,295 @@
+import itertools
+import math
+from collections import OrderedDict
+from typing import List, Optional
+
+import torch
+
+
+class PagedKVCache:
+    """Block based K/V cache shared by all attention layers of a Transformer and by all running sequences.
+
+    Keys/values live in per-layer pools of shape [num_blocks, block_size, n_heads, head_dim], where n_heads
+    counts key/value heads (n_kv_heads with grouped-query attention). Every sequence owns a block table, the
+    same block ids are used in every layer. Blocks are handed out when a sequence actually writes into them
+    and go back to the free list when the sequence is freed, so memory follows the
+    number of tokens in flight instead of max_batch_size x max_seq_len. The pools are created lazily with the
+    dtype/device of the first activations they see and grow on demand up to max_blocks. They keep their size
+    between generations; release() shrinks them back to the cached prefix blocks once no sequence is left.
+
+    Blocks are reference counted: a block shared with the prefix cache is copied the first time its sequence
+    writes into it (copy-on-write).
+
+    With prefix_caching, full blocks of prompts are kept in a hashed block table after the sequence that
+    computed them is gone (cache_prefix()). A block is keyed on all tokens up to its end plus a fingerprint of
+    everything else the K/V depend on (e.g. the adapter inputs), so match_prefix() can point a new sequence at
+    the blocks of the longest cached prefix and prefill starts at the first token that is not cached. Cached
+    blocks nobody uses are evicted least recently used first once the pool is full.
+
+    Before a forward pass the caller binds the sequences of the batch and the absolute positions of the new
+    tokens; each attention layer then writes its keys/values there and reads back the first
+    positions.max() + 1 entries of every sequence. Entries past a sequence's own length are padding and have
+    to be masked by the caller; the pools are zero initialised, so padding is always finite and the mask
+    hides it.
+    """
+
+    def __init__(self, n_layers: int, n_heads: int, head_dim: int, block_size: int = 16,
+                 max_blocks: Optional[int] = None, initial_blocks: int = 16, prefix_caching: bool = True):
+        self.n_layers = n_layers
+        self.n_heads = n_heads
+        self.head_dim = head_dim
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.initial_blocks = initial_blocks
+
+        self.pool_k = [None] * n_layers
+        self.pool_v = [None] * n_layers
+        self.num_blocks = 0
+        self.free_blocks = []
+        self.ref_counts = []
+
+        self.block_tables = {}
+        self.seq_lens = {}
+        self.reserved = {}
+        self._ids = itertools.count()
+
+        self.prefix_caching = prefix_caching
+        self.prefix_blocks = OrderedDict()
+        self.prefix_query_tokens = 0
+        self.prefix_hit_tokens = 0
+
+        self.seq_ids = None
+        self.read_len = 0
+        self.write_slots = None
+        self.gather_table = None
+
+    # ---------------------------------------------------------------- accounting
+    def blocks_for(self, num_tokens: int):
+        return math.ceil(num_tokens / self.block_size)
+
+    @property
+    def num_used_blocks(self):
+        return self.num_blocks - len(self.free_blocks)
+
+    @property
+    def num_evictable_blocks(self):
+        return sum(self.ref_counts[b] == 1 for b in self.prefix_blocks.values())
+
+    @property
+    def num_committed_blocks(self):
+        """Blocks in use (without evictable prefix blocks) plus blocks promised to running sequences."""
+        pending = sum(max(0, self.reserved[s] - len(t)) for s, t in self.block_tables.items())
+        return self.num_used_blocks - self.num_evictable_blocks + pending
+
+    @property
+    def num_free_blocks(self):
+        if self.max_blocks is None:
+            return None
+        return self.max_blocks - self.num_committed_blocks
+
+    @property
+    def memory_bytes(self):
+        return sum(p.numel() * p.element_size() for p in self.pool_k + self.pool_v if p is not None)
+
+    def can_allocate(self, num_tokens: int):
+        return self.max_blocks is None or self.blocks_for(num_tokens) <= self.num_free_blocks
+
+    # ---------------------------------------------------------------- sequences
+    def allocate(self, num_tokens: int = 0):
+        """Register a new, empty sequence and reserve budget for num_tokens tokens. Returns its id."""
+        if not self.can_allocate(num_tokens):
+            raise RuntimeError(f"KV cache cannot hold {num_tokens} more tokens "
+                               f"({self.num_free_blocks} of {self.max_blocks} blocks free)")
+        seq_id = next(self._ids)
+        self.block_tables[seq_id] = []
+        self.seq_lens[seq_id] = 0
+        self.reserved[seq_id] = self.blocks_for(num_tokens)
+        return seq_id
+
+    def free(self, seq_id: int):
+        for block in self.block_tables.pop(seq_id):
+            self._release_block(block)
+        del self.seq_lens[seq_id]
+        del self.reserved[seq_id]
+
+    def truncate(self, seq_id: int, num_tokens: int):
+        """Forget everything of seq_id from position num_tokens on."""
+        table = self.block_tables[seq_id]
+        keep = self.blocks_for(num_tokens)
+        for block in table[keep:]:
+            self._release_block(block)
+        del table[keep:]
+        self.seq_lens[seq_id] = min(self.seq_lens[seq_id], num_tokens)
+
+    def release(self):
+        """Shrink the pools to the cached prefix blocks once no sequence is left, returning the memory of the
+        free blocks to the allocator (e.g. when a Scheduler stops)."""
+        assert not self.block_tables, f"{len(self.block_tables)} sequences still hold KV blocks"
+        keep = list(self.prefix_blocks.values())
+        for layer_id in range(self.n_layers):
+            pool_k, pool_v = self.pool_k[layer_id], self.pool_v[layer_id]
+            if pool_k is None or not keep:
+                self.pool_k[layer_id] = self.pool_v[layer_id] = None
+            else:
+                index = torch.tensor(keep, device=pool_k.device)
+                self.pool_k[layer_id], self.pool_v[layer_id] = pool_k[index], pool_v[index]
+        self.prefix_blocks = OrderedDict((h, i) for i, h in enumerate(self.prefix_blocks))
+        self.num_blocks = len(keep)
+        self.free_blocks = []
+        self.ref_counts = [1] * len(keep)
+
+    # ---------------------------------------------------------------- prefix caching
+    def _block_hashes(self, tokens, fingerprint):
+        hashes, h = [], hash(fingerprint)
+        for i in range(0, len(tokens) - self.block_size + 1, self.block_size):
+            h = hash((h, tuple(tokens[i:i + self.block_size])))
+            hashes.append(h)
+        return hashes
+
+    def match_prefix(self, seq_id: int, tokens: List[int], fingerprint=None):
+        """Point the empty sequence seq_id at the cached blocks of the longest cached prefix of tokens.
+
+        Returns the number of tokens whose K/V are already in place. The last token is never matched, so the
+        caller always has at least one token to run and gets its logits."""
+        table = self.block_tables[seq_id]
+        assert not table, "match_prefix() expects a new sequence"
+        self.prefix_query_tokens += len(tokens)
+        if not self.prefix_caching:
+            return 0
+        matched = []
+        for h in self._block_hashes(tokens[:-1], fingerprint):
+            block = self.prefix_blocks.get(h)
+            if block is None:
+                break
+            self.ref_counts[block] += 1
+            table.append(block)
+            matched.append(h)
+        self._touch(matched)
+        self.seq_lens[seq_id] = len(table) * self.block_size
+        self.prefix_hit_tokens += self.seq_lens[seq_id]
+        return self.seq_lens[seq_id]
+
+    def cache_prefix(self, seq_id: int, tokens: List[int], fingerprint=None):
+        """Share the full blocks seq_id has written for tokens with later match_prefix() calls."""
+        if not self.prefix_caching:
+            return
+        table = self.block_tables[seq_id]
+        hashes = self._block_hashes(tokens[:self.seq_lens[seq_id]], fingerprint)
+        for h, block in zip(hashes, table):
+            if h not in self.prefix_blocks:
+                self.prefix_blocks[h] = block
+                self.ref_counts[block] += 1
+        self._touch(hashes[:len(table)])
+
+    def _touch(self, hashes):
+        # most recently used last; a prefix counts as more recent than its continuations so that eviction
+        # removes the tails of cached prefixes first and never strands a block behind an evicted one
+        for h in reversed(hashes):
+            self.prefix_blocks.move_to_end(h)
+
+    def clear_prefix_cache(self):
+        """Forget all cached prefixes, e.g. because the weights they were computed with changed."""
+        for block in self.prefix_blocks.values():
+            self._release_block(block)
+        self.prefix_blocks.clear()
+
+    def _evict(self):
+        for h, block in self.prefix_blocks.items():
+            if self.ref_counts[block] == 1:
+                del self.prefix_blocks[h]
+                self._release_block(block)
+                return True
+        return False
+
+    # ---------------------------------------------------------------- blocks
+    def _new_block(self):
+        if not self.free_blocks and self.max_blocks is not None and self.num_blocks >= self.max_blocks:
+            if not self._evict():
+                raise RuntimeError(f"KV cache is out of blocks ({self.max_blocks} blocks in use)")
+        if not self.free_blocks:
+            capacity = max(2 * self.num_blocks, self.initial_blocks)
+            if self.max_blocks is not None:
+                capacity = min(capacity, self.max_blocks)
+            # lowest ids at the end of the free list, pop() hands them out first
+            self.free_blocks.extend(reversed(range(self.num_blocks, capacity)))
+            self.ref_counts.extend([0] * (capacity - self.num_blocks))
+            self.num_blocks = capacity
+        block = self.free_blocks.pop()
+        self.ref_counts[block] = 1
+        return block
+
+    def _release_block(self, block):
+        self.ref_counts[block] -= 1
+        if self.ref_counts[block] == 0:
+            self.free_blocks.append(block)
+
+    def _pools(self, layer_id, like=None):
+        pool_k, pool_v = self.pool_k[layer_id], self.pool_v[layer_id]
+        if pool_k is None and like is None:
+            return None, None
+        if pool_k is None or pool_k.shape[0] < self.num_blocks:
+            shape = (self.num_blocks, self.block_size, self.n_heads, self.head_dim)
+            ref = like if pool_k is None else pool_k
+            # zeros: reads past a sequence's length (and the block 0 padding of the gather table) must stay
+            # finite, a NaN would survive the -inf mask
+            new_k = torch.zeros(shape, dtype=ref.dtype, device=ref.device)
+            new_v = torch.zeros(shape, dtype=ref.dtype, device=ref.device)
+            if pool_k is not None:
+                new_k[:pool_k.shape[0]] = pool_k
+                new_v[:pool_v.shape[0]] = pool_v
+            self.pool_k[layer_id], self.pool_v[layer_id] = pool_k, pool_v = new_k, new_v
+        return pool_k, pool_v
+
+    def _copy_block(self, src, dst):
+        for layer_id in range(self.n_layers):
+            pool_k, pool_v = self._pools(layer_id)
+            if pool_k is not None:
+                pool_k[dst] = pool_k[src]
+                pool_v[dst] = pool_v[src]
+
+    # ---------------------------------------------------------------- forward pass
+    @property
+    def bound(self):
+        return self.seq_ids is not None
+
+    def bind(self, seq_ids: List[int], positions: torch.Tensor):
+        """seq_ids: the sequences of the batch, positions: [bsz, seqlen] absolute positions of the new tokens"""
+        bs = self.block_size
+        spans = positions[:, [0, -1]].tolist()
+        write_slots = []
+        for seq_id, (first, last) in zip(seq_ids, spans):
+            table = self.block_tables[seq_id]
+            while len(table) <= last // bs:
+                table.append(self._new_block())
+            for i in range(first // bs, last // bs + 1):
+                if self.ref_counts[table[i]] > 1:
+                    block = self._new_block()
+                    self._copy_block(table[i], block)
+                    self._release_block(table[i])
+                    table[i] = block
+            self.seq_lens[seq_id] = max(self.seq_lens[seq_id], last + 1)
+            write_slots.extend(table[p // bs] * bs + p % bs for p in range(first, last + 1))
+
+        self.read_len = max(last for _, last in spans) + 1
+        num_read_blocks = self.blocks_for(self.read_len)
+        gather_table = [self.block_tables[s][:num_read_blocks] for s in seq_ids]
+        gather_table = [t + [0] * (num_read_blocks - len(t)) for t in gather_table]
+
+        self.seq_ids = list(seq_ids)
+        self.write_slots = torch.tensor(write_slots, dtype=torch.long, device=positions.device)
+        self.gather_table = torch.tensor(gather_table, dtype=torch.long, device=positions.device)
+
+    def unbind(self):
+        self.seq_ids = None
+        self.write_slots = None
+        self.gather_table = None
+
+    def update(self, layer_id: int, xk: torch.Tensor, xv: torch.Tensor):
+        pool_k, pool_v = self._pools(layer_id, like=xk)
+        bsz = xk.shape[0]
+        pool_k.view(-1, self.n_heads, self.head_dim)[self.write_slots] = xk.reshape(-1, self.n_heads, self.head_dim)
+        pool_v.view(-1, self.n_heads, self.head_dim)[self.write_slots] = xv.reshape(-1, self.n_heads, self.head_dim)
+
+        keys = pool_k[self.gather_table].view(bsz, -1, self.n_heads, self.head_dim)[:, :self.read_len]
+        values = pool_v[self.gather_table].view(bsz, -1, self.n_heads, self.head_dim)[:, :self.read_len]
+        return keys, values
@@ -9,20 +9,36 @@ import math
 from dataclasses import dataclass
 from typing import Any, Optional, Tuple
 
+from .kv_cache import PagedKVCache
+from .quantization import QUANT_TARGETS, quantize_
+
+try:
+    from torch.nn.attention.bias import causal_lower_right
+except ImportError:  # torch < 2.3
+    causal_lower_right = None
+
+# F.scaled_dot_product_attention(..., enable_gqa=True) broadcasts grouped keys/values, torch >= 2.5
+_SDPA_GQA = tuple(int(v) for v in torch.__version__.split(".")[:2]) >= (2, 5)
+
 
 @dataclass
 class ModelArgs:
     dim: int = 4096
     n_layers: int = 32
     n_heads: int = 32
-    n_kv_heads: Optional[int] = None
+    n_kv_heads: Optional[int] = None  # grouped-query attention: key/value heads shared by n_heads // n_kv_heads
     vocab_size: int = -1  # defined later by tokenizer
     multiple_of: int = 256  # make SwiGLU hidden layer size multiple of large power of 2
     ffn_dim_multiplier: Optional[float] = None
     norm_eps: float = 1e-5
+    rope_theta: float = 10000.0
 
     max_batch_size: int = 1
     max_seq_len: int = 2048
+    kv_block_size: int = 16  # tokens per KV cache block
+    kv_cache_blocks: Optional[int] = None  # KV cache budget in blocks, None: max_batch_size * max_seq_len tokens
+    kv_prefix_caching: bool = True  # share the K/V of common prompt prefixes (e.g. the instruction template)
+    attention_backend: str = "sdpa"  # key of ATTENTION_BACKENDS
 
     w_bias: bool = True  # use bias tuning
     w_lora: bool = True  # use lora tuning
@@ -47,33 +63,109 @@ class RMSNorm(torch.nn.Module):
         return output * self.weight
 
 
-def precompute_freqs_cis(dim: int, end: int, theta: float = 10000.0):
-    freqs = 1.0 / (theta ** (torch.arange(0, dim, 2)[: (dim // 2)].float() / dim))
-    t = torch.arange(end, device=freqs.device)  # type: ignore
-    freqs = torch.outer(t, freqs).float()  # type: ignore
-    freqs_cis = torch.polar(torch.ones_like(freqs), freqs)  # complex64
-    return freqs_cis
-
-
-def reshape_for_broadcast(freqs_cis: torch.Tensor, x: torch.Tensor):
-    ndim = x.ndim
-    assert 0 <= 1 < ndim
-    assert freqs_cis.shape == (x.shape[1], x.shape[-1])
-    shape = [d if i == 1 or i == ndim - 1 else 1 for i, d in enumerate(x.shape)]
-    return freqs_cis.view(*shape)
+class RotaryEmbedding:
+    """Rotary position embedding with tables built once per device and dtype.
+
+    q/k are rotated in place in their own dtype. For float32 the table holds complex64 rotations and q/k are
+    multiplied as complex numbers (torch's complex kernel beats the real-valued formulation there); for
+    fp16/bf16 activations it holds real cos/sin in that dtype, so nothing is cast to float32 and back. Calling
+    it with the start position of a forward pass (int, or [bsz] tensor for per-row KV cache offsets) gives
+    the RotaryPositions that the attention layers apply.
+    """
+
+    def __init__(self, head_dim: int, max_len: int, theta: float = 10000.0):
+        self.head_dim = head_dim
+        self.max_len = max_len
+        self.theta = theta
+        self._tables = {}
+
+    def tables(self, device, dtype):
+        key = (device, dtype)
+        if key not in self._tables:
+            freqs = 1.0 / (self.theta ** (torch.arange(0, self.head_dim, 2, device=device).float() / self.head_dim))
+            angles = torch.outer(torch.arange(self.max_len, device=device).float(), freqs)
+            if dtype == torch.float32:
+                self._tables[key] = torch.polar(torch.ones_like(angles), angles)
+            else:
+                # interleaved like the (x0, x1) pairs: cos(a) cos(a) .. and -sin(a) sin(a) ..
+                cos, sin = angles.cos(), angles.sin()
+                self._tables[key] = (cos.repeat_interleave(2, dim=-1).to(dtype),
+                                     torch.stack((-sin, sin), dim=-1).flatten(-2).to(dtype))
+        return self._tables[key]
+
+    def __call__(self, start_pos, seqlen: int, device):
+        return RotaryPositions(self, start_pos, seqlen, device)
+
+
+class RotaryPositions:
+    """Rotations of the positions start_pos .. start_pos + seqlen - 1, shaped to broadcast over
+    [bsz, seqlen, n_heads, head_dim // 2] (complex) or [bsz, seqlen, n_heads, head_dim] (real); looked up once
+    per forward pass and dtype."""
+
+    def __init__(self, rope: RotaryEmbedding, start_pos, seqlen: int, device):
+        self.rope = rope
+        self.start_pos = start_pos
+        self.seqlen = seqlen
+        self.device = device
+        self._freqs = {}
+
+    def _select(self, table):
+        if torch.is_tensor(self.start_pos):
+            positions = self.start_pos[:, None] + torch.arange(self.seqlen, device=self.device)
+            return table[positions][:, :, None]
+        return table[self.start_pos:self.start_pos + self.seqlen][None, :, None]
+
+    def freqs(self, dtype):
+        if dtype not in self._freqs:
+            table = self.rope.tables(self.device, dtype)
+            self._freqs[dtype] = self._select(table) if torch.is_tensor(table) else tuple(map(self._select, table))
+        return self._freqs[dtype]
+
+
+def _rotate(x: torch.Tensor, freqs):
+    # rotate the (x0, x1) pairs of the last dim, in place unless autograd needs x
+    inplace = not (torch.is_grad_enabled() and x.requires_grad)
+    if torch.is_tensor(freqs):
+        x_ = torch.view_as_complex(x.unflatten(-1, (-1, 2)))
+        if inplace:
+            x_.mul_(freqs)
+            return x
+        return torch.view_as_real(x_ * freqs).flatten(-2)
+    # (x0, x1) -> (x0 cos - x1 sin, x1 cos + x0 sin)
+    cos, sin = freqs
+    x0, x1 = x.unflatten(-1, (-1, 2)).unbind(-1)
+    swapped = torch.stack((x1, x0), dim=-1).flatten(-2).mul_(sin)
+    if not inplace:
+        return x * cos + swapped
+    return x.mul_(cos).add_(swapped)
 
 
 def apply_rotary_emb(
     xq: torch.Tensor,
     xk: torch.Tensor,
-    freqs_cis: torch.Tensor,
+    rope: RotaryPositions,
 ) -> Tuple[torch.Tensor, torch.Tensor]:
-    xq_ = torch.view_as_complex(xq.float().reshape(*xq.shape[:-1], -1, 2))
-    xk_ = torch.view_as_complex(xk.float().reshape(*xk.shape[:-1], -1, 2))
-    freqs_cis = reshape_for_broadcast(freqs_cis, xq_)
-    xq_out = torch.view_as_real(xq_ * freqs_cis).flatten(3)
-    xk_out = torch.view_as_real(xk_ * freqs_cis).flatten(3)
-    return xq_out.type_as(xq), xk_out.type_as(xk)
+    freqs = rope.freqs(xq.dtype)
+    return _rotate(xq, freqs), _rotate(xk, freqs)
+
+
+class CausalMask:
+    """Causal mask of seqlen queries at positions start_pos .. start_pos + seqlen - 1 over the keys of positions
+    0 .. start_pos + seqlen - 1 (cached keys are visible to every query). It is not materialised unless a
+    backend needs it: sdpa_attention turns it into is_causal or a lower-right causal bias, reference_attention
+    uses dense(), which is built once per forward pass."""
+
+    def __init__(self, start_pos: int, seqlen: int):
+        self.start_pos = start_pos
+        self.seqlen = seqlen
+        self._dense = {}
+
+    def dense(self, device):
+        if device not in self._dense:
+            mask = torch.full((self.seqlen, self.seqlen), float("-inf"), device=device)
+            mask = torch.triu(mask, diagonal=1)
+            self._dense[device] = torch.hstack([torch.zeros((self.seqlen, self.start_pos), device=device), mask])
+        return self._dense[device]
 
 
 def repeat_kv(x: torch.Tensor, n_rep: int) -> torch.Tensor:
@@ -88,13 +180,123 @@ def repeat_kv(x: torch.Tensor, n_rep: int) -> torch.Tensor:
     )
 
 
-class Attention(nn.Module):
+def _repeat_heads(x, n_heads):
+    # (bsz, n_kv_heads, len, head_dim) -> (bsz, n_heads, len, head_dim), query head h reads key/value head
+    # h // (n_heads // n_kv_heads)
+    return repeat_kv(x.transpose(1, 2), n_heads // x.shape[1]).transpose(1, 2)
+
+
+def reference_attention(xq, keys, values, mask=None):
+    """Explicit scores, additive dense mask and float32 softmax. xq: (bsz, n_heads, seqlen, head_dim),
+    keys/values: (bsz, n_kv_heads, kv_len, head_dim) with n_kv_heads dividing n_heads, mask: None, CausalMask
+    or an additive tensor."""
+    if keys.shape[1] != xq.shape[1]:
+        keys, values = _repeat_heads(keys, xq.shape[1]), _repeat_heads(values, xq.shape[1])
+    scores = torch.matmul(xq, keys.transpose(2, 3)) / math.sqrt(xq.shape[-1])
+    if isinstance(mask, CausalMask):
+        mask = mask.dense(xq.device)
+    if mask is not None:
+        scores = scores + mask  # (bs, n_local_heads, slen, cache_len + slen)
+    scores = F.softmax(scores.float(), dim=-1).type_as(xq)
+    return torch.matmul(scores, values)  # (bs, n_local_heads, slen, head_dim)
+
+
+def sdpa_attention(xq, keys, values, mask=None):
+    """Same as reference_attention through F.scaled_dot_product_attention (flash / memory efficient kernels
+    where available); causal masks are never materialised except for offset prefill on torch < 2.3. Grouped
+    keys/values are broadcast by the kernel (torch >= 2.5) or repeated."""
+    is_causal = False
+    if isinstance(mask, CausalMask):
+        assert keys.shape[2] == mask.start_pos + mask.seqlen, (keys.shape, mask.start_pos, mask.seqlen)
+        if mask.start_pos == 0:
+            is_causal, mask = True, None
+        elif causal_lower_right is not None:
+            mask = causal_lower_right(mask.seqlen, keys.shape[2])
+        else:
+            mask = mask.dense(xq.device).to(xq.dtype)
+    elif mask is not None:
+        mask = mask.to(xq.dtype)
+    if keys.shape[1] == xq.shape[1]:
+        return F.scaled_dot_product_attention(xq, keys, values, attn_mask=mask, is_causal=is_causal)
+    if _SDPA_GQA:
+        return F.scaled_dot_product_attention(xq, keys, values, attn_mask=mask, is_causal=is_causal,
+                                              enable_gqa=True)
+    keys, values = _repeat_heads(keys, xq.shape[1]), _repeat_heads(values, xq.shape[1])
+    return F.scaled_dot_product_attention(xq, keys, values, attn_mask=mask, is_causal=is_causal)
+
+
+ATTENTION_BACKENDS = {
+    "reference": reference_attention,
+    "sdpa": sdpa_attention,
+}
+
+
+def _lora_delta(module, name):
+    # l2(l1(x)) == x @ (l2.weight @ l1.weight).T
+    l1, l2 = getattr(module, f"lora_{name}_l1"), getattr(module, f"lora_{name}_l2")
+    return l2.weight.float() @ l1.weight.float()
+
+
+@torch.no_grad()
+def _fold_lora(module, sign):
+    for name in module.lora_targets:
+        weight = getattr(module, name).weight
+        weight.copy_((weight.float() + sign * _lora_delta(module, name)).to(weight.dtype))
+
+
+def _unmerged_lora_state_dict(module, state_dict, prefix, local_metadata):
+    # checkpoints always hold the weights without the LoRA deltas folded in
+    if module.lora_merged:
+        for name in module.lora_targets:
+            key = f"{prefix}{name}.weight"
+            if key in state_dict:
+                weight = state_dict[key]
+                state_dict[key] = (weight.detach().float() - _lora_delta(module, name)).to(weight.dtype)
+
+
+def _unmerge_lora_before_load(module, *args, **kwargs):
+    # loaded weights are unmerged, drop the folded deltas first so the module state stays consistent
+    if module.lora_merged:
+        module.unmerge_lora()
+
+
+class LoRAMergeable:
+    """merge_lora() folds the LoRA branches of lora_targets into the frozen weights (W + l2.weight @ l1.weight)
+    so that inference runs one GEMM per projection; unmerge_lora() subtracts them again for training. In float16
+    a merge/unmerge round trip may move weights by one ulp. state_dict() always returns unmerged weights."""
+
+    lora_targets = ()
+
+    def _init_lora_merge(self):
+        self.lora_merged = False
+        if self.w_lora:
+            self._register_state_dict_hook(_unmerged_lora_state_dict)
+            self._register_load_state_dict_pre_hook(_unmerge_lora_before_load, with_module=True)
+
+    def merge_lora(self):
+        if self.w_lora and not self.lora_merged:
+            assert all(isinstance(getattr(self, name), Linear) for name in self.lora_targets), \
+                "LoRA branches cannot be merged into quantised weights, they stay separate"
+            _fold_lora(self, 1.0)
+            self.lora_merged = True
+
+    def unmerge_lora(self):
+        if self.lora_merged:
+            _fold_lora(self, -1.0)
+            self.lora_merged = False
+
+
+class Attention(LoRAMergeable, nn.Module):
+    lora_targets = ("wq", "wk", "wv", "wo")
+
     def __init__(self, args: ModelArgs):
         super().__init__()
         self.args = args
 
         self.n_local_heads = args.n_heads
-        self.n_kv_heads = args.n_kv_heads
+        self.n_kv_heads = args.n_heads if args.n_kv_heads is None else args.n_kv_heads
+        assert args.n_heads % self.n_kv_heads == 0, f"n_heads {args.n_heads} is not a multiple of n_kv_heads"
+        self.n_rep = args.n_heads // self.n_kv_heads
         self.head_dim = args.dim // args.n_heads
 
         self.wq = Linear(
@@ -104,12 +306,12 @@ class Attention(nn.Module):
         )
         self.wk = Linear(
             args.dim,
-            args.n_heads * self.head_dim,
+            self.n_kv_heads * self.head_dim,
             bias=False
         )
         self.wv = Linear(
             args.dim,
-            args.n_heads * self.head_dim,
+            self.n_kv_heads * self.head_dim,
             bias=False
         )
         self.wo = Linear(
@@ -118,114 +320,118 @@ class Attention(nn.Module):
             bias=args.w_bias
         )
 
-        if args.w_bias:
-            nn.init.constant_(self.wq.bias.data, 0)
-            nn.init.constant_(self.wo.bias.data, 0)
-
         self.w_lora = args.w_lora
         if args.w_lora:
             self.lora_wq_l1 = Linear(args.dim, args.lora_rank, bias=False)
             self.lora_wq_l2 = Linear(args.lora_rank, args.dim, bias=False)
 
             self.lora_wk_l1 = Linear(args.dim, args.lora_rank, bias=False)
-            self.lora_wk_l2 = Linear(args.lora_rank, args.dim, bias=False)
+            self.lora_wk_l2 = Linear(args.lora_rank, self.n_kv_heads * self.head_dim, bias=False)
 
             self.lora_wv_l1 = Linear(args.dim, args.lora_rank, bias=False)
-            self.lora_wv_l2 = Linear(args.lora_rank, args.dim, bias=False)
+            self.lora_wv_l2 = Linear(args.lora_rank, self.n_kv_heads * self.head_dim, bias=False)
 
             self.lora_wo_l1 = Linear(args.dim, args.lora_rank, bias=False)
             self.lora_wo_l2 = Linear(args.lora_rank, args.dim, bias=False)
-            nn.init.constant_(self.lora_wq_l2.weight.data, 0)
-            nn.init.constant_(self.lora_wk_l2.weight.data, 0)
-            nn.init.constant_(self.lora_wv_l2.weight.data, 0)
-            nn.init.constant_(self.lora_wo_l2.weight.data, 0)
 
-        self.cache_k = None
-        self.cache_v = None
+        # shared llama.kv_cache.PagedKVCache of the Transformer, used while it is bound to a batch
+        self.kv_cache = None
+        self.layer_id = None
 
         self.gate = torch.nn.Parameter(torch.zeros(1, self.n_local_heads, 1, 1))
-
-    def train(self, mode: bool = True):
-        if mode:
-            self.cache_k = None
-            self.cache_v = None
-        else:
-            self.cache_k = torch.zeros(
-                (self.args.max_batch_size, self.args.max_seq_len, self.n_local_heads, self.head_dim)
-            ).cuda()
-            self.cache_v = torch.zeros(
-                (self.args.max_batch_size, self.args.max_seq_len, self.n_local_heads, self.head_dim)
-            ).cuda()
-        return super().train(mode)
-
-    def forward(self, x: torch.Tensor, start_pos: int, freqs_cis: torch.Tensor, mask: Optional[torch.Tensor],
+        self.attention_backend = args.attention_backend
+        self.reset_adapter_parameters(reset_lora=False)
+        self._init_lora_merge()
+
+    def reset_adapter_parameters(self, reset_lora=True):
+        # the parameters the pretrained checkpoints do not have: biases, LoRA up projections and the gate start
+        # at zero, LoRA down projections with the default nn.Linear init
+        if self.args.w_bias:
+            nn.init.constant_(self.wq.bias.data, 0)
+            nn.init.constant_(self.wo.bias.data, 0)
+        if self.w_lora:
+            for name in self.lora_targets:
+                if reset_lora:
+                    getattr(self, f"lora_{name}_l1").reset_parameters()
+                nn.init.constant_(getattr(self, f"lora_{name}_l2").weight.data, 0)
+        nn.init.constant_(self.gate.data, 0)
+
+    def project_adapter(self, adapter: torch.Tensor):
+        """Keys/values of an adapter prompt, either per row (bsz, len, dim) or shared by the batch (1, len, dim).
+
+        A single-token adapter has no keys: its softmax is 1, so the gated values are returned right away.
+        forward() accepts the result in place of the adapter, which lets generation project a request's
+        adapters once instead of at every decode step.
+
+        Adapters are projected without LoRA, so merged LoRA deltas are taken out again here.
+        """
+        adapter_bsz, adapter_len = adapter.shape[:2]
+        adapter_v = self.wv(adapter)
+        if self.lora_merged:
+            adapter_v = adapter_v - self.lora_wv_l2(self.lora_wv_l1(adapter))
+        adapter_v = adapter_v.view(adapter_bsz, adapter_len, self.n_kv_heads, self.head_dim)
+        if adapter_len == 1:
+            return None, self.gate.tanh() * repeat_kv(adapter_v, self.n_rep).transpose(1, 2)
+        adapter_v = adapter_v.transpose(1, 2)
+
+        adapter_k = self.wk(adapter)
+        if self.lora_merged:
+            adapter_k = adapter_k - self.lora_wk_l2(self.lora_wk_l1(adapter))
+        adapter_k = adapter_k.view(adapter_bsz, adapter_len, self.n_kv_heads, self.head_dim)
+        adapter_k = adapter_k.transpose(1, 2)
+        return adapter_k, adapter_v
+
+    def forward(self, x: torch.Tensor, start_pos: int, rope: RotaryPositions, mask: Optional[torch.Tensor],
                 adapter=None):
         bsz, seqlen, _ = x.shape
         xq, xk, xv = self.wq(x), self.wk(x), self.wv(x)
-        if self.w_lora:
+        if self.w_lora and not self.lora_merged:
             xq = xq + self.lora_wq_l2(self.lora_wq_l1(x))
             xk = xk + self.lora_wk_l2(self.lora_wk_l1(x))
             xv = xv + self.lora_wv_l2(self.lora_wv_l1(x))
 
         xq = xq.view(bsz, seqlen, self.n_local_heads, self.head_dim)
-        xk = xk.view(bsz, seqlen, self.n_local_heads, self.head_dim)
-        xv = xv.view(bsz, seqlen, self.n_local_heads, self.head_dim)
-
-        xq, xk = apply_rotary_emb(xq, xk, freqs_cis=freqs_cis)
-
-        if not self.training:
-            self.cache_k = self.cache_k.to(xq)
-            self.cache_v = self.cache_v.to(xq)
+        xk = xk.view(bsz, seqlen, self.n_kv_heads, self.head_dim)
+        xv = xv.view(bsz, seqlen, self.n_kv_heads, self.head_dim)
 
-            self.cache_k[:bsz, start_pos: start_pos + seqlen] = xk
-            self.cache_v[:bsz, start_pos: start_pos + seqlen] = xv
+        xq, xk = apply_rotary_emb(xq, xk, rope)
 
-            keys = self.cache_k[:bsz, : start_pos + seqlen]
-            values = self.cache_v[:bsz, : start_pos + seqlen]
+        if not self.training and self.kv_cache is not None and self.kv_cache.bound:
+            keys, values = self.kv_cache.update(self.layer_id, xk, xv)
         else:
             assert start_pos == 0
             keys = xk
             values = xv
 
-        if adapter is not None:
-            adapter_len = adapter.shape[1]
-            adapter_v = self.wv(adapter).view(bsz, adapter_len, self.n_local_heads, self.head_dim)
-            adapter_v = adapter_v.transpose(1, 2)
-
-            if adapter_len > 1:
-                adapter_k = self.wk(adapter).view(bsz, adapter_len, self.n_local_heads, self.head_dim)
-                adapter_k = adapter_k.transpose(1, 2)
+        if adapter is not None and torch.is_tensor(adapter):
+            adapter = self.project_adapter(adapter)
 
+        attention = ATTENTION_BACKENDS[self.attention_backend]
         xq = xq.transpose(1, 2)
-        keys = keys.transpose(1, 2)
-        values = values.transpose(1, 2)
-        scores = torch.matmul(xq, keys.transpose(2, 3)) / math.sqrt(self.head_dim)
-
-        if mask is not None:
-            scores = scores + mask  # (bs, n_local_heads, slen, cache_len + slen)
-
-        scores = F.softmax(scores.float(), dim=-1).type_as(xq)
-        output = torch.matmul(scores, values)  # (bs, n_local_heads, slen, head_dim)
+        output = attention(xq, keys.transpose(1, 2), values.transpose(1, 2), mask)
 
+        # the adapter prompt is attended separately (no mask) and added with its gate
         if adapter is not None:
-            if adapter_len > 1:
-                adapter_scores = torch.matmul(xq, adapter_k.transpose(2, 3)) / math.sqrt(self.head_dim)
-                adapter_scores = self.gate.tanh() * F.softmax(adapter_scores.float(), dim=-1).type_as(xq)
-                output = output + torch.matmul(adapter_scores, adapter_v)
+            adapter_k, adapter_v = adapter
+            if adapter_k is not None:
+                adapter_k, adapter_v = adapter_k.expand(bsz, -1, -1, -1), adapter_v.expand(bsz, -1, -1, -1)
+                output = torch.addcmul(output, self.gate.tanh(), attention(xq, adapter_k, adapter_v))
             else:
-                output = output + self.gate.tanh() * adapter_v
+                output = output + adapter_v
 
         output = output.transpose(
             1, 2
         ).contiguous().view(bsz, seqlen, -1)
 
-        if self.w_lora:
+        if self.w_lora and not self.lora_merged:
             return self.wo(output) + self.lora_wo_l2(self.lora_wo_l1(output))
         else:
             return self.wo(output)
 
 
-class FeedForward(nn.Module):
+class FeedForward(LoRAMergeable, nn.Module):
+    lora_targets = ("w1", "w2", "w3")
+
     def __init__(
             self,
             dim: int,
@@ -249,11 +455,8 @@ class FeedForward(nn.Module):
         self.w3 = Linear(
             dim, hidden_dim, bias=args.w_bias
         )
-        if args.w_bias:
-            nn.init.constant_(self.w1.bias.data, 0)
-            nn.init.constant_(self.w2.bias.data, 0)
-            nn.init.constant_(self.w3.bias.data, 0)
 
+        self.w_bias = args.w_bias
         self.w_lora = args.w_lora
         if args.w_lora:
             self.lora_w1_l1 = Linear(dim, args.lora_rank, bias=False)
@@ -262,12 +465,23 @@ class FeedForward(nn.Module):
             self.lora_w2_l2 = Linear(args.lora_rank, dim, bias=False)
             self.lora_w3_l1 = Linear(dim, args.lora_rank, bias=False)
             self.lora_w3_l2 = Linear(args.lora_rank, hidden_dim, bias=False)
-            nn.init.constant_(self.lora_w1_l2.weight.data, 0)
-            nn.init.constant_(self.lora_w2_l2.weight.data, 0)
-            nn.init.constant_(self.lora_w3_l2.weight.data, 0)
+        self.reset_adapter_parameters(reset_lora=False)
+        self._init_lora_merge()
 
-    def forward(self, x):
+    def reset_adapter_parameters(self, reset_lora=True):
+        # see Attention.reset_adapter_parameters()
+        if self.w_bias:
+            nn.init.constant_(self.w1.bias.data, 0)
+            nn.init.constant_(self.w2.bias.data, 0)
+            nn.init.constant_(self.w3.bias.data, 0)
         if self.w_lora:
+            for name in self.lora_targets:
+                if reset_lora:
+                    getattr(self, f"lora_{name}_l1").reset_parameters()
+                nn.init.constant_(getattr(self, f"lora_{name}_l2").weight.data, 0)
+
+    def forward(self, x):
+        if self.w_lora and not self.lora_merged:
             out = F.silu(self.w1(x) + self.lora_w1_l2(self.lora_w1_l1(x))) * (
                         self.w3(x) + self.lora_w3_l2(self.lora_w3_l1(x)))
             return self.w2(out) + self.lora_w2_l2(self.lora_w2_l1(out))
@@ -290,9 +504,9 @@ class TransformerBlock(nn.Module):
         self.attention_norm = RMSNorm(args.dim, eps=args.norm_eps)
         self.ffn_norm = RMSNorm(args.dim, eps=args.norm_eps)
 
-    def forward(self, x: torch.Tensor, start_pos: int, freqs_cis: torch.Tensor, mask: Optional[torch.Tensor],
+    def forward(self, x: torch.Tensor, start_pos: int, rope: RotaryPositions, mask: Optional[torch.Tensor],
                 prompt=None):
-        h = x + self.attention.forward(self.attention_norm(x), start_pos, freqs_cis, mask, prompt)
+        h = x + self.attention.forward(self.attention_norm(x), start_pos, rope, mask, prompt)
         out = h + self.feed_forward.forward(self.ffn_norm(h))
         return out
 
@@ -316,24 +530,99 @@ class Transformer(nn.Module):
             params.dim, params.vocab_size, bias=False
         )
 
-        self.freqs_cis = precompute_freqs_cis(
-            self.params.dim // self.params.n_heads, self.params.max_seq_len * 2
-        )
+        self.rope = RotaryEmbedding(self.params.dim // self.params.n_heads, self.params.max_seq_len * 2,
+                                    self.params.rope_theta)
+
+        # blocks are only materialised when tokens are written, so building the cache costs no memory
+        max_blocks = params.kv_cache_blocks
+        if max_blocks is None:
+            max_blocks = params.max_batch_size * math.ceil(params.max_seq_len / params.kv_block_size)
+        n_kv_heads = params.n_heads if params.n_kv_heads is None else params.n_kv_heads
+        self.attach_kv_cache(PagedKVCache(params.n_layers, n_kv_heads, params.dim // params.n_heads,
+                                          block_size=params.kv_block_size, max_blocks=max_blocks,
+                                          prefix_caching=params.kv_prefix_caching))
+        self._seq_ids = []
+
+    def materialize_(self, device, dtype):
+        """Allocate the parameters of a Transformer built on the meta device (with torch.device("meta"): ...)
+        on device in dtype, without a temporary float32 copy or a random init of the pretrained weights. Norms
+        and the bias/LoRA/gate parameters get their usual init; the pretrained weights are left uninitialised
+        for llama.checkpoint.load_llama_checkpoint() or a MuMu-LLaMA checkpoint to fill."""
+        self.to(dtype)  # still meta, nothing is allocated
+        self.to_empty(device=device)
+        with torch.no_grad():
+            for module in self.modules():
+                if isinstance(module, RMSNorm):
+                    nn.init.ones_(module.weight)
+                elif isinstance(module, (Attention, FeedForward)):
+                    module.reset_adapter_parameters()
+        return self
+
+    def train(self, mode: bool = True):
+        # cached prefixes were computed with the current weights
+        self.kv_cache.clear_prefix_cache()
+        if mode:
+            self.unmerge_lora()
+        return super().train(mode)
+
+    def merge_lora(self):
+        """Fold the LoRA branches into wq/wk/wv/wo/w1/w2/w3 for serving, see LoRAMergeable."""
+        self.kv_cache.clear_prefix_cache()
+        for layer in self.layers:
+            layer.attention.merge_lora()
+            layer.feed_forward.merge_lora()
+
+    def unmerge_lora(self):
+        self.kv_cache.clear_prefix_cache()
+        for layer in self.layers:
+            layer.attention.unmerge_lora()
+            layer.feed_forward.unmerge_lora()
+
+    def quantize(self, bits=8, group_size=128, targets=QUANT_TARGETS, compute_dtype=None, empty=False):
+        """Weight-only int8 (per channel) / int4 (group-wise) quantisation of wq/wk/wv/wo/w1/w2/w3/output for
+        inference, see llama.quantization. LoRA is unmerged first and its branches stay in the weight dtype."""
+        self.kv_cache.clear_prefix_cache()
+        self.unmerge_lora()
+        quantize_(self, bits, group_size, targets, compute_dtype, empty)
+
+    def set_attention_backend(self, name: str):
+        assert name in ATTENTION_BACKENDS, f"Unknown attention backend {name}, one of {list(ATTENTION_BACKENDS)}"
+        self.params.attention_backend = name
+        for layer in self.layers:
+            layer.attention.attention_backend = name
+
+    def attach_kv_cache(self, kv_cache):
+        self.kv_cache = kv_cache
+        for layer_id, layer in enumerate(self.layers):
+            layer.attention.kv_cache = kv_cache
+            layer.attention.layer_id = layer_id
 
     @torch.inference_mode()
-    def forward(self, tokens: torch.Tensor, start_pos: int):
+    def forward(self, tokens: torch.Tensor, start_pos: int, seq_ids=None):
+        # seq_ids: self.kv_cache sequences of the rows, by default the rows continue the batch of the last call
+        _bsz, seqlen = tokens.shape
+        if seq_ids is None:
+            if start_pos == 0 or len(self._seq_ids) != _bsz:
+                # a new batch: row i of every following call continues sequence self._seq_ids[i]
+                for seq_id in self._seq_ids:
+                    self.kv_cache.free(seq_id)
+                self._seq_ids = [self.kv_cache.allocate(self.params.max_seq_len) for _ in range(_bsz)]
+            seq_ids = self._seq_ids
+        positions = start_pos + torch.arange(seqlen, device=tokens.device).expand(_bsz, seqlen)
+        self.kv_cache.bind(seq_ids, positions)
+        try:
+            return self._forward(tokens, start_pos)
+        finally:
+            self.kv_cache.unbind()
+
+    def _forward(self, tokens: torch.Tensor, start_pos: int):
         _bsz, seqlen = tokens.shape
         h = self.tok_embeddings(tokens)
-        self.freqs_cis = self.freqs_cis.to(h.device)
-        freqs_cis = self.freqs_cis[start_pos: start_pos + seqlen]
-
-        mask = None
-        if seqlen > 1:
-            mask = torch.full((1, 1, seqlen, seqlen), float("-inf"), device=tokens.device)
-            mask = torch.triu(mask, diagonal=start_pos + 1).type_as(h)
+        rope = self.rope(start_pos, seqlen, h.device)
 
+        mask = CausalMask(start_pos, seqlen) if seqlen > 1 else None
         for layer in self.layers:
-            h = layer(h, start_pos, freqs_cis, mask)
+            h = layer(h, start_pos, rope, mask)
         h = self.norm(h)
         output = self.output(h)  # only compute last logits
         return output.float()
@@ -1,5 +1,7 @@
 import json
+import math
 import os
+import time
 from pathlib import Path
 import numpy as np
 
@@ -7,12 +9,20 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from .llama import Transformer, ModelArgs, RMSNorm
+from .llama import Transformer, ModelArgs, RMSNorm, CausalMask
 from .projector import ProjectionLayer
-from util.misc import download
-from .utils import sample_top_p
+from .checkpoint import load_llama_checkpoint, llama_manifest, verify_llama_manifest
+from .components import ComponentRegistry
+from .feature_cache import FeatureCache
+from .image_processing import preprocess_images, preprocess_videos
+from .quantization import QUANT_TARGETS
+from .utils import sampling_probs
+from .sampling import sample
+from .retrieval import load_knn_indexes
+from .scheduler import Scheduler
+from .stopping import DEFAULT_STOP_STRINGS, get_stop_matcher
 from .musicgen.musicgen import MusicgenForConditionalGeneration
-from .audioldm2 import AudioLDM2Pipeline
+from .audioldm2 import AudioLDM2Pipeline, apply_profile, get_profile
 
 from transformers import LlamaTokenizer
 from transformers import Wav2Vec2FeatureExtractor, AutoModel
@@ -22,6 +32,38 @@ from transformers import AutoProcessor
 
 import torchaudio
 
+# state dict prefixes of the lazily loaded, frozen components
+FROZEN_COMPONENTS = ("mert_model.", "vit_model.", "vivit_model.", "generation_model.")
+ADAPTER_FORMAT = "mumu-adapter"
+# arguments naming the frozen pretrained components, recorded in the base manifest of adapter checkpoints
+BASE_COMPONENT_ARGS = ("mert_path", "vit_path", "vivit_path", "music_decoder", "music_decoder_path")
+
+
+def is_trainable(name, stage=1):
+    """Whether the parameter name (of MuMu_LLaMA.named_parameters()) is trained in stage."""
+    if stage not in (1, 2, 3):
+        return False
+    if "llama." in name and ('norm' in name or 'bias' in name or 'lora' in name):
+        return True
+    if "prefix_query" in name or "tok_embeddings" in name:
+        return True
+    if stage == 1:
+        return "mu_mert_" in name or "iu_vivit_" in name or "iu_vit_" in name
+    if stage == 2:
+        return "output_projector" in name
+    return False
+
+
+def base_parameter_names(names, stage=1):
+    """The names (of MuMu_LLaMA.state_dict()) that are pretrained LLaMA weights frozen in stage, i.e. the
+    parameters an adapter checkpoint leaves to the base checkpoint."""
+    return {name for name in names if name.startswith("llama.") and not is_trainable(name, stage)
+            and "gate" not in name and "lora" not in name and "bias" not in name}
+
+
+def is_adapter_checkpoint(checkpoint):
+    return checkpoint.get("format") == ADAPTER_FORMAT
+
 
 class MuMu_LLaMA(nn.Module):
     """ Masked Autoencoder with VisionTransformer backbone
@@ -38,13 +80,19 @@ class MuMu_LLaMA(nn.Module):
         else:
             self.device = device
 
+        # The pretrained encoders and the music decoder are frozen and loaded the first time they are used
+        # (self.mert_model etc.), components named in --disable_components are never loaded
+        disabled = set(getattr(self.args, "disable_components", None) or [])
+        self.components = ComponentRegistry()
+
         # 1. MERT Encoder
         # The model files for MERT can be downloaded here in case of network issues:
         # https://huggingface.co/m-a-p/MERT-v1-330M
         # And set the mert_path argument to directory with the model files
-        print(f'Initialize MERT...')
-        self.mert_model = AutoModel.from_pretrained(self.args.mert_path, trust_remote_code=True)  # .to(self.device)
-        self.mert_processor = Wav2Vec2FeatureExtractor.from_pretrained(self.args.mert_path, trust_remote_code=True)
+        self.components.register("mert", lambda: self._frozen(
+            AutoModel.from_pretrained(self.args.mert_path, trust_remote_code=True)), enabled="mert" not in disabled)
+        self.components.register("mert_processor", lambda: Wav2Vec2FeatureExtractor.from_pretrained(
+            self.args.mert_path, trust_remote_code=True), enabled="mert" not in disabled)
         self.mu_mert_agg = nn.Conv1d(in_channels=25, out_channels=1, kernel_size=1)
         self.mu_mert_rnn = nn.RNN(1024, 1024, batch_first=True)
         self.mu_mert_attention = nn.Linear(1024, 1)
@@ -74,16 +122,15 @@ class MuMu_LLaMA(nn.Module):
         self.mu_mert_f1_3 = nn.Linear(4096, 4096 * self.feature_scaler, bias=bridge_bias)
         self.mu_mert_f2_3 = nn.Linear(4096 * self.feature_scaler, 4096, bias=bridge_bias)
         self.mu_mert_f3_3 = nn.Linear(4096, 4096 * self.feature_scaler, bias=bridge_bias)
-        print(f'MERT initialized...')
 
         # 2. ViT Encoder
         # The model files for ViT can be downloaded here in case of network issues:
         # https://huggingface.co/google/vit-base-patch16-224-in21k
         # And set the vit_path argument to directory with the model files
-        print(f'Initialize ViT...')
-        self.vit_model = ViTModel.from_pretrained(self.args.vit_path)  # .to(self.device)
-        self.vit_model.eval()
-        self.vit_processor = ViTImageProcessor.from_pretrained(self.args.vit_path, do_rescale=False)
+        self.components.register("vit", lambda: self._frozen(ViTModel.from_pretrained(self.args.vit_path)),
+                                 enabled="vit" not in disabled)
+        self.components.register("vit_processor", lambda: ViTImageProcessor.from_pretrained(
+            self.args.vit_path, do_rescale=False), enabled="vit" not in disabled)
         self.iu_vit_agg = nn.Conv1d(in_channels=197, out_channels=1, kernel_size=1)
         self.iu_vit_proj = nn.Linear(768, 4096)
 
@@ -101,16 +148,15 @@ class MuMu_LLaMA(nn.Module):
         self.iu_vit_f1_3 = nn.Linear(4096, 4096 * self.feature_scaler, bias=bridge_bias)
         self.iu_vit_f2_3 = nn.Linear(4096 * self.feature_scaler, 4096, bias=bridge_bias)
         self.iu_vit_f3_3 = nn.Linear(4096, 4096 * self.feature_scaler, bias=bridge_bias)
-        print(f'ViT initialized...')
 
         # 3. ViViT Encoder
         # The model files for ViViT can be downloaded here in case of network issues:
         # https://huggingface.co/google/vivit-b-16x2-kinetics400
         # And set the vivit_path argument to directory with the model files
-        print(f'Initialize ViViT...')
-        self.vivit_model = VivitModel.from_pretrained(self.args.vivit_path)  # .to(self.device)
-        self.vivit_model.eval()
-        self.vivit_processor = VivitImageProcessor.from_pretrained(self.args.vivit_path)
+        self.components.register("vivit", lambda: self._frozen(VivitModel.from_pretrained(self.args.vivit_path)),
+                                 enabled="vivit" not in disabled)
+        self.components.register("vivit_processor", lambda: VivitImageProcessor.from_pretrained(
+            self.args.vivit_path), enabled="vivit" not in disabled)
         self.iu_vivit_agg = nn.Conv1d(in_channels=3137, out_channels=1, kernel_size=1)
         self.iu_vivit_rnn = nn.RNN(1024, 1024, batch_first=True)
         self.iu_vivit_attention = nn.Linear(1024, 1)
@@ -131,21 +177,36 @@ class MuMu_LLaMA(nn.Module):
         self.iu_vivit_f1_3 = nn.Linear(4096, 4096 * self.feature_scaler, bias=bridge_bias)
         self.iu_vivit_f2_3 = nn.Linear(4096 * self.feature_scaler, 4096, bias=bridge_bias)
         self.iu_vivit_f3_3 = nn.Linear(4096, 4096 * self.feature_scaler, bias=bridge_bias)
-        print(f'ViViT initialized...')
+
+        # aggregated encoder features of recent inputs, see _cached_features()
+        self._encoder_ids = {}
+        if getattr(self.args, "no_feature_cache", False):
+            self.feature_cache = None
+        else:
+            self.feature_cache = FeatureCache(
+                max_memory_bytes=getattr(self.args, "feature_cache_memory_mb", 256) * 2 ** 20,
+                cache_dir=getattr(self.args, "feature_cache_dir", None),
+                max_disk_bytes=getattr(self.args, "feature_cache_disk_mb", 4096) * 2 ** 20)
 
         # 4. llama
+        self.llama_ckpt_dir = llama_ckpt_dir
         with open(os.path.join(llama_ckpt_dir, "params.json"), "r") as f:
             params = json.loads(f.read())
         bias_lora = True
+        max_batch_size = getattr(self.args, "max_batch_size", 1)
+        kv_cache_blocks = getattr(self.args, "kv_cache_blocks", None)
+        attention_backend = getattr(self.args, "attention_backend", "sdpa")
 
         if self.args.music_decoder.lower() == "audioldm2":
             self.model_args: ModelArgs = ModelArgs(
-                max_seq_len=1024, max_batch_size=1, w_bias=bias_lora, w_lora=bias_lora,
+                max_seq_len=1024, max_batch_size=max_batch_size, kv_cache_blocks=kv_cache_blocks,
+                attention_backend=attention_backend, w_bias=bias_lora, w_lora=bias_lora,
                 num_output_tokens=1, output_dim_tokens=137216,
                 **params)  # max_batch_size only affects inference
         else:
             self.model_args: ModelArgs = ModelArgs(
-                max_seq_len=1024, max_batch_size=1, w_bias=bias_lora, w_lora=bias_lora,
+                max_seq_len=1024, max_batch_size=max_batch_size, kv_cache_blocks=kv_cache_blocks,
+                attention_backend=attention_backend, w_bias=bias_lora, w_lora=bias_lora,
                 num_output_tokens=128, output_dim_tokens=768,
                 **params)  # max_batch_size only affects inference
         print(f"model args: {self.model_args}")
@@ -156,59 +217,19 @@ class MuMu_LLaMA(nn.Module):
         self._add_audio_token()
         self.model_args.vocab_size = len(self.tokenizer)
 
-        if torch.cuda.is_available():
-            torch.set_default_tensor_type(torch.cuda.HalfTensor)
-        self.llama = Transformer(self.model_args)
-        torch.set_default_tensor_type(torch.FloatTensor)
+        llama_start = time.perf_counter()
+        # built on the meta device and allocated once, in the final device and dtype, then filled from the
+        # memory-mapped shards (without load_llama, the MuMu-LLaMA checkpoint loaded next fills the weights)
+        llama_device, llama_dtype = ("cuda", torch.float16) if torch.cuda.is_available() else ("cpu", torch.float32)
+        with torch.device("meta"):
+            self.llama = Transformer(self.model_args)
+        self.llama.materialize_(llama_device, llama_dtype)
 
         if load_llama:
             print(f"Loading LLaMA Checkpoint...")
-            ckpts = sorted(Path(llama_ckpt_dir).glob("*.pth"))
-
-            """
-            Adapted from https://github.com/cedrickchee/llama/blob/main/chattyllama/combined/inference.py
-            """
-            key_to_dim = {
-                "w1": 0,
-                "w2": -1,
-                "w3": 0,
-                "wo": -1,
-                "wq": 0,
-                "wk": 0,
-                "wv": 0,
-                "output": 0,
-                "tok_embeddings": 2,
-                "ffn_norm": None,
-                "attention_norm": None,
-                "norm": None,
-                "rope": None,
-            }
-            for i, ckpt in enumerate(ckpts):
-                checkpoint = torch.load(ckpt, map_location="cpu")
-                for parameter_name, parameter in self.llama.named_parameters():
-                    short_name = parameter_name.split(".")[-2]
-                    if "gate" in parameter_name or "lora" in parameter_name or "bias" in parameter_name:
-                        continue
-                    if key_to_dim[short_name] is None and i == 0:
-                        parameter.data = checkpoint[parameter_name]
-                    elif key_to_dim[short_name] == 0:
-                        size = checkpoint[parameter_name].size(0)
-                        parameter.data[size * i: size * (i + 1), :] = checkpoint[
-                            parameter_name
-                        ]
-                    elif key_to_dim[short_name] == -1:
-                        size = checkpoint[parameter_name].size(-1)
-                        parameter.data[:, size * i: size * (i + 1)] = checkpoint[
-                            parameter_name
-                        ]
-                    elif key_to_dim[short_name] == 2:
-                        size = checkpoint[parameter_name].size(-1)
-                        parameter.data[:-self.model_args.num_gen_audio_tokens, size * i: size * (i + 1)] = checkpoint[
-                            parameter_name
-                        ]
-                        parameter.data[-self.model_args.num_gen_audio_tokens:, :] = 1
-                del checkpoint
+            load_llama_checkpoint(self.llama, llama_ckpt_dir, self.model_args.num_gen_audio_tokens)
             print(f"LLaMA Checkpoint Loaded")
+        self.components.record("llama", time.perf_counter() - llama_start, self.llama)
 
         # 5. projector
         self.output_projector = ProjectionLayer(4096, self.model_args.output_dim_tokens,
@@ -216,25 +237,25 @@ class MuMu_LLaMA(nn.Module):
                                                 num_output_tokens=self.model_args.num_output_tokens)
 
         # 6. Generator
-        if self.args.music_decoder.lower() == "audioldm2":
+        self.music_decoder = self.args.music_decoder.lower()
+        if self.music_decoder == "audioldm2":
             # The model files for AudioLDM2 can be downloaded here in case of network issues:
             # https://huggingface.co/cvssp/audioldm2-music
             # And set the music_decoder_path argument to directory with the model files
-            print(f'Initialize AudioLDM2...')
             dtype = torch.float16 if torch.cuda.is_available() else torch.float32
-            self.generation_model = AudioLDM2Pipeline.from_pretrained(self.args.music_decoder_path, torch_dtype=dtype)
-            self.generation_model.to("cuda")
-            print(f'AudioLDM2 initialized...')
+            self.components.register("music_decoder", lambda: AudioLDM2Pipeline.from_pretrained(
+                self.args.music_decoder_path, torch_dtype=dtype).to(self.device),
+                                     enabled="music_decoder" not in disabled)
         else:
             # The model files for MusicGen can be downloaded here in case of network issues:
             # https://huggingface.co/facebook/musicgen-medium
             # And set the music_decoder_path argument to directory with the model files
-            print(f'Initialize MusicGen...')
-            self.generation_processor = AutoProcessor.from_pretrained(self.args.music_decoder_path)
-            self.generation_model = MusicgenForConditionalGeneration.from_pretrained(self.args.music_decoder_path)
-            self.generation_model.eval()
-            print(f'MusicGen initialized...')
-        self.music_decoder = self.args.music_decoder.lower()
+            self.components.register("music_decoder", lambda: self._frozen(
+                MusicgenForConditionalGeneration.from_pretrained(self.args.music_decoder_path)),
+                                     enabled="music_decoder" not in disabled)
+            self.components.register("music_processor", lambda: AutoProcessor.from_pretrained(
+                self.args.music_decoder_path), enabled="music_decoder" not in disabled)
+        self.components.load(*getattr(self.args, "preload_components", None) or [])
 
         # 4. prefix
         self.query_layer = 6
@@ -244,9 +265,13 @@ class MuMu_LLaMA(nn.Module):
         # 5. knn
         self.knn = knn
         if knn:
-            import faiss
-            self.index = faiss.read_index(download("https://huggingface.co/csuhan/knn/resolve/main/knn.index", knn_dir))
-            print(self.index)
+            # {modality: PrototypeIndex}, see build_knn_index.py
+            self.retrieval = load_knn_indexes(knn_dir, device=getattr(self.args, "knn_device", "cpu"),
+                                              nprobe=getattr(self.args, "knn_nprobe", None),
+                                              ef_search=getattr(self.args, "knn_ef_search", None),
+                                              rerank=getattr(self.args, "knn_rerank", None))
+            for modality, index in self.retrieval.items():
+                print(f"kNN {modality}: {index.stats()}")
 
         # 6. training criterion
         self.criterion = torch.nn.CrossEntropyLoss(ignore_index=0)
@@ -254,44 +279,53 @@ class MuMu_LLaMA(nn.Module):
         self.stage = stage
         self.set_default_trainability(self.stage)
 
+        # 7. draft model for speculative decoding, see load_draft_model()
+        self.draft_model = None
+
+    def _frozen(self, model):
+        return model.to(self.device).eval().requires_grad_(False)
+
+    # the lazily loaded components, see self.components
+    @property
+    def mert_model(self):
+        return self.components["mert"]
+
+    @property
+    def mert_processor(self):
+        return self.components["mert_processor"]
+
+    @property
+    def vit_model(self):
+        return self.components["vit"]
+
+    @property
+    def vit_processor(self):
+        return self.components["vit_processor"]
+
+    @property
+    def vivit_model(self):
+        return self.components["vivit"]
+
+    @property
+    def vivit_processor(self):
+        return self.components["vivit_processor"]
+
+    @property
+    def generation_model(self):
+        return self.components["music_decoder"]
+
+    @property
+    def generation_processor(self):
+        return self.components["music_processor"]
+
+    def load_state_dict(self, state_dict, strict=True, **kwargs):
+        # checkpoints from before lazy loading also hold the frozen pretrained components, which are loaded
+        # from their own checkpoints instead
+        state_dict = {key: value for key, value in state_dict.items() if not key.startswith(FROZEN_COMPONENTS)}
+        return super().load_state_dict(state_dict, strict=strict, **kwargs)
+
     def get_trainable_params(self, stage=1):
-        trainable = {}
-        if stage == 1:
-            for name, para in self.named_parameters():
-                if "llama." in name:
-                    if 'norm' in name or 'bias' in name or 'lora' in name:
-                        trainable[name] = para
-                if "mu_mert_" in name:
-                    trainable[name] = para
-                if "iu_vivit_" in name:
-                    trainable[name] = para
-                if "iu_vit_" in name:
-                    trainable[name] = para
-                if "prefix_query" in name:
-                    trainable[name] = para
-                if "tok_embeddings" in name:
-                    trainable[name] = para
-        elif stage == 2:
-            for name, para in self.named_parameters():
-                if "llama." in name:
-                    if 'norm' in name or 'bias' in name or 'lora' in name:
-                        trainable[name] = para
-                if "output_projector" in name:
-                    trainable[name] = para
-                if "prefix_query" in name:
-                    trainable[name] = para
-                if "tok_embeddings" in name:
-                    trainable[name] = para
-        elif stage == 3:
-            for name, para in self.named_parameters():
-                if "llama." in name:
-                    if 'norm' in name or 'bias' in name or 'lora' in name:
-                        trainable[name] = para
-                if "prefix_query" in name:
-                    trainable[name] = para
-                if "tok_embeddings" in name:
-                    trainable[name] = para
-        return trainable
+        return {name: para for name, para in self.named_parameters() if is_trainable(name, stage)}
 
     def set_default_trainability(self, stage=1):
         for key, value in self.named_parameters():
@@ -302,6 +336,60 @@ class MuMu_LLaMA(nn.Module):
             value.data = value.data.float()
             value.requires_grad = True
 
+    def base_manifest(self, hashes=True):
+        """The frozen base weights this model is built from: the LLaMA checkpoint (path, params.json and the
+        size and sha256 of its shards) and the pretrained components."""
+        manifest = {"llama": llama_manifest(self.llama_ckpt_dir, hashes=hashes),
+                    "num_gen_audio_tokens": self.model_args.num_gen_audio_tokens}
+        for key in BASE_COMPONENT_ARGS:
+            manifest[key] = getattr(self.args, key, None)
+        return manifest
+
+    def adapter_state_dict(self, stage=None):
+        """state_dict() without the pretrained LLaMA weights that are frozen in stage.
+
+        Next to get_trainable_params(stage) this keeps the frozen parameters that are not base weights (the
+        bridges of an earlier stage, the projector, the gates), so that base + adapter restores the whole model.
+        The [AUD*] rows of llama.output are randomly initialised when the base is loaded and returned apart.
+        """
+        stage = self.stage if stage is None else stage
+        state_dict = self.state_dict()
+        base = base_parameter_names(state_dict, stage)
+        audio_rows = {}
+        if "llama.output.weight" in base:
+            audio_rows["llama.output.weight"] = \
+                state_dict["llama.output.weight"][-self.model_args.num_gen_audio_tokens:].clone()
+        return {key: value for key, value in state_dict.items() if key not in base}, audio_rows
+
+    def adapter_checkpoint(self, stage=None, hashes=True):
+        stage = self.stage if stage is None else stage
+        state_dict, audio_rows = self.adapter_state_dict(stage)
+        return {"format": ADAPTER_FORMAT, "stage": stage, "model": state_dict, "audio_rows": audio_rows,
+                "base": self.base_manifest(hashes=hashes)}
+
+    @torch.no_grad()
+    def load_adapter_checkpoint(self, checkpoint, verify_hashes=False):
+        """Load an adapter checkpoint (adapter_checkpoint()) on top of the base weights this model was built
+        with (load_llama=True). Differences between the base and the manifest of the checkpoint are printed."""
+        manifest = checkpoint["base"]
+        problems = verify_llama_manifest(manifest["llama"], self.llama_ckpt_dir, hashes=verify_hashes)
+        for key in BASE_COMPONENT_ARGS:
+            if manifest.get(key) != getattr(self.args, key, None):
+                problems.append(f"{key} is {getattr(self.args, key, None)}, the adapter was trained with "
+                                f"{manifest.get(key)}")
+        for problem in problems:
+            print(f"WARNING: base weights differ from the adapter checkpoint: {problem}")
+        state_dict = {key.replace("module.", ""): value for key, value in checkpoint["model"].items()}
+        load_result = self.load_state_dict(state_dict, strict=False)
+        missing = set(load_result.missing_keys) - base_parameter_names(self.state_dict(), checkpoint["stage"])
+        assert not load_result.unexpected_keys and not missing, \
+            f"Adapter checkpoint does not match the model: missing {sorted(missing)}, " \
+            f"unexpected {load_result.unexpected_keys}"
+        for name, rows in checkpoint.get("audio_rows", {}).items():
+            parameter = self.get_parameter(name)
+            parameter[-rows.shape[0]:] = rows.to(parameter.dtype)
+        return load_result
+
     def _add_audio_token(self):
         self.audio_tokens = []
         for i in range(self.model_args.num_gen_audio_tokens):
@@ -321,82 +409,168 @@ class MuMu_LLaMA(nn.Module):
         audio = resampler(y)
         return audio, target_sr
 
+    def _encoder_id(self, modality):
+        # encoder checkpoint and preprocessing settings, part of the feature cache keys
+        if modality not in self._encoder_ids:
+            if modality == "audio":
+                window = (getattr(self.args, "mert_window_s", 60), getattr(self.args, "mert_overlap_s", 0))
+                path, processor = f"{self.args.mert_path}|window={window}", self.mert_processor
+            elif modality == "image":
+                path, processor = self.args.vit_path, self.vit_processor
+            else:
+                path, processor = self.args.vivit_path, self.vivit_processor
+            self._encoder_ids[modality] = f"{modality}|{path}|{sorted(processor.to_dict().items())}"
+        return self._encoder_ids[modality]
+
+    def _cached_features(self, modality, xs, agg, encode):
+        """encode(xs), the aggregated encoder features (after agg) of every input in xs, with the inputs found
+        in self.feature_cache left out of the call. Entries are keyed by the decoded input, the
+        encoder/preprocessing and the agg weights. Bypassed without a cache and when agg is being trained,
+        since cached features carry no autograd graph."""
+        cache = self.feature_cache
+        if cache is None or (torch.is_grad_enabled() and agg.weight.requires_grad):
+            return encode(xs)
+        keys = [cache.key(self._encoder_id(modality), agg.weight, agg.bias, x) for x in xs]
+        feats = [cache.get(key) for key in keys]
+        missing = [i for i, f in enumerate(feats) if f is None]
+        if missing:
+            for i, f in zip(missing, encode([xs[i] for i in missing])):
+                cache.put(keys[i], f)
+                feats[i] = f
+        return [f.to(agg.weight.device) for f in feats]
+
+    def _mert_window(self):
+        # window and overlap in samples, multiples of the MERT frame stride
+        sr = self.mert_processor.sampling_rate
+        stride = math.prod(self.mert_model.config.conv_stride)
+        window = int(getattr(self.args, "mert_window_s", 60) * sr) // stride * stride
+        overlap = int(getattr(self.args, "mert_overlap_s", 0) * sr) // stride * stride
+        assert 0 <= overlap < window, f"MERT window overlap {overlap} not in [0, {window})"
+        return window, overlap
+
+    def _mert_frames(self, num_samples):
+        # output length of the MERT conv feature extractor
+        for kernel, stride in zip(self.mert_model.config.conv_kernel, self.mert_model.config.conv_stride):
+            num_samples = (num_samples - kernel) // stride + 1
+        return max(num_samples, 0)
+
+    def _mert_receptive_field(self):
+        # fewest samples the MERT conv feature extractor turns into one frame
+        field = 1
+        for kernel, stride in reversed(list(zip(self.mert_model.config.conv_kernel,
+                                                self.mert_model.config.conv_stride))):
+            field = (field - 1) * stride + kernel
+        return field
+
+    def _encode_audio(self, xs):
+        """Aggregated MERT features [T, 1024] of every waveform in xs (at the processor's sampling rate).
+
+        Waveforms are cut into windows of mert_window_s seconds overlapping by mert_overlap_s. The windows of
+        all waveforms are encoded together, longest first, at most mert_max_windows per MERT pass (padded,
+        with an attention mask). Every window keeps its frames up to the middle of the overlaps with its
+        neighbours, so the stitched features cover each waveform once. A tail too short for a MERT frame is
+        encoded as part of the window before it, a waveform too short for one is zero padded."""
+        sr = self.mert_processor.sampling_rate
+        frame = math.prod(self.mert_model.config.conv_stride)
+        field = self._mert_receptive_field()
+        window, overlap = self._mert_window()
+        hop = window - overlap
+        max_windows = getattr(self.args, "mert_max_windows", 4)
+        # padding only leaves the other frames unchanged with per-frame layer norm in the feature extractor,
+        # models normalising over time (group norm) only batch windows of equal length
+        pad = getattr(self.mert_model.config, "feat_extract_norm", "layer") == "layer"
+
+        windows = []  # (waveform, window index, samples)
+        for item, waveform in enumerate(xs):
+            waveform = np.asarray(waveform.cpu() if torch.is_tensor(waveform) else waveform, dtype=np.float32)
+            if len(waveform) < field:
+                waveform = np.pad(waveform, (0, field - len(waveform)))
+            starts = list(range(0, max(len(waveform) - overlap, 1), hop))
+            if len(starts) > 1 and len(waveform) - starts[-1] < field:
+                starts.pop()
+            # the last window runs to the end of the waveform
+            windows += [(item, i, waveform[start:start + window] if i + 1 < len(starts) else waveform[start:])
+                        for i, start in enumerate(starts)]
+        order = sorted(range(len(windows)), key=lambda w: -len(windows[w][2]))
+        batches = []
+        for w in order:
+            if (batches and len(batches[-1]) < max_windows
+                    and (pad or len(windows[batches[-1][0]][2]) == len(windows[w][2]))):
+                batches[-1].append(w)
+            else:
+                batches.append([w])
+
+        feats = {}
+        for batch in batches:
+            inputs = self.mert_processor([windows[w][2] for w in batch], sampling_rate=sr, padding=True,
+                                         return_attention_mask=pad, return_tensors="pt").to(self.device)
+            with torch.no_grad():
+                hidden_states = self.mert_model(**inputs, output_hidden_states=True).hidden_states
+            for j, w in enumerate(batch):
+                n = self._mert_frames(len(windows[w][2]))
+                # [frames, layers, 1024], aggregated over the layers
+                layers = torch.stack([h[j, :n] for h in hidden_states], dim=1)
+                feats[w] = self.mu_mert_agg(layers).squeeze(1)
+
+        half, hop_frames = overlap // frame // 2, hop // frame
+        outputs = [[] for _ in xs]
+        for w, (item, i, _) in enumerate(windows):
+            last = w + 1 == len(windows) or windows[w + 1][0] != item
+            outputs[item].append(feats[w][0 if i == 0 else half:None if last else hop_frames + half])
+        return [torch.cat(parts) for parts in outputs]
+
     def encode_audio(self, x):
-        xs = []
-        for sub_x in x:
-            all_inputs = [self.mert_processor(sub_x[ix * self.mert_processor.sampling_rate:min(
-                (ix + 60) * self.mert_processor.sampling_rate, len(sub_x))],
-                                              sampling_rate=self.mert_processor.sampling_rate,
-                                              return_tensors="pt").to(self.device) for ix in
-                          range(0, len(sub_x) // (self.mert_processor.sampling_rate * 60) + 1, 60)]
-            aggoutputs = []
-            for inputs in all_inputs:
-                with torch.no_grad():
-                    outputs = self.mert_model(**inputs, output_hidden_states=True)
-                all_layer_hidden_states = torch.stack(outputs.hidden_states).squeeze()
-                sub_x = torch.swapaxes(all_layer_hidden_states, 0, 1)
-                aggoutputs.append(sub_x)
-            aggoutputs = torch.cat(aggoutputs)
-            sub_x = self.mu_mert_agg(aggoutputs).squeeze()
-            xs.append(sub_x)
-        x = torch.stack(xs, dim=0)
-        return x
+        xs = self._cached_features("audio", list(x), self.mu_mert_agg, self._encode_audio)
+        # [B, T, 1024], shorter waveforms are zero padded at the end, and [B] frames of each
+        lengths = torch.tensor([len(f) for f in xs], device=xs[0].device)
+        return torch.nn.utils.rnn.pad_sequence(xs, batch_first=True), lengths
+
+    def _encode_image(self, xs):
+        pixel_values = preprocess_images(xs, self.vit_processor, device=self.vit_model.device)
+        with torch.no_grad():
+            outputs = self.vit_model(pixel_values=pixel_values)
+        last_hidden_states = outputs.last_hidden_state
+        return list(self.iu_vit_agg(last_hidden_states.to(self.device)).squeeze(1))
 
     def encode_image(self, x):
-        xs = []
-        for sub_x in x:
-            inputs = self.vit_processor(images=sub_x, return_tensors="pt").to(self.vit_model.device)
-            with torch.no_grad():
-                outputs = self.vit_model(**inputs)
-            last_hidden_states = outputs.last_hidden_state
-            sub_x = self.iu_vit_agg(last_hidden_states.to(self.device)).squeeze()
-            xs.append(sub_x)
-        return torch.stack(xs, dim=0)
+        return torch.stack(self._cached_features("image", list(x), self.iu_vit_agg, self._encode_image), dim=0)
+
+    def _encode_video(self, xs):
+        pixel_values = preprocess_videos(xs, self.vivit_processor, device=self.vivit_model.device)
+        with torch.no_grad():
+            outputs = self.vivit_model(pixel_values=pixel_values)
+        last_hidden_states = outputs.last_hidden_state
+        return list(self.iu_vivit_agg(last_hidden_states.to(self.device)).squeeze(1))
 
     def encode_video(self, x):
-        xs = []
-        for sub_x in x:
-            inputs = self.vivit_processor(list(sub_x), padding=True, return_tensors="pt").to(self.vivit_model.device)
-            with torch.no_grad():
-                outputs = self.vivit_model(**inputs, output_hidden_states=True)
-            hidden_states = outputs.output_hidden_states
-            sub_x = self.iu_vivit_agg(hidden_states.to(self.device)).squeeze()
-            xs.append(sub_x)
-        return torch.stack(xs, dim=0)
+        return torch.stack(self._cached_features("video", list(x), self.iu_vivit_agg, self._encode_video), dim=0)
 
     def forward_audio(self, inputs, cache_size=10, cache_t=20, cache_weight=0.5):
         outputs = []
         outputs_weights = []
+        lengths = None
         for input_type, (input, input_weight) in inputs.items():
-            outputs.append(F.normalize(self.encode_audio(input), dim=-1))
+            feats, input_lengths = self.encode_audio(input)
+            outputs.append(F.normalize(feats, dim=-1))
             outputs_weights.append(input_weight)
+            lengths = input_lengths if lengths is None else torch.maximum(lengths, input_lengths)
         outputs_weights = [x / (sum(outputs_weights) + 1e-6) for x in outputs_weights]
 
         audio_feats = sum([output * output_weight for output, output_weight in zip(outputs, outputs_weights)])
-        device = audio_feats.device
 
         audio_feats, _ = self.mu_mert_rnn(audio_feats)
 
         attention_weights = self.mu_mert_attention(audio_feats).squeeze(-1)
+        # the padding of shorter clips gets no attention; the RNN is unidirectional, so it does not reach the
+        # outputs of their real frames either
+        padding = torch.arange(attention_weights.shape[1], device=lengths.device) >= lengths[:, None]
+        attention_weights = attention_weights.masked_fill(padding.to(attention_weights.device), float("-inf"))
         attention_scores = self.mu_mert_softmax(attention_weights)
         
         audio_feats = torch.matmul(attention_scores.unsqueeze(1), audio_feats).squeeze(1)
 
         if self.knn:
-            audio_feats_ori = audio_feats
-            sims, indices = self.index.search(audio_feats.cpu(), int(cache_size))
-            B = sims.shape[0]
-            prototypes = [self.index.reconstruct(x) for x in indices.reshape(-1, ).tolist()]
-            prototypes = np.vstack(prototypes).reshape(B, int(cache_size), -1)  # [N, top_k, 1024]
-            sims = torch.tensor(sims, device=device)
-            prototypes = torch.tensor(prototypes, device=device)
-
-            sims = (sims * cache_t).softmax(dim=-1)
-            audio_feats = sims @ prototypes
-            audio_feats = audio_feats / audio_feats.norm(dim=-1, keepdim=True)
-
-            audio_feats = (1 - cache_weight) * audio_feats_ori + cache_weight * audio_feats
-            audio_feats = audio_feats / audio_feats.norm(dim=-1, keepdim=True)
+            audio_feats = self.retrieval["audio"].mix(audio_feats, int(cache_size), cache_t, cache_weight)
 
         audio_feats = audio_feats.unsqueeze(1)  # B, 1, D
         audio_feats = self.mu_mert_proj(audio_feats)
@@ -422,23 +596,9 @@ class MuMu_LLaMA(nn.Module):
         outputs_weights = [x / (sum(outputs_weights) + 1e-6) for x in outputs_weights]
 
         image_feats = sum([output * output_weight for output, output_weight in zip(outputs, outputs_weights)])
-        device = image_feats.device
 
         if self.knn:
-            image_feats_ori = image_feats
-            sims, indices = self.index.search(image_feats.cpu(), int(cache_size))
-            B = sims.shape[0]
-            prototypes = [self.index.reconstruct(x) for x in indices.reshape(-1, ).tolist()]
-            prototypes = np.vstack(prototypes).reshape(B, int(cache_size), -1)  # [N, top_k, 1024]
-            sims = torch.tensor(sims, device=device)
-            prototypes = torch.tensor(prototypes, device=device)
-
-            sims = (sims * cache_t).softmax(dim=-1)
-            image_feats = sims @ prototypes
-            image_feats = image_feats / image_feats.norm(dim=-1, keepdim=True)
-
-            image_feats = (1 - cache_weight) * image_feats_ori + cache_weight * image_feats
-            image_feats = image_feats / image_feats.norm(dim=-1, keepdim=True)
+            image_feats = self.retrieval["image"].mix(image_feats, int(cache_size), cache_t, cache_weight)
 
         image_feats = image_feats.unsqueeze(1)  # B, 1, D
         image_feats = self.iu_vit_proj(image_feats)
@@ -464,7 +624,6 @@ class MuMu_LLaMA(nn.Module):
         outputs_weights = [x / (sum(outputs_weights) + 1e-6) for x in outputs_weights]
 
         video_feats = sum([output * output_weight for output, output_weight in zip(outputs, outputs_weights)])
-        device = video_feats.device
 
         video_feats, _ = self.iu_vivit_rnn(video_feats)
 
@@ -474,20 +633,7 @@ class MuMu_LLaMA(nn.Module):
         video_feats = torch.matmul(attention_scores.unsqueeze(1), video_feats).squeeze(1)
 
         if self.knn:
-            video_feats_ori = video_feats
-            sims, indices = self.index.search(video_feats.cpu(), int(cache_size))
-            B = sims.shape[0]
-            prototypes = [self.index.reconstruct(x) for x in indices.reshape(-1, ).tolist()]
-            prototypes = np.vstack(prototypes).reshape(B, int(cache_size), -1)  # [N, top_k, 1024]
-            sims = torch.tensor(sims, device=device)
-            prototypes = torch.tensor(prototypes, device=device)
-
-            sims = (sims * cache_t).softmax(dim=-1)
-            video_feats = sims @ prototypes
-            video_feats = video_feats / video_feats.norm(dim=-1, keepdim=True)
-
-            video_feats = (1 - cache_weight) * video_feats_ori + cache_weight * video_feats
-            video_feats = video_feats / video_feats.norm(dim=-1, keepdim=True)
+            video_feats = self.retrieval["video"].mix(video_feats, int(cache_size), cache_t, cache_weight)
 
         video_feats = video_feats.unsqueeze(1)  # B, 1, D
         video_feats = self.iu_vivit_proj(video_feats)
@@ -505,60 +651,81 @@ class MuMu_LLaMA(nn.Module):
         return video_feats
 
     @torch.inference_mode()
-    def forward_inference(self, tokens, start_pos: int, audio_feats=None, image_feats=None, video_feats=None):
+    def forward_inference(self, tokens, start_pos: int, audio_feats=None, image_feats=None, video_feats=None,
+                          pad_mask=None, seq_ids=None, adapters=None, all_logits=False):
+        # seq_ids: the self.llama.kv_cache sequences of the batch rows. Without them (and no cache bound by
+        # the caller) nothing is cached and start_pos has to be 0.
+        # adapters: project_adapters() of the request, replaces audio_feats/image_feats/video_feats
+        # all_logits: return the logits of every position instead of only the last one
+        if adapters is None:
+            adapters = self.project_adapters(audio_feats, image_feats, video_feats)
+        if seq_ids is None:
+            return self._forward_inference(tokens, start_pos, adapters, pad_mask, all_logits)
+        _bsz, seqlen = tokens.shape
+        positions = torch.arange(seqlen, device=tokens.device).expand(_bsz, seqlen)
+        positions = positions + (start_pos[:, None] if torch.is_tensor(start_pos) else start_pos)
+        self.llama.kv_cache.bind(seq_ids, positions)
+        try:
+            return self._forward_inference(tokens, start_pos, adapters, pad_mask, all_logits)
+        finally:
+            self.llama.kv_cache.unbind()
+
+    def _forward_inference(self, tokens, start_pos, adapters, pad_mask=None, all_logits=False):
         _bsz, seqlen = tokens.shape
         h = self.llama.tok_embeddings(tokens)
-        freqs_cis = self.llama.freqs_cis.to(h.device)
-        freqs_cis = freqs_cis[start_pos:start_pos + seqlen]
-
-        mask = None
-        mask = torch.full((1, 1, seqlen, seqlen), float("-inf"), device=h.device)
-        mask = torch.triu(mask, diagonal=start_pos + 1).type_as(h)
-
+        rope = self.llama.rope(start_pos, seqlen, h.device)
+
+        if torch.is_tensor(start_pos):
+            # per-row start positions [bsz], each row reads its own KV cache sequence
+            positions = start_pos[:, None] + torch.arange(seqlen, device=h.device)
+            # keys past a row's own position are either in its future or padding of the block table
+            key_pos = torch.arange(int(positions.max()) + 1, device=h.device)
+            mask = torch.zeros((_bsz, seqlen, len(key_pos)), device=h.device)
+            mask = mask.masked_fill(key_pos[None, None, :] > positions[:, :, None], float("-inf"))
+            mask = mask.unsqueeze(1).type_as(h)
+            return self._forward_layers(h, start_pos, rope, mask, adapters, all_logits)
+
+        mask = CausalMask(start_pos, seqlen) if seqlen > 1 else None
+        if pad_mask is not None:
+            # pad_mask: [bsz, start_pos + seqlen], True at left-padding positions. Padding queries still
+            # attend to themselves so that their softmax rows (and the cached K/V) stay finite.
+            self_key = torch.zeros((seqlen, start_pos + seqlen), dtype=torch.bool, device=h.device)
+            self_key[:, start_pos:] = torch.eye(seqlen, dtype=torch.bool, device=h.device)
+            pad = (pad_mask[:, None, :] & ~self_key).unsqueeze(1)
+            pad = torch.zeros(pad.shape, device=h.device).masked_fill(pad, float("-inf")).type_as(h)
+            mask = pad if mask is None else mask.dense(h.device).type_as(h) + pad
+        return self._forward_layers(h, start_pos, rope, mask, adapters, all_logits)
+
+    def adapter_inputs(self, audio_feats=None, image_feats=None, video_feats=None):
+        """Adapter prompt of each of the last 3 * query_layer layers: modality features + prefix query."""
+        prefix_query = self.prefix_query.weight.reshape(
+            self.query_layer * 3, 1, self.llama.params.dim).unsqueeze(1)
+        adapters = []
+        for feats in (audio_feats, image_feats, video_feats):
+            for _ in range(self.query_layer):
+                query = prefix_query[len(adapters)]
+                adapters.append(query if feats is None else feats + query)
+        return adapters
+
+    def project_adapters(self, audio_feats=None, image_feats=None, video_feats=None):
+        """Adapter keys/values of the adapted layers. They are constant for a request, so the generation
+        loops compute them once and hand them to every forward_inference() call."""
+        layers = self.llama.layers[-3 * self.query_layer:]
+        return [layer.attention.project_adapter(adapter)
+                for layer, adapter in zip(layers, self.adapter_inputs(audio_feats, image_feats, video_feats))]
+
+    def _forward_layers(self, h, start_pos, rope, mask, adapters, all_logits=False):
         music_output_embedding = []
         for layer in self.llama.layers[:-3 * self.query_layer]:
-            h = layer(h, 0, freqs_cis, mask)
+            h = layer(h, start_pos, rope, mask)
             music_output_embedding.append(h)
 
-        prefix_query = self.prefix_query.weight.reshape(
-            self.query_layer * 3, 1, 4096).unsqueeze(1)
-
-        prefix_index = 0
-        if audio_feats is not None:
-            for layer in self.llama.layers[-3 * self.query_layer:-2 * self.query_layer]:
-                h = layer(h, 0, freqs_cis, mask, audio_feats + prefix_query[prefix_index])
-                music_output_embedding.append(h)
-                prefix_index = prefix_index + 1
-        else:
-            for layer in self.llama.layers[-3 * self.query_layer:-2 * self.query_layer]:
-                h = layer(h, 0, freqs_cis, mask, prefix_query[prefix_index])
-                music_output_embedding.append(h)
-                prefix_index = prefix_index + 1
-
-        if image_feats is not None:
-            for layer in self.llama.layers[-2 * self.query_layer:-1 * self.query_layer]:
-                h = layer(h, 0, freqs_cis, mask, image_feats + prefix_query[prefix_index])
-                music_output_embedding.append(h)
-                prefix_index = prefix_index + 1
-        else:
-            for layer in self.llama.layers[-2 * self.query_layer:-1 * self.query_layer]:
-                h = layer(h, 0, freqs_cis, mask, prefix_query[prefix_index])
-                music_output_embedding.append(h)
-                prefix_index = prefix_index + 1
-
-        if video_feats is not None:
-            for layer in self.llama.layers[-1 * self.query_layer:]:
-                h = layer(h, 0, freqs_cis, mask, video_feats + prefix_query[prefix_index])
-                music_output_embedding.append(h)
-                prefix_index = prefix_index + 1
-        else:
-            for layer in self.llama.layers[-1 * self.query_layer:]:
-                h = layer(h, 0, freqs_cis, mask, prefix_query[prefix_index])
-                music_output_embedding.append(h)
-                prefix_index = prefix_index + 1
+        for layer, adapter in zip(self.llama.layers[-3 * self.query_layer:], adapters):
+            h = layer(h, start_pos, rope, mask, adapter)
+            music_output_embedding.append(h)
 
         h = self.llama.norm(h)
-        output = self.llama.output(h[:, -1, :])
+        output = self.llama.output(h if all_logits else h[:, -1, :])
 
         return output.float(), torch.cat(music_output_embedding[-1:], dim=1)
 
@@ -573,42 +740,40 @@ class MuMu_LLaMA(nn.Module):
         _bsz, seqlen = tokens.shape
 
         h = self.llama.tok_embeddings(tokens.to(self.device))
-        freqs_cis = self.llama.freqs_cis.to(h.device)
-        freqs_cis = freqs_cis[:seqlen]
-        mask = torch.full((1, 1, seqlen, seqlen), float("-inf"), device=h.device)
-        mask = torch.triu(mask, diagonal=0 + 1).type_as(h)
+        rope = self.llama.rope(0, seqlen, h.device)
+        mask = CausalMask(0, seqlen)
 
         for layer in self.llama.layers[:-3 * self.query_layer]:
-            h = layer(h, 0, freqs_cis, mask)
+            h = layer(h, 0, rope, mask)
         prefix_query = self.prefix_query.weight.reshape(
             self.query_layer * 3, 1, 4096).unsqueeze(1)
 
         prefix_index = 0
         if audio_feats is not None:
             for layer in self.llama.layers[-3 * self.query_layer:-2 * self.query_layer]:
-                h = layer(h, 0, freqs_cis, mask, audio_feats + prefix_query[prefix_index])
+                h = layer(h, 0, rope, mask, audio_feats + prefix_query[prefix_index])
                 prefix_index = prefix_index + 1
         else:
             for layer in self.llama.layers[-3 * self.query_layer:-2 * self.query_layer]:
-                h = layer(h, 0, freqs_cis, mask, prefix_query[prefix_index])
+                h = layer(h, 0, rope, mask, prefix_query[prefix_index])
                 prefix_index = prefix_index + 1
 
         if image_feats is not None:
             for layer in self.llama.layers[-2 * self.query_layer:-1 * self.query_layer]:
-                h = layer(h, 0, freqs_cis, mask, image_feats + prefix_query[prefix_index])
+                h = layer(h, 0, rope, mask, image_feats + prefix_query[prefix_index])
                 prefix_index = prefix_index + 1
         else:
             for layer in self.llama.layers[-2 * self.query_layer:-1 * self.query_layer]:
-                h = layer(h, 0, freqs_cis, mask, prefix_query[prefix_index])
+                h = layer(h, 0, rope, mask, prefix_query[prefix_index])
                 prefix_index = prefix_index + 1
 
         if video_feats is not None:
             for layer in self.llama.layers[-1 * self.query_layer:]:
-                h = layer(h, 0, freqs_cis, mask, video_feats + prefix_query[prefix_index])
+                h = layer(h, 0, rope, mask, video_feats + prefix_query[prefix_index])
                 prefix_index = prefix_index + 1
         else:
             for layer in self.llama.layers[-1 * self.query_layer:]:
-                h = layer(h, 0, freqs_cis, mask, prefix_query[prefix_index])
+                h = layer(h, 0, rope, mask, prefix_query[prefix_index])
                 prefix_index = prefix_index + 1
 
         final_hidden = h
@@ -662,30 +827,50 @@ class MuMu_LLaMA(nn.Module):
             mse_loss = torch.tensor(0.0)
         return c_loss, mse_loss
 
+    def music_profile(self, profile=None):
+        # AudioLDM2 sampler profile (see llama/audioldm2/profiles.py): --music_profile with the --music_scheduler,
+        # --music_steps, --music_candidates and --music_scoring overrides
+        return get_profile(profile or getattr(self.args, "music_profile", "reference"),
+                           scheduler=getattr(self.args, "music_scheduler", None),
+                           num_inference_steps=getattr(self.args, "music_steps", None),
+                           num_waveforms_per_prompt=getattr(self.args, "music_candidates", None),
+                           scoring=getattr(self.args, "music_scoring", None))
+
     @torch.inference_mode()
-    def generate_music(self, embeddings, audio_length_in_s, music_caption):
+    def generate_music(self, embeddings, audio_length_in_s, music_caption, conditioning=None, profile=None):
+        # conditioning (MusicGen): "text" encodes music_caption with the T5 text encoder, "embeddings" uses the
+        # projected [AUD*] embeddings instead (default: --music_conditioning)
+        # profile (AudioLDM2): name of the sampler profile (default: --music_profile)
         gen_prefix = ''.join([f'[AUD{i}]' for i in range(len(self.audio_tokens))])
         gen_prefx_ids = self.tokenizer(gen_prefix, add_special_tokens=False, return_tensors="pt").input_ids.to(
             self.device)
         gen_prefix_embs = self.llama.tok_embeddings(gen_prefx_ids)
         if self.music_decoder == "audioldm2":
-            gen_emb = self.output_projector(embeddings.float().to("cuda"), gen_prefix_embs).squeeze(dim=0) / 10
+            gen_emb = self.output_projector(embeddings.float().to(self.device), gen_prefix_embs).squeeze(dim=0) / 10
             prompt_embeds, generated_prompt_embeds = gen_emb[:, :128 * 1024], gen_emb[:, 128 * 1024:]
             prompt_embeds = prompt_embeds.reshape(prompt_embeds.shape[0], 128, 1024)
             generated_prompt_embeds = generated_prompt_embeds.reshape(generated_prompt_embeds.shape[0], 8, 768)
-            print("Generating Music...")
+            profile = self.music_profile(profile)
+            print(f"Generating Music... ({profile})")
             audio_outputs = self.generation_model(music_caption,
-                                                  num_inference_steps=200,
-                                                  num_waveforms_per_prompt=3,
                                                   negative_prompt='Low quality.',
-                                                  audio_length_in_s=audio_length_in_s).audios
+                                                  audio_length_in_s=audio_length_in_s,
+                                                  **apply_profile(self.generation_model, profile)).audios
             return audio_outputs
         else:
             print("Generating Music...")
-            gen_emb = 0.1 * self.output_projector(embeddings.float().to("cuda"), gen_prefix_embs) / 10
-            gen_inputs = self.generation_processor(text=music_caption, padding='max_length',
-                                                   max_length=128, truncation=True, return_tensors="pt").to(
-                self.device)
+            conditioning = conditioning or getattr(self.args, "music_conditioning", "text")
+            if conditioning == "embeddings":
+                # the projector is trained to produce 10 x the T5 encoder outputs of the caption (see forward()),
+                # they are attended to in full, the unconditional branch of CFG is added by generate()
+                gen_emb = self.output_projector(embeddings.float().to(self.device), gen_prefix_embs) / 10
+                gen_emb = gen_emb.to(self.generation_model.device, self.generation_model.dtype)
+                gen_inputs = {"encoder_outputs": (gen_emb,),
+                              "attention_mask": torch.ones(gen_emb.shape[:2], dtype=torch.long, device=gen_emb.device)}
+            else:
+                gen_inputs = self.generation_processor(text=music_caption, padding='max_length',
+                                                       max_length=128, truncation=True, return_tensors="pt").to(
+                    self.device)
             audio_outputs = self.generation_model.generate(**gen_inputs, guidance_scale=3.5,
                                                            max_new_tokens=int(256 / 5 * audio_length_in_s))
             return audio_outputs[0][0].cpu().detach().numpy()
@@ -703,7 +888,12 @@ class MuMu_LLaMA(nn.Module):
             cache_size=10,
             cache_t=20,
             cache_weight=0.5,
-            audio_length_in_s=10
+            audio_length_in_s=10,
+            use_cache=True,
+            num_draft_tokens=4,
+            stop_strings=DEFAULT_STOP_STRINGS,
+            top_k=0,
+            repetition_penalty=1.0
     ):
         bsz = len(prompts)
         params = self.llama.params
@@ -722,6 +912,8 @@ class MuMu_LLaMA(nn.Module):
                 image_feats = self.forward_image({'Image': [[imgs], 1]}, cache_size, cache_t, cache_weight)
             else:
                 image_feats = None
+            # the adapters do not change during generation, project them once
+            adapters = self.project_adapters(audio_feats, image_feats, video_feats)
 
         if isinstance(prompts[0], str):
             prompts = [self.tokenizer(x).input_ids[:, 1:] for x in prompts]
@@ -731,42 +923,69 @@ class MuMu_LLaMA(nn.Module):
 
         total_len = min(params.max_seq_len, max_gen_len + max_prompt_size)
 
-        tokens = torch.full((bsz, total_len), 0).cuda().long()
+        tokens = torch.full((bsz, total_len), 0, dtype=torch.long, device=self.device)
 
         for k, t in enumerate(prompts):
-            tokens[k, : len(t)] = torch.tensor(t).cuda().long()
+            tokens[k, : len(t)] = torch.tensor(t, dtype=torch.long)
         input_text_mask = tokens != 0
         start_pos = min_prompt_size
         prev_pos = 0
         music_output_embeddings = []
         start_gather = 0
-        for cur_pos in range(start_pos, total_len):
-            with torch.cuda.amp.autocast():
-                logits, music_output_embedding = self.forward_inference(tokens[:, prev_pos:cur_pos], prev_pos,
-                                                                        audio_feats, image_feats, video_feats)
-            if temperature > 0:
-                probs = torch.softmax(logits / temperature, dim=-1)
-                next_token = sample_top_p(probs, top_p)
-            else:
-                next_token = torch.argmax(logits, dim=-1)
-            next_token = next_token.reshape(-1)
-
-            next_token = torch.where(
-                input_text_mask[:, cur_pos], tokens[:, cur_pos], next_token
-            )
-            tokens[:, cur_pos] = next_token
-            if next_token[0] == self.audio_tokens[start_gather]:
-                if start_gather == 0:
-                    music_output_embeddings = []
-                music_output_embeddings.append(music_output_embedding[:, -1:, :])
-                start_gather += 1
-                if start_gather >= len(self.audio_tokens):
-                    start_gather = 0
-                    break
-            # trick: early stop if bsz==1
-            if bsz == 1 and self.tokenizer.decode(tokens[0, cur_pos - 2:cur_pos + 1]) == "\n###":
-                break
-            # prev_pos = cur_pos
+        fingerprint = self.prefix_fingerprint(audio_feats, image_feats, video_feats)
+        stop_matcher = get_stop_matcher(self.tokenizer, tuple(stop_strings))
+        # speculative sampling reproduces the plain temperature/top_p distribution only
+        speculative = top_k <= 0 and repetition_penalty == 1.0
+        if self.draft_model is not None and num_draft_tokens > 0 and bsz == 1 and use_cache and speculative:
+            out, music_output_embeddings = self._generate_speculative(
+                prompts[0], adapters, fingerprint, total_len, temperature, top_p, num_draft_tokens, stop_matcher)
+            tokens[0, :len(out)] = torch.tensor(out, dtype=torch.long)
+        else:
+            kv_cache = self.llama.kv_cache
+            seq_ids = [kv_cache.allocate(total_len) for _ in range(bsz)]
+            stop_state = stop_matcher.initial_state(bsz, self.device)
+            stopped = torch.zeros(bsz, dtype=torch.bool, device=self.device)
+            try:
+                if use_cache:
+                    # skip the prompt prefix (usually the instruction template) whose K/V are cached already
+                    prev_pos = min(kv_cache.match_prefix(s, t, fingerprint) for s, t in zip(seq_ids, prompts))
+                    for seq_id in seq_ids:
+                        kv_cache.truncate(seq_id, prev_pos)
+                for cur_pos in range(start_pos, total_len):
+                    with torch.cuda.amp.autocast():
+                        logits, music_output_embedding = self.forward_inference(
+                            tokens[:, prev_pos:cur_pos], prev_pos, seq_ids=seq_ids, adapters=adapters)
+                    if use_cache and cur_pos == start_pos:
+                        for seq_id, t in zip(seq_ids, prompts):
+                            kv_cache.cache_prefix(seq_id, t, fingerprint)
+                    next_token = sample(logits, temperature, top_p, top_k, repetition_penalty,
+                                        prev_tokens=tokens[:, :cur_pos])
+
+                    next_token = torch.where(
+                        input_text_mask[:, cur_pos], tokens[:, cur_pos], next_token
+                    )
+                    tokens[:, cur_pos] = next_token
+                    if next_token[0] == self.audio_tokens[start_gather]:
+                        if start_gather == 0:
+                            music_output_embeddings = []
+                        music_output_embeddings.append(music_output_embedding[:, -1:, :])
+                        start_gather += 1
+                        if start_gather >= len(self.audio_tokens):
+                            start_gather = 0
+                            break
+                    # early stop once every sequence has produced a stop string
+                    generated = ~input_text_mask[:, cur_pos]
+                    new_state, hit = stop_matcher.step(stop_state, next_token)
+                    stop_state = torch.where(generated, new_state, stop_state)
+                    stopped |= hit & generated
+                    if stopped.all():
+                        break
+                    if use_cache:
+                        # only feed the newly sampled token next step, attending to the cached K/V
+                        prev_pos = cur_pos
+            finally:
+                for seq_id in seq_ids:
+                    kv_cache.free(seq_id)
 
         decoded = []
         for i, t in enumerate(tokens.tolist()):
@@ -786,6 +1005,333 @@ class MuMu_LLaMA(nn.Module):
 
         return [decoded[0]]
 
+    def _generate_speculative(self, prompt, adapters, fingerprint, total_len, temperature, top_p, num_draft_tokens,
+                              stop_matcher):
+        """Speculative sampling (Leviathan et al., 2023) for a single prompt.
+
+        The draft model proposes num_draft_tokens tokens which the full model scores in one forward pass. A
+        proposal d is kept with probability min(1, p(d) / q(d)), p and q being the temperature/top_p sampling
+        distributions of the full and the draft model; the first rejected one is resampled from
+        max(0, p - q), and if all are kept one more token is sampled from p. The tokens therefore follow the
+        same distribution as the plain decode loop (and are identical for temperature 0). Music embeddings
+        are the full model's hidden states at the positions that produced the [AUD*] tokens.
+
+        Returns the prompt followed by the generated tokens, and the gathered music embeddings.
+        """
+        draft = self.draft_model
+        kv_cache, draft_kv_cache = self.llama.kv_cache, draft.kv_cache
+        out = list(prompt)
+        music_output_embeddings = []
+        start_gather = 0
+        stop_state = stop_matcher.initial_state()
+        seq_id = kv_cache.allocate(total_len)
+        draft_seq_id = draft_kv_cache.allocate(total_len)
+        try:
+            # both caches hold every token but the last one of out
+            kv_cache.match_prefix(seq_id, prompt, fingerprint)
+            draft_kv_cache.match_prefix(draft_seq_id, prompt)
+            stop = False
+            while not stop and len(out) < total_len:
+                n = len(out)
+                # keep one position for the token sampled from the full model
+                k = min(num_draft_tokens, total_len - n - 1)
+                drafts, draft_probs = [], []
+                for _ in range(k):
+                    seq = out + drafts
+                    start = draft_kv_cache.seq_lens[draft_seq_id]
+                    logits = draft(torch.tensor([seq[start:]], device=self.device), start, seq_ids=[draft_seq_id])
+                    q = sampling_probs(logits[0, -1], temperature, top_p)
+                    drafts.append(torch.multinomial(q, num_samples=1).item())
+                    draft_probs.append(q)
+
+                seq = out + drafts
+                start = kv_cache.seq_lens[seq_id]
+                with torch.cuda.amp.autocast():
+                    logits, music_output_embedding = self.forward_inference(
+                        torch.tensor([seq[start:]], device=self.device), start, seq_ids=[seq_id], adapters=adapters,
+                        all_logits=True)
+                if start < len(prompt):
+                    kv_cache.cache_prefix(seq_id, prompt, fingerprint)
+                    draft_kv_cache.cache_prefix(draft_seq_id, prompt)
+                # position i predicts the token after seq[n - 1 + i]
+                probs = sampling_probs(logits[0, -(k + 1):], temperature, top_p)
+                hidden = music_output_embedding[0, -(k + 1):]
+
+                new_tokens = []
+                for i, (d, q) in enumerate(zip(drafts, draft_probs)):
+                    if torch.rand(1).item() < min(1.0, (probs[i, d] / q[d]).item()):
+                        new_tokens.append(d)
+                        continue
+                    residual = torch.clamp(probs[i] - q, min=0)
+                    if residual.sum() <= 0:
+                        residual = probs[i]
+                    new_tokens.append(torch.multinomial(residual / residual.sum(), num_samples=1).item())
+                    break
+                else:
+                    new_tokens.append(torch.multinomial(probs[k], num_samples=1).item())
+                # drop the K/V of rejected proposals
+                kv_cache.truncate(seq_id, n + len(new_tokens) - 1)
+                draft_kv_cache.truncate(draft_seq_id, n + len(new_tokens) - 1)
+
+                for i, token in enumerate(new_tokens):
+                    out.append(token)
+                    if token == self.audio_tokens[start_gather]:
+                        if start_gather == 0:
+                            music_output_embeddings = []
+                        music_output_embeddings.append(hidden[None, i:i + 1])
+                        start_gather += 1
+                        if start_gather >= len(self.audio_tokens):
+                            start_gather = 0
+                            stop = True
+                    stop_state, hit = stop_matcher.advance(stop_state, token)
+                    if hit:
+                        stop = True
+                    if stop:
+                        break
+        finally:
+            kv_cache.free(seq_id)
+            draft_kv_cache.free(draft_seq_id)
+        return out, music_output_embeddings
+
+    def load_draft_model(self, draft_ckpt_dir):
+        """Load a small LLaMA (Meta checkpoint format, single shard, same tokenizer) as the draft model of
+        speculative decoding in generate(). It is not a submodule, so it is never part of MuMu_LLaMA
+        checkpoints. Rows for the [AUD*] tokens are added to its embeddings/output if missing."""
+        with open(os.path.join(draft_ckpt_dir, "params.json"), "r") as f:
+            params = json.loads(f.read())
+        params.pop("vocab_size", None)
+        draft_args = ModelArgs(max_seq_len=self.model_args.max_seq_len, max_batch_size=1, w_bias=False,
+                               w_lora=False, vocab_size=len(self.tokenizer),
+                               attention_backend=self.model_args.attention_backend, **params)
+        ckpts = sorted(Path(draft_ckpt_dir).glob("*.pth"))
+        assert len(ckpts) == 1, f"Expected a single draft checkpoint shard in {draft_ckpt_dir}, found {len(ckpts)}"
+        checkpoint = torch.load(ckpts[0], map_location="cpu")
+        for key in ("tok_embeddings.weight", "output.weight"):
+            weight = checkpoint[key]
+            if weight.shape[0] < draft_args.vocab_size:
+                missing = weight.new_zeros(draft_args.vocab_size - weight.shape[0], weight.shape[1])
+                checkpoint[key] = torch.cat([weight, missing], dim=0)
+
+        draft = Transformer(draft_args)
+        load_result = draft.load_state_dict(checkpoint, strict=False)
+        assert len(load_result.missing_keys) == 0, f"Missing keys: {load_result.missing_keys}"
+        dtype = torch.float16 if torch.cuda.is_available() else torch.float32
+        draft = draft.to(self.device, dtype).eval()
+        # plain attribute, kept out of the module tree
+        object.__setattr__(self, "draft_model", draft)
+        print(f"Draft model loaded: {draft_args.n_layers} layers, dim {draft_args.dim}")
+        return draft
+
+    def merge_lora(self):
+        """Fold the LLaMA LoRA weights into the base projections for inference; checkpoints stay unmerged."""
+        self.llama.merge_lora()
+
+    def unmerge_lora(self):
+        self.llama.unmerge_lora()
+
+    def quantize(self, bits=8, group_size=128, targets=QUANT_TARGETS, compute_dtype=None, empty=False):
+        """Weight-only quantisation of the LLaMA projections (Transformer.quantize()); the modality bridges,
+        projector and encoders are left alone. save_quantized() writes the checkpoint."""
+        self.llama.quantize(bits, group_size, targets, compute_dtype, empty)
+
+    def prefix_fingerprint(self, audio_feats=None, image_feats=None, video_feats=None):
+        """Key for sharing cached prompt K/V: the adapted upper layers also depend on the modality features."""
+        return tuple(None if f is None else hash(f.detach().float().cpu().numpy().tobytes())
+                     for f in (audio_feats, image_feats, video_feats))
+
+    def generate_stream(self, prompt, audio=None, image=None, video=None, max_gen_len: int = 256,
+                        temperature: float = 0.1, top_p: float = 0.75, audio_length_in_s=10,
+                        stop_strings=DEFAULT_STOP_STRINGS, top_k=0, repetition_penalty=1.0):
+        """Generator version of generate() for one prompt: yields the text as it is sampled, then the music.
+        See Scheduler.stream() for the events."""
+        yield from Scheduler(self, max_batch_size=1).stream(prompt, audio=audio, image=image, video=video,
+                                                            max_gen_len=max_gen_len, temperature=temperature,
+                                                            top_p=top_p, audio_length_in_s=audio_length_in_s,
+                                                            stop_strings=stop_strings, top_k=top_k,
+                                                            repetition_penalty=repetition_penalty)
+
+    def _batch_modality_feats(self, forward_fn, modality, inputs, cache_size, cache_t, cache_weight):
+        """Encode the non-empty entries of inputs one by one and stack them to [bsz, 1, dim].
+
+        Rows without an input get zero features so that their adapter reduces to the bare prefix query,
+        which is exactly what generate() uses when the modality is missing."""
+        if inputs is None or all(x is None for x in inputs):
+            return None
+        feats = [None if x is None else forward_fn({modality: [[x], 1]}, cache_size, cache_t, cache_weight)
+                 for x in inputs]
+        ref = next(f for f in feats if f is not None)
+        return torch.cat([torch.zeros_like(ref) if f is None else f for f in feats], dim=0)
+
+    @torch.inference_mode()
+    def generate_batch(
+            self,
+            prompts,
+            audios=None,
+            imgs=None,
+            videos=None,
+            max_gen_len: int = 256,
+            temperature: float = 0.1,
+            top_p: float = 0.75,
+            cache_size=10,
+            cache_t=20,
+            cache_weight=0.5,
+            audio_length_in_s=10,
+            padding_side="left",
+            decode_music=True,
+            stop_strings=DEFAULT_STOP_STRINGS,
+            top_k=0,
+            repetition_penalty=1.0
+    ):
+        """Generate answers for N prompts at once.
+
+        prompts is a list of token id lists (or strings), audios/imgs/videos are either None or lists of the
+        same length holding the input of each prompt or None. Prompts are run in chunks of
+        params.max_batch_size; each sequence stops on its own (EOS, one of stop_strings, all [AUD*] tokens
+        or max_gen_len) and is removed from the running batch. Returns one result per prompt in the same
+        format as generate(): [text] or [text, {'aud': [audio], 'emb': music_embedding}].
+        """
+        assert padding_side in ("left", "right"), padding_side
+        if isinstance(prompts[0], str):
+            prompts = [self.tokenizer(x).input_ids for x in prompts]
+        chunk = self.llama.params.max_batch_size
+
+        def _slice(xs, i):
+            return None if xs is None else xs[i:i + chunk]
+
+        results = []
+        for i in range(0, len(prompts), chunk):
+            with torch.cuda.amp.autocast():
+                audio_feats = self._batch_modality_feats(self.forward_audio, 'Audio', _slice(audios, i),
+                                                         cache_size, cache_t, cache_weight)
+                video_feats = self._batch_modality_feats(self.forward_video, 'Video', _slice(videos, i),
+                                                         cache_size, cache_t, cache_weight)
+                image_feats = self._batch_modality_feats(self.forward_image, 'Image', _slice(imgs, i),
+                                                         cache_size, cache_t, cache_weight)
+            results.extend(self._generate_chunk(prompts[i:i + chunk], audio_feats, image_feats, video_feats,
+                                                max_gen_len, temperature, top_p, padding_side, stop_strings,
+                                                top_k, repetition_penalty))
+
+        outputs = []
+        for text, music_output_embeddings in results:
+            if music_output_embeddings is None:
+                outputs.append([text])
+                continue
+            music = {'emb': music_output_embeddings}
+            if decode_music:
+                music['aud'] = [self.generate_music(music_output_embeddings, audio_length_in_s, text)]
+            outputs.append([text, music])
+        return outputs
+
+    def _generate_chunk(self, prompts, audio_feats, image_feats, video_feats, max_gen_len, temperature, top_p,
+                        padding_side, stop_strings=DEFAULT_STOP_STRINGS, top_k=0, repetition_penalty=1.0):
+        bsz = len(prompts)
+        params = self.llama.params
+        assert bsz <= params.max_batch_size, (bsz, params.max_batch_size)
+
+        prompt_lens = [len(t) for t in prompts]
+        max_prompt_size = max(prompt_lens)
+        total_len = min(params.max_seq_len, max_gen_len + max_prompt_size)
+
+        tokens = torch.zeros((bsz, total_len), dtype=torch.long, device=self.device)
+        pad_mask = None
+        if padding_side == "left":
+            # every prompt ends at max_prompt_size, so the whole batch is prefilled in one pass
+            pad_mask = torch.zeros((bsz, total_len), dtype=torch.bool, device=self.device)
+            for k, t in enumerate(prompts):
+                tokens[k, max_prompt_size - len(t): max_prompt_size] = torch.tensor(t, dtype=torch.long)
+                pad_mask[k, :max_prompt_size - len(t)] = True
+            gen_start = [max_prompt_size] * bsz
+            start_pos = max_prompt_size
+        else:
+            # decoding starts at the shortest prompt, longer prompts are teacher-forced until they run out
+            for k, t in enumerate(prompts):
+                tokens[k, :len(t)] = torch.tensor(t, dtype=torch.long)
+            gen_start = prompt_lens
+            start_pos = min(prompt_lens)
+        gen_start_t = torch.tensor(gen_start, device=self.device)
+        with torch.cuda.amp.autocast():
+            adapters = self.project_adapters(audio_feats, image_feats, video_feats)
+
+        # rows of the running batch -> index into prompts
+        active = list(range(bsz))
+        gather = [0] * bsz
+        music_output_embeddings = [[] for _ in range(bsz)]
+        # rows whose prompt leaves no room before total_len generate nothing
+        finished_tokens = [[] for _ in range(bsz)]
+        stop_matcher = get_stop_matcher(self.tokenizer, tuple(stop_strings))
+        stop_state = stop_matcher.initial_state(bsz, self.device)
+        prev_pos = 0
+        seq_ids = [self.llama.kv_cache.allocate(total_len) for _ in range(bsz)]
+        try:
+            for cur_pos in range(start_pos, total_len):
+                with torch.cuda.amp.autocast():
+                    logits, music_output_embedding = self.forward_inference(
+                        tokens[:, prev_pos:cur_pos], prev_pos,
+                        pad_mask=None if pad_mask is None else pad_mask[:, :cur_pos], seq_ids=seq_ids,
+                        adapters=adapters)
+                # left padding is token 0 and only ever penalises <unk>
+                next_token = sample(logits, temperature, top_p, top_k, repetition_penalty,
+                                    prev_tokens=tokens[:, :cur_pos])
+                next_token = torch.where(gen_start_t > cur_pos, tokens[:, cur_pos], next_token)
+                tokens[:, cur_pos] = next_token
+                generated = gen_start_t <= cur_pos
+                new_state, stop_hit = stop_matcher.step(stop_state, next_token)
+                stop_state = torch.where(generated, new_state, stop_state)
+                stop_hit = (stop_hit & generated).tolist()
+
+                done = []
+                for i, (row, token) in enumerate(zip(active, next_token.tolist())):
+                    if cur_pos < gen_start[row]:
+                        continue
+                    stop = token == self.tokenizer.eos_token_id
+                    if token == self.audio_tokens[gather[row]]:
+                        if gather[row] == 0:
+                            music_output_embeddings[row] = []
+                        music_output_embeddings[row].append(music_output_embedding[i, -1:, :])
+                        gather[row] += 1
+                        if gather[row] >= len(self.audio_tokens):
+                            gather[row] = 0
+                            stop = True
+                    if stop_hit[i]:
+                        stop = True
+                    if stop or cur_pos + 1 - gen_start[row] >= max_gen_len or cur_pos + 1 == total_len:
+                        finished_tokens[row] = tokens[i, gen_start[row]:cur_pos + 1].tolist()
+                        done.append(i)
+                if len(done) == len(active):
+                    break
+                if done:
+                    keep = [i for i in range(len(active)) if i not in done]
+                    keep_t = torch.tensor(keep, device=self.device)
+                    tokens = tokens[keep_t]
+                    gen_start_t = gen_start_t[keep_t]
+                    stop_state = stop_state[keep_t]
+                    if pad_mask is not None:
+                        pad_mask = pad_mask[keep_t]
+                    # adapters without modality features are shared by the batch (one row)
+                    adapters = [tuple(x if x is None or x.shape[0] == 1 else x[keep_t] for x in adapter)
+                                for adapter in adapters]
+                    for i in done:
+                        self.llama.kv_cache.free(seq_ids[i])
+                    seq_ids = [seq_ids[i] for i in keep]
+                    active = [active[i] for i in keep]
+                prev_pos = cur_pos
+        finally:
+            for seq_id in seq_ids:
+                self.llama.kv_cache.free(seq_id)
+
+        results = []
+        for row in range(bsz):
+            t = finished_tokens[row]
+            # cut to eos tok if any
+            for stop_token in (13, self.tokenizer.eos_token_id):
+                if stop_token in t:
+                    t = t[: t.index(stop_token)]
+            embedding = None
+            if len(music_output_embeddings[row]) == len(self.audio_tokens):
+                embedding = torch.cat(music_output_embeddings[row], dim=1)
+            results.append((self.tokenizer.decode(t), embedding))
+        return results
+
 
 def load(model_path, llama_dir, mert_path="m-a-p/MERT-v1-330M", device="cuda" if torch.cuda.is_available() else "cpu",
          knn=False, knn_dir="./ckpts", llama_type="7B", stage=3):
@@ -146,6 +146,61 @@ class MusicgenSinusoidalPositionalEmbedding(nn.Module):
         return self.weights.index_select(0, position_ids.view(-1)).detach()
 
 
+class MusicgenStaticCache:
+    """Preallocated decoder cache for generation.
+
+    Self-attention keys/values of every layer live in one [bsz, heads, max_length, head_dim] buffer per layer,
+    allocated on the first step and written in place at the current position, so a generated frame does not
+    reallocate and copy the whole cache as the torch.cat of the tuple cache does. Attention reads the filled
+    prefix as a view. Cross-attention keys/values are projected from the encoder outputs on the first step and
+    kept. Indexing gives the MusicgenStaticLayerCache of a layer, which MusicgenAttention writes to.
+    """
+
+    def __init__(self, max_length: int, num_layers: int):
+        self.max_length = max_length
+        self.seen = 0
+        self.layers = [MusicgenStaticLayerCache(self) for _ in range(num_layers)]
+
+    def __getitem__(self, idx):
+        return self.layers[idx]
+
+    def __len__(self):
+        return len(self.layers)
+
+    def get_seq_length(self):
+        return self.seen
+
+
+class MusicgenStaticLayerCache:
+    def __init__(self, cache: MusicgenStaticCache):
+        self.cache = cache
+        self.key = None
+        self.value = None
+        self.cross = None
+
+    def update(self, key_states: torch.Tensor, value_states: torch.Tensor):
+        """Write key/value_states ([bsz, heads, tgt_len, head_dim]) at the current position and return the keys and
+        values of all positions so far."""
+        start, end = self.cache.seen, self.cache.seen + key_states.shape[2]
+        if self.key is None:
+            shape = (*key_states.shape[:2], self.cache.max_length, key_states.shape[3])
+            self.key = key_states.new_empty(shape)
+            self.value = value_states.new_empty(shape)
+        if end > self.cache.max_length:
+            raise ValueError(f"MusicgenStaticCache of length {self.cache.max_length} cannot hold {end} positions")
+        self.key[:, :, start:end] = key_states
+        self.value[:, :, start:end] = value_states
+        return self.key[:, :, :end], self.value[:, :, :end]
+
+
+def _past_length(past_key_values):
+    if past_key_values is None:
+        return 0
+    if isinstance(past_key_values, MusicgenStaticCache):
+        return past_key_values.get_seq_length()
+    return past_key_values[0][0].shape[2]
+
+
 # Copied from transformers.models.bart.modeling_bart.BartAttention with Bart->Musicgen
 class MusicgenAttention(nn.Module):
     """Multi-headed attention from 'Attention Is All You Need' paper"""
@@ -207,7 +262,21 @@ class MusicgenAttention(nn.Module):
         # `past_key_value[0].shape[2] == key_value_states.shape[1]`
         # is checking that the `sequence_length` of the `past_key_value` is the same as
         # the provided `key_value_states` to support prefix tuning
-        if (
+        static = isinstance(past_key_value, MusicgenStaticLayerCache)
+        if static and is_cross_attention:
+            # projected once, on the first step
+            if past_key_value.cross is None:
+                past_key_value.cross = (
+                    self._shape(self.k_proj(key_value_states), -1, bsz),
+                    self._shape(self.v_proj(key_value_states), -1, bsz),
+                )
+            key_states, value_states = past_key_value.cross
+        elif static:
+            # written in place into the preallocated buffers
+            key_states, value_states = past_key_value.update(
+                self._shape(self.k_proj(hidden_states), -1, bsz), self._shape(self.v_proj(hidden_states), -1, bsz)
+            )
+        elif (
             is_cross_attention
             and past_key_value is not None
             and past_key_value[0].shape[2] == key_value_states.shape[1]
@@ -230,7 +299,7 @@ class MusicgenAttention(nn.Module):
             key_states = self._shape(self.k_proj(hidden_states), -1, bsz)
             value_states = self._shape(self.v_proj(hidden_states), -1, bsz)
 
-        if self.is_decoder:
+        if self.is_decoder and not static:
             # if cross_attention save Tuple(torch.Tensor, torch.Tensor) of all cross attention key/value_states.
             # Further calls to cross_attention layer can then reuse all cross-attention
             # key/value_states (first "if" case)
@@ -370,7 +439,12 @@ class MusicgenDecoderLayer(nn.Module):
 
         # Self Attention
         # decoder uni-directional self-attention cached key/values tuple is at positions 1,2
-        self_attn_past_key_value = past_key_value[:2] if past_key_value is not None else None
+        # (a MusicgenStaticLayerCache holds both the self- and cross-attention keys/values)
+        static = isinstance(past_key_value, MusicgenStaticLayerCache)
+        if static:
+            self_attn_past_key_value = past_key_value
+        else:
+            self_attn_past_key_value = past_key_value[:2] if past_key_value is not None else None
         # add present self-attn cache to positions 1,2 of present_key_value tuple
         hidden_states, self_attn_weights, present_key_value = self.self_attn(
             hidden_states=hidden_states,
@@ -390,7 +464,10 @@ class MusicgenDecoderLayer(nn.Module):
             hidden_states = self.encoder_attn_layer_norm(hidden_states)
 
             # cross_attn cached key/values tuple is at positions 3,4 of present_key_value tuple
-            cross_attn_past_key_value = past_key_value[-2:] if past_key_value is not None else None
+            if static:
+                cross_attn_past_key_value = past_key_value
+            else:
+                cross_attn_past_key_value = past_key_value[-2:] if past_key_value is not None else None
             hidden_states, cross_attn_weights, cross_attn_present_key_value = self.encoder_attn(
                 hidden_states=hidden_states,
                 key_value_states=encoder_hidden_states,
@@ -403,7 +480,8 @@ class MusicgenDecoderLayer(nn.Module):
             hidden_states = residual + hidden_states
 
             # add cross-attn to positions 3,4 of present_key_value tuple
-            present_key_value = present_key_value + cross_attn_present_key_value
+            if not static:
+                present_key_value = present_key_value + cross_attn_present_key_value
 
         # Fully Connected
         residual = hidden_states
@@ -717,7 +795,7 @@ class MusicgenDecoder(MusicgenPreTrainedModel):
             raise ValueError("You have to specify either decoder_input_ids or decoder_inputs_embeds")
 
         # past_key_values_length
-        past_key_values_length = past_key_values[0][0].shape[2] if past_key_values is not None else 0
+        past_key_values_length = _past_length(past_key_values)
 
         if inputs_embeds is None:
             inputs_embeds = sum([self.embed_tokens[codebook](input[:, codebook]) for codebook in range(num_codebooks)])
@@ -815,6 +893,10 @@ class MusicgenDecoder(MusicgenPreTrainedModel):
         if output_hidden_states:
             all_hidden_states += (hidden_states,)
 
+        if isinstance(past_key_values, MusicgenStaticCache):
+            # the layers wrote this step's keys/values in place
+            past_key_values.seen += input_shape[-1]
+            next_decoder_cache = past_key_values
         next_cache = next_decoder_cache if use_cache else None
         if not return_dict:
             return tuple(
@@ -1036,7 +1118,7 @@ class MusicgenForCausalLM(MusicgenPreTrainedModel):
             if attention_mask is not None:
                 attention_mask = attention_mask.repeat((2, 1))
 
-        if past_key_values is not None:
+        if _past_length(past_key_values) > 0:
             input_ids = input_ids[:, -1:]
 
         return {
@@ -1129,6 +1211,7 @@ class MusicgenForCausalLM(MusicgenPreTrainedModel):
         stopping_criteria: Optional[StoppingCriteriaList] = None,
         synced_gpus: Optional[bool] = None,
         streamer: Optional["BaseStreamer"] = None,
+        static_cache: Optional[bool] = True,
         **kwargs,
     ):
         """
@@ -1172,6 +1255,9 @@ class MusicgenForCausalLM(MusicgenPreTrainedModel):
             streamer (`BaseStreamer`, *optional*):
                 Streamer object that will be used to stream the generated sequences. Generated tokens are passed
                 through `streamer.put(token_ids)` and the streamer is responsible for any further processing.
+            static_cache (`bool`, *optional*, defaults to `True`):
+                Whether to decode with a [`MusicgenStaticCache`], preallocated for `max_length` positions, instead of
+                the tuple cache grown by concatenation at every step.
             kwargs (`Dict[str, Any]`, *optional*):
                 Ad hoc parametrization of `generate_config` and/or additional model-specific kwargs that will be
                 forwarded to the `forward` function of the model. If the model is an encoder-decoder model, encoder
@@ -1288,6 +1374,12 @@ class MusicgenForCausalLM(MusicgenPreTrainedModel):
         # stash the delay mask so that we don't have to recompute it in each forward pass
         model_kwargs["delay_pattern_mask"] = delay_pattern_mask
 
+        if static_cache and generation_config.use_cache and model_kwargs.get("past_key_values") is None:
+            # keys/values of all max_length positions are preallocated and written in place (MusicgenStaticCache)
+            model_kwargs["past_key_values"] = MusicgenStaticCache(
+                generation_config.max_length, len(self.model.decoder.layers)
+            )
+
         # 7. determine generation mode
         is_greedy_gen_mode = (
             (generation_config.num_beams == 1)
@@ -1931,7 +2023,7 @@ class MusicgenForConditionalGeneration(PreTrainedModel):
                 decoder_attention_mask = decoder_attention_mask.repeat((2, 1))
 
         if past_key_values is not None:
-            past_length = past_key_values[0][0].shape[2]
+            past_length = _past_length(past_key_values)
 
             # Some generation methods already pass only the last input ID
             if decoder_input_ids.shape[1] > past_length:
@@ -2142,6 +2234,7 @@ class MusicgenForConditionalGeneration(PreTrainedModel):
         synced_gpus: Optional[bool] = None,
         streamer: Optional["BaseStreamer"] = None,
         encoder_only: Optional[bool] = False,
+        static_cache: Optional[bool] = True,
         **kwargs,
     ):
         """
@@ -2185,6 +2278,9 @@ class MusicgenForConditionalGeneration(PreTrainedModel):
             streamer (`BaseStreamer`, *optional*):
                 Streamer object that will be used to stream the generated sequences. Generated tokens are passed
                 through `streamer.put(token_ids)` and the streamer is responsible for any further processing.
+            static_cache (`bool`, *optional*, defaults to `True`):
+                Whether to decode with a [`MusicgenStaticCache`], preallocated for `max_length` positions, instead of
+                the tuple cache grown by concatenation at every step.
             kwargs (`Dict[str, Any]`, *optional*):
                 Ad hoc parametrization of `generate_config` and/or additional model-specific kwargs that will be
                 forwarded to the `forward` function of the model. If the model is an encoder-decoder model, encoder
@@ -2270,6 +2366,17 @@ class MusicgenForConditionalGeneration(PreTrainedModel):
                 model_input_name,
                 guidance_scale=generation_config.guidance_scale,
             )
+        elif generation_config.guidance_scale is not None and generation_config.guidance_scale > 1:
+            # encoder_outputs passed in place of the text encoder outputs (e.g. projected LLM embeddings): add the
+            # 'null' input for classifier free guidance, as _prepare_text_encoder_kwargs_for_generation does
+            last_hidden_state = model_kwargs["encoder_outputs"].last_hidden_state
+            model_kwargs["encoder_outputs"] = BaseModelOutput(
+                last_hidden_state=torch.concatenate([last_hidden_state, torch.zeros_like(last_hidden_state)], dim=0)
+            )
+            if model_kwargs.get("attention_mask") is not None:
+                model_kwargs["attention_mask"] = torch.concatenate(
+                    [model_kwargs["attention_mask"], torch.zeros_like(model_kwargs["attention_mask"])], dim=0
+                )
 
         if encoder_only:
             return model_kwargs['encoder_outputs']['last_hidden_state']
@@ -2329,6 +2436,12 @@ class MusicgenForConditionalGeneration(PreTrainedModel):
         # stash the delay mask so that we don't have to recompute in each forward pass
         model_kwargs["decoder_delay_pattern_mask"] = decoder_delay_pattern_mask
 
+        if static_cache and generation_config.use_cache and model_kwargs.get("past_key_values") is None:
+            # keys/values of all max_length positions are preallocated and written in place (MusicgenStaticCache)
+            model_kwargs["past_key_values"] = MusicgenStaticCache(
+                generation_config.max_length, len(self.decoder.model.decoder.layers)
+            )
+
         # input_ids are ready to be placed on the streamer (if used)
         if streamer is not None:
             streamer.put(input_ids.cpu())
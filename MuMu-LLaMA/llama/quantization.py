@@ -0,0 +1,223 @@
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+# the LLaMA projections that are quantised; LoRA branches, biases, norms, gates, embeddings and the
+# modality bridges keep their dtype
+QUANT_TARGETS = ("wq", "wk", "wv", "wo", "w1", "w2", "w3", "output")
+
+_int8_mm = getattr(torch, "_weight_int8pack_mm", None)  # torch >= 2.3
+_int8_mm_unsupported = set()  # (device type, dtype) the kernel failed on
+# int4 on CPU (torch >= 2.6), bfloat16 only (float32/float16 are slower than dequantising): the kernel takes the
+# weight in its own packing with a multiple of 16 rows, which QuantLinear converts to
+_int4_mm = getattr(torch, "_weight_int4pack_mm_for_cpu", None)
+_int4_pack = getattr(torch, "_convert_weight_to_int4pack_for_cpu", None)
+_int4_mm_unsupported = set()  # dtypes the kernel failed on
+
+
+def quantize_int8(weight):
+    """Symmetric per-output-channel int8: weight ~= qweight * scales[:, None]."""
+    weight = weight.float()
+    scales = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+    qweight = torch.round(weight / scales[:, None]).clamp_(-127, 127).to(torch.int8)
+    return qweight, scales
+
+
+def quantize_int4(weight, group_size):
+    """Asymmetric group-wise int4 over groups of group_size input columns: weight ~= q * scales + zeros.
+    Two values per byte, even columns in the low nibble."""
+    out_features, in_features = weight.shape
+    weight = weight.float().view(out_features, in_features // group_size, group_size)
+    zeros = weight.amin(dim=-1)
+    scales = ((weight.amax(dim=-1) - zeros) / 15).clamp(min=1e-8)
+    q = torch.round((weight - zeros[..., None]) / scales[..., None]).clamp_(0, 15).to(torch.uint8)
+    q = q.view(out_features, in_features)
+    return q[:, 0::2] | (q[:, 1::2] << 4), scales, zeros
+
+
+def _unpack_int4_cpu(packed, rows, in_features):
+    """The [rows, in_features] 4-bit values of a weight packed by torch._convert_weight_to_int4pack_for_cpu: blocks
+    of 64 rows hold, for each input column, row j in the low and row j + 32 in the high nibble of byte j; a last
+    block of fewer rows holds consecutive pairs of rows."""
+    packed = packed.view(-1)
+    full = rows // 64 * 64
+    head = packed[:full * in_features // 2].view(-1, in_features, 32)
+    head = torch.cat([head & 15, head >> 4], dim=-1).transpose(1, 2).reshape(full, in_features)
+    tail = packed[full * in_features // 2:].view(in_features, -1)
+    tail = torch.stack([tail & 15, tail >> 4], dim=-1).view(in_features, -1).t()
+    return torch.cat([head, tail])
+
+
+class QuantLinear(nn.Module):
+    """Weight-only quantised nn.Linear for inference. The weight is stored as int8 (per output channel scales)
+    or int4 (per group scales and zeros) buffers and dequantised in the matmul; the bias is kept as is.
+
+    Inputs are multiplied in compute_dtype (default: their own dtype) and the output is returned in the input
+    dtype. int8 uses torch._weight_int8pack_mm where the device/dtype supports it, int4 in bfloat16 on CPU uses
+    torch._weight_int4pack_mm_for_cpu: the first forward converts qweight in place to the packing of that kernel
+    (about the same size) and state_dict(), load_state_dict(), dequantize() and moves to another device convert
+    it back. Elsewhere int4 dequantises its whole weight for every matmul, which only saves memory and is slower
+    than the unquantised layer.
+    """
+
+    def __init__(self, in_features, out_features, bias=True, bits=8, group_size=128, compute_dtype=None,
+                 device=None):
+        super().__init__()
+        assert bits in (4, 8), f"Unsupported number of bits {bits}, one of 4, 8"
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        self.group_size = min(group_size, in_features)
+        self.compute_dtype = compute_dtype
+        if bits == 8:
+            self.register_buffer("qweight", torch.empty(out_features, in_features, dtype=torch.int8, device=device))
+            self.register_buffer("scales", torch.empty(out_features, device=device))
+        else:
+            assert in_features % self.group_size == 0 and self.group_size % 2 == 0, \
+                f"in_features {in_features} is not a multiple of the int4 group size {self.group_size}"
+            n_groups = in_features // self.group_size
+            self.register_buffer("qweight", torch.empty(out_features, in_features // 2, dtype=torch.uint8,
+                                                        device=device))
+            self.register_buffer("scales", torch.empty(out_features, n_groups, device=device))
+            self.register_buffer("zeros", torch.empty(out_features, n_groups, device=device))
+        self.bias = nn.Parameter(torch.empty(out_features, device=device), requires_grad=False) if bias else None
+        self.cpu_int4_packed = False  # qweight holds the packing of _int4_mm instead of two nibbles per byte
+        self._scales_and_zeros = {}  # per dtype, for _int4_mm
+
+    @classmethod
+    @torch.no_grad()
+    def from_linear(cls, linear, bits=8, group_size=128, compute_dtype=None, empty=False):
+        # empty: only allocate the buffers, for loading a quantised state dict
+        module = cls(linear.in_features, linear.out_features, linear.bias is not None, bits, group_size,
+                     compute_dtype, device=linear.weight.device)
+        if not empty:
+            if bits == 8:
+                qweight, scales = quantize_int8(linear.weight)
+            else:
+                qweight, scales, zeros = quantize_int4(linear.weight, module.group_size)
+                module.zeros.copy_(zeros)
+            module.qweight.copy_(qweight)
+            module.scales.copy_(scales)
+        if linear.bias is not None:
+            module.bias = linear.bias
+        return module
+
+    def dequantize(self, dtype=torch.float32):
+        self._unpack_cpu_int4()
+        if self.bits == 8:
+            return self.qweight.to(dtype) * self.scales.to(dtype)[:, None]
+        # unpack straight into the output, then scale and shift in place
+        weight = torch.empty(self.out_features, self.in_features, dtype=dtype, device=self.qweight.device)
+        pairs = weight.view(self.out_features, -1, 2)
+        pairs[..., 0] = self.qweight & 15
+        pairs[..., 1] = self.qweight >> 4
+        groups = weight.view(self.out_features, -1, self.group_size)
+        groups.mul_(self.scales.to(dtype)[..., None]).add_(self.zeros.to(dtype)[..., None])
+        return weight
+
+    def forward(self, x):
+        dtype = self.compute_dtype or x.dtype
+        inp = x.to(dtype)
+        key = (inp.device.type, dtype)
+        if (self.bits == 8 and _int8_mm is not None and key not in _int8_mm_unsupported
+                and not (torch.is_grad_enabled() and inp.requires_grad)):
+            try:
+                out = _int8_mm(inp.reshape(-1, self.in_features).contiguous(), self.qweight, self.scales.to(dtype))
+                out = out.view(*inp.shape[:-1], self.out_features)
+                if self.bias is not None:
+                    out = out + self.bias.to(dtype)
+                return out.to(x.dtype)
+            except RuntimeError as e:
+                _int8_mm_unsupported.add(key)
+                print(f"Warning: torch._weight_int8pack_mm does not support {dtype} on {inp.device.type} ({e}), "
+                      f"int8 layers dequantise their whole weight for every matmul instead, which is slower than "
+                      f"the unquantised model. Set the compute dtype to one the kernel supports (e.g. bfloat16).")
+        if (self.bits == 4 and _int4_mm is not None and key == ("cpu", torch.bfloat16)
+                and dtype not in _int4_mm_unsupported
+                and self.group_size in (32, 64, 128, 256) and not (torch.is_grad_enabled() and inp.requires_grad)):
+            try:
+                out = self._cpu_int4_mm(inp.reshape(-1, self.in_features))
+                out = out.view(*inp.shape[:-1], self.out_features)
+                if self.bias is not None:
+                    out = out + self.bias.to(dtype)
+                return out.to(x.dtype)
+            except RuntimeError as e:
+                self._unpack_cpu_int4()
+                _int4_mm_unsupported.add(dtype)
+                print(f"Warning: torch._weight_int4pack_mm_for_cpu failed ({e}), int4 layers dequantise their whole "
+                      f"weight for every matmul instead, which is slower than the unquantised model.")
+        bias = None if self.bias is None else self.bias.to(dtype)
+        return F.linear(inp, self.dequantize(dtype), bias).to(x.dtype)
+
+    @torch.no_grad()
+    def _cpu_int4_mm(self, inp):
+        pad = -self.out_features % 16  # rows of zeros up to the multiple of 16 the kernel needs
+        if not self.cpu_int4_packed:
+            q = torch.stack([self.qweight & 15, self.qweight >> 4], dim=-1).view(self.out_features, -1)
+            q = F.pad(q, (0, 0, 0, pad))
+            packed = _int4_pack(q.int(), 1)
+            if not torch.equal(_unpack_int4_cpu(packed, len(q), self.in_features), q):
+                raise RuntimeError("unknown packing, _unpack_int4_cpu() cannot convert it back")
+            self.qweight = packed
+            self.cpu_int4_packed = True
+        if inp.dtype not in self._scales_and_zeros:
+            # the kernel computes (q - 8) * scale + zero
+            scales_and_zeros = torch.stack([self.scales.t(), (self.zeros + 8 * self.scales).t()], dim=-1)
+            self._scales_and_zeros[inp.dtype] = F.pad(scales_and_zeros, (0, 0, 0, pad)).to(inp.dtype).contiguous()
+        out = _int4_mm(inp.contiguous(), self.qweight, self.group_size, self._scales_and_zeros[inp.dtype])
+        return out[:, :self.out_features]
+
+    @torch.no_grad()
+    def _unpack_cpu_int4(self):
+        if not self.cpu_int4_packed:
+            return
+        rows = self.out_features + -self.out_features % 16
+        q = _unpack_int4_cpu(self.qweight, rows, self.in_features)[:self.out_features]
+        self.qweight = q[:, 0::2] | (q[:, 1::2] << 4)
+        self.cpu_int4_packed = False
+
+    def _apply(self, fn, *args, **kwargs):
+        self._unpack_cpu_int4()
+        self._scales_and_zeros = {}
+        return super()._apply(fn, *args, **kwargs)
+
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        self._unpack_cpu_int4()
+        super()._save_to_state_dict(destination, prefix, keep_vars)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        self._unpack_cpu_int4()
+        self._scales_and_zeros = {}
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def extra_repr(self):
+        return (f"in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}, "
+                f"bits={self.bits}" + (f", group_size={self.group_size}" if self.bits == 4 else ""))
+
+
+def quantize_(model, bits=8, group_size=128, targets=QUANT_TARGETS, compute_dtype=None, empty=False):
+    """Replace the nn.Linear children of model named in targets by QuantLinear, in place. With empty=True the
+    layers are only allocated (e.g. before loading a state dict saved by save_quantized())."""
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if name in targets and isinstance(child, nn.Linear):
+                setattr(module, name, QuantLinear.from_linear(child, bits, group_size, compute_dtype, empty))
+    return model
+
+
+def quantization_config(model):
+    """Arguments of quantize_() that rebuild the QuantLinear layers of model, None if it has none."""
+    layers = [(name.split(".")[-1], module) for name, module in model.named_modules()
+              if isinstance(module, QuantLinear)]
+    if not layers:
+        return None
+    names = {name for name, _ in layers}
+    # layers narrower than the group size use a single group
+    return {"bits": layers[0][1].bits, "group_size": max(layer.group_size for _, layer in layers),
+            "targets": tuple(name for name in QUANT_TARGETS if name in names)}
+
+
+def save_quantized(model, path):
+    """Checkpoint in the format of the training checkpoints ({"model": state_dict}) plus the quantisation
+    arguments, which loaders pass to quantize(..., empty=True) before load_state_dict()."""
+    torch.save({"model": model.state_dict(), "quantization": quantization_config(model)}, path)
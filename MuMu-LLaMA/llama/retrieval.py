@@ -0,0 +1,212 @@
+import json
+import os
+import time
+
+import numpy as np
+import torch
+
+MODALITIES = ("audio", "image", "video")
+INDEX_TYPES = ("flat", "ivf", "hnsw", "pq", "ivfpq")
+LEGACY_INDEX_URL = "https://huggingface.co/csuhan/knn/resolve/main/knn.index"
+
+
+def index_factory_string(index_type, num_prototypes, nlist=None, pq_m=16, hnsw_m=32):
+    """faiss.index_factory() description of index_type for num_prototypes vectors. nlist defaults to about
+    4 sqrt(N) inverted lists, at most N / 39 (faiss wants 39 training points per centroid)."""
+    if nlist is None:
+        nlist = max(1, min(int(4 * num_prototypes ** 0.5), num_prototypes // 39))
+    return {
+        "flat": "Flat",
+        "ivf": f"IVF{nlist},Flat",
+        "hnsw": f"HNSW{hnsw_m},Flat",
+        "pq": f"PQ{pq_m}",
+        "ivfpq": f"IVF{nlist},PQ{pq_m}",
+    }[index_type]
+
+
+def build_faiss_index(prototypes, index_type="flat", nlist=None, pq_m=16, hnsw_m=32, train_size=None, seed=0):
+    """A trained faiss index (inner product) over prototypes ([N, D] float32). train_size caps the number of
+    prototypes IVF/PQ are trained on."""
+    import faiss
+    description = index_factory_string(index_type, len(prototypes), nlist, pq_m, hnsw_m)
+    index = faiss.index_factory(prototypes.shape[1], description, faiss.METRIC_INNER_PRODUCT)
+    if not index.is_trained:
+        train = prototypes
+        if train_size is not None and train_size < len(prototypes):
+            train = prototypes[np.random.default_rng(seed).choice(len(prototypes), train_size, replace=False)]
+        index.train(np.ascontiguousarray(train, dtype=np.float32))
+    for start in range(0, len(prototypes), 2 ** 16):
+        index.add(np.ascontiguousarray(prototypes[start:start + 2 ** 16], dtype=np.float32))
+    return index
+
+
+class PrototypeIndex:
+    """kNN retrieval over a set of prototype features.
+
+    The prototypes are kept as one [N, D] array (memory-mapped from prototypes.npy when loaded), so the
+    neighbours of a whole batch are gathered with a single indexing op instead of one reconstruct() per id, and
+    their similarities are recomputed exactly from them. Search goes through a faiss index (IVF/HNSW/PQ for
+    large prototype sets); without one it is an exact matmul + topk in torch on the prototypes' device. With
+    rerank > 1 the index returns rerank * k candidates, which are reordered by their exact similarity (for PQ,
+    whose scores are approximate).
+    """
+
+    def __init__(self, prototypes, index=None, device="cpu", nprobe=None, ef_search=None, rerank=1, meta=None):
+        self.prototypes = torch.from_numpy(prototypes) if isinstance(prototypes, np.ndarray) else prototypes
+        if str(device) != "cpu":
+            self.prototypes = self.prototypes.to(device)
+        self.index = index
+        self.rerank = rerank
+        self.meta = meta or {}
+        self.set_search_params(nprobe, ef_search)
+        self.searches = 0
+        self.queries = 0
+        self.search_seconds = 0.
+
+    @property
+    def num_prototypes(self):
+        return self.prototypes.shape[0]
+
+    @property
+    def dim(self):
+        return self.prototypes.shape[1]
+
+    def set_search_params(self, nprobe=None, ef_search=None):
+        if self.index is None:
+            return
+        import faiss
+        if nprobe is not None:
+            try:
+                faiss.extract_index_ivf(self.index).nprobe = nprobe
+            except RuntimeError:
+                pass  # not an IVF index
+        index = faiss.downcast_index(self.index)
+        if ef_search is not None and hasattr(index, "hnsw"):
+            index.hnsw.efSearch = ef_search
+
+    @classmethod
+    def build(cls, prototypes, index_type="flat", device="cpu", nprobe=None, ef_search=None, rerank=1, **kwargs):
+        prototypes = np.ascontiguousarray(prototypes, dtype=np.float32)
+        index = None if index_type == "flat" else build_faiss_index(prototypes, index_type, **kwargs)
+        return cls(prototypes, index, device, nprobe, ef_search, rerank,
+                   meta={"index_type": index_type, "nprobe": nprobe, "ef_search": ef_search, "rerank": rerank,
+                         **kwargs})
+
+    @classmethod
+    def from_faiss(cls, index, device="cpu", nprobe=None, ef_search=None, rerank=1):
+        # prototypes of an index written elsewhere (e.g. the original knn.index), reconstructed in one call
+        return cls(index.reconstruct_n(0, index.ntotal), index, device, nprobe, ef_search, rerank,
+                   meta={"index_type": type(index).__name__})
+
+    @classmethod
+    def load(cls, directory, device="cpu", nprobe=None, ef_search=None, rerank=None, mmap=True):
+        """Load an index written by save() (see build_knn_index.py)."""
+        with open(os.path.join(directory, "meta.json"), "r") as f:
+            meta = json.load(f)
+        prototypes = np.load(os.path.join(directory, "prototypes.npy"), mmap_mode="c" if mmap else None)
+        index = None
+        if os.path.exists(os.path.join(directory, "index.faiss")):
+            import faiss
+            index = faiss.read_index(os.path.join(directory, "index.faiss"))
+        nprobe = meta.get("nprobe") if nprobe is None else nprobe
+        ef_search = meta.get("ef_search") if ef_search is None else ef_search
+        rerank = meta.get("rerank", 1) if rerank is None else rerank
+        return cls(prototypes, index, device, nprobe, ef_search, rerank, meta)
+
+    def save(self, directory, **meta):
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, "prototypes.npy"), self.prototypes.cpu().numpy())
+        if self.index is not None:
+            import faiss
+            faiss.write_index(self.index, os.path.join(directory, "index.faiss"))
+        self.meta = {**self.meta, **meta, "num_prototypes": self.num_prototypes, "dim": self.dim}
+        with open(os.path.join(directory, "meta.json"), "w") as f:
+            json.dump(self.meta, f, indent=2)
+
+    @torch.no_grad()
+    def search(self, queries, k):
+        """Ids ([B, k] long, -1 where the index found fewer than k neighbours) of the k prototypes with the
+        largest inner product with each query ([B, D]), on the prototypes' device."""
+        assert queries.shape[-1] == self.dim, \
+            f"Queries of dimension {queries.shape[-1]} for a kNN index of dimension {self.dim}"
+        start = time.perf_counter()
+        if self.index is None:
+            sims = queries.to(self.prototypes.device, self.prototypes.dtype) @ self.prototypes.T
+            ids = sims.topk(min(k, self.num_prototypes), dim=-1).indices
+        else:
+            _, ids = self.index.search(np.ascontiguousarray(queries.detach().float().cpu().numpy()), k * self.rerank)
+            ids = torch.from_numpy(ids).to(self.prototypes.device)
+            if self.rerank > 1:
+                sims = torch.einsum("bd,bkd->bk", queries.to(self.prototypes.device, self.prototypes.dtype),
+                                    self.reconstruct(ids))
+                sims = sims.masked_fill(ids < 0, float("-inf"))
+                ids = ids.gather(1, sims.topk(k, dim=-1).indices)
+        self.searches += 1
+        self.queries += queries.shape[0]
+        self.search_seconds += time.perf_counter() - start
+        return ids
+
+    def reconstruct(self, ids):
+        """The prototypes of ids ([B, k]) as one [B, k, D] tensor; ids of -1 give prototype 0."""
+        return self.prototypes[ids.clamp(min=0)]
+
+    def mix(self, feats, k, temperature=20, weight=0.5):
+        """feats ([B, D]) mixed with the softmax(temperature * similarity) weighted average of their k nearest
+        prototypes, with weight for the prototypes; the average and the result are L2 normalised."""
+        ids = self.search(feats, k)
+        prototypes = self.reconstruct(ids).to(feats.device, feats.dtype)  # [B, k, D]
+        sims = torch.einsum("bd,bkd->bk", feats, prototypes)
+        sims = sims.masked_fill(ids.to(feats.device) < 0, float("-inf"))
+        retrieved = (sims * temperature).softmax(dim=-1).unsqueeze(1) @ prototypes
+        retrieved = retrieved.squeeze(1)
+        retrieved = retrieved / retrieved.norm(dim=-1, keepdim=True)
+        feats = (1 - weight) * feats + weight * retrieved
+        return feats / feats.norm(dim=-1, keepdim=True)
+
+    def memory_bytes(self):
+        """Bytes of the prototypes (on disk when memory-mapped) and of the faiss index."""
+        index_bytes = 0
+        if self.index is not None:
+            import faiss
+            index_bytes = faiss.serialize_index(self.index).nbytes
+        return {"prototypes": self.prototypes.numel() * self.prototypes.element_size(), "index": index_bytes}
+
+    def stats(self):
+        return {"index_type": self.meta.get("index_type"), "num_prototypes": self.num_prototypes, "dim": self.dim,
+                "searches": self.searches, "queries": self.queries, "search_seconds": self.search_seconds,
+                **{f"{k}_bytes": v for k, v in self.memory_bytes().items()}}
+
+
+def load_knn_indexes(knn_dir, device="cpu", nprobe=None, ef_search=None, rerank=None):
+    """{modality: PrototypeIndex}: knn_dir/<modality> where build_knn_index.py wrote one, else the original
+    knn.index (downloaded to knn_dir), shared by the remaining modalities."""
+    indexes = {}
+    for modality in MODALITIES:
+        if os.path.exists(os.path.join(knn_dir, modality, "meta.json")):
+            indexes[modality] = PrototypeIndex.load(os.path.join(knn_dir, modality), device, nprobe, ef_search,
+                                                    rerank)
+    missing = [modality for modality in MODALITIES if modality not in indexes]
+    if missing:
+        import faiss
+        from util.misc import download
+        legacy = PrototypeIndex.from_faiss(faiss.read_index(download(LEGACY_INDEX_URL, knn_dir)), device,
+                                           nprobe, ef_search, rerank or 1)
+        indexes.update({modality: legacy for modality in missing})
+    return indexes
+
+
+@torch.no_grad()
+def evaluate_index(index, reference, queries, k=10, batch_size=16, temperature=20, weight=0.5):
+    """Compare index with reference (usually the exact index over the same prototypes) on queries ([Q, D]):
+    recall@k of the neighbour ids, largest difference of mix() and the mean search + mix time per batch."""
+    hits, max_diff, seconds = 0, 0., 0.
+    for start in range(0, len(queries), batch_size):
+        batch = queries[start:start + batch_size]
+        t = time.perf_counter()
+        mixed = index.mix(batch, k, temperature, weight)
+        seconds += time.perf_counter() - t
+        ids, expected = index.search(batch, k), reference.search(batch, k)
+        hits += sum(len(set(a) & set(b)) for a, b in zip(ids.tolist(), expected.tolist()))
+        max_diff = max(max_diff, (mixed - reference.mix(batch, k, temperature, weight)).abs().max().item())
+    num_batches = -(-len(queries) // batch_size)
+    return {"recall": hits / (len(queries) * k), "max_mix_diff": max_diff, "ms_per_batch": seconds / num_batches * 1e3}
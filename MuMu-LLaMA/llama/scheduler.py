@@ -0,0 +1,446 @@
+import itertools
+import threading
+import time
+from collections import deque
+from typing import List, Optional
+
+import torch
+
+from .utils import IncrementalDetokenizer
+from .sampling import sample
+from .stopping import DEFAULT_STOP_STRINGS, MAX_STOP_STRINGS, get_stop_matcher
+
+
+class GenerationRequest:
+    """A single prompt submitted to a Scheduler. Use result() to wait for the answer."""
+
+    WAITING, RUNNING, FINISHED, CANCELLED = "waiting", "running", "finished", "cancelled"
+
+    def __init__(self, request_id, prompt: List[int], audio=None, image=None, video=None, max_gen_len=256,
+                 temperature=0.1, top_p=0.75, audio_length_in_s=10, decode_music=True, stop_strings=(),
+                 top_k=0, repetition_penalty=1.0):
+        self.request_id = request_id
+        self.prompt = list(prompt)
+        self.audio = audio
+        self.image = image
+        self.video = video
+        self.max_gen_len = max_gen_len
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self.repetition_penalty = repetition_penalty
+        self.audio_length_in_s = audio_length_in_s
+        self.decode_music = decode_music
+        self.stop_strings = tuple(stop_strings)
+        # state in, and bitmask of stop_strings over, the stop matcher of the running batch (Scheduler)
+        self.stop_state = 0
+        self.stop_mask = None
+
+        self.state = self.WAITING
+        self.seq_id = None
+        self.tokens = []
+        self.feats = (None, None, None)
+        self.adapters = None
+        self.gather = 0
+        self.music_output_embeddings = []
+        self.text = None
+        self.music_output_embedding = None
+        self.submit_time = time.time()
+        self.first_token_time = None
+        self.finish_time = None
+        self._done = threading.Event()
+        self._progress = threading.Event()
+
+    @property
+    def num_tokens(self):
+        return len(self.prompt) + len(self.tokens)
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def _finish(self, state):
+        self.state = state
+        self.finish_time = time.time()
+        self._done.set()
+        self._progress.set()
+
+
+class Scheduler:
+    """Continuous batching around the MuMu_LLaMA decode loop.
+
+    Requests are admitted into the running batch at any decode step as long as fewer than max_batch_size
+    requests run and the paged KV cache of the model has budget for prompt + max_gen_len tokens. They are
+    prefilled on their own and then decoded together with the other running requests, one token per step.
+    Finished or cancelled requests leave the batch right away and return their KV blocks. Stop strings are
+    matched for the whole batch in one step of a matcher compiled over the union of the running requests'
+    stop strings, each row masked to its own. Music decoding of a
+    finished request happens in the thread that calls result(), so it never stalls the decode loop; it is
+    serialised by a lock, as the music decoder (its AudioLDM2 scheduler, the swapped sampler profile) is shared
+    by all callers.
+    """
+
+    def __init__(self, model, max_batch_size: Optional[int] = None, max_queue_size: int = 1024,
+                 stats_window: float = 10.0):
+        self.model = model
+        params = model.llama.params
+        self.max_batch_size = max_batch_size or params.max_batch_size
+        self.max_queue_size = max_queue_size
+        self.kv_cache = model.llama.kv_cache
+
+        self.waiting = deque()
+        self.running = []
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._music_lock = threading.Lock()
+        # step() is driven by the decode thread or, without one, by every caller of result()/stream()
+        self._step_lock = threading.Lock()
+        self._thread = None
+        self._stop = False
+        self._adapters_key = None
+        self._adapters = None
+        self._stop_matcher = None
+
+        self.stats_window = stats_window
+        self._token_times = deque()
+        self.num_generated_tokens = 0
+        self.num_finished = 0
+
+    # ---------------------------------------------------------------- public API
+    def submit(self, prompt, audio=None, image=None, video=None, max_gen_len=256, temperature=0.1, top_p=0.75,
+               audio_length_in_s=10, decode_music=True, stop_strings=DEFAULT_STOP_STRINGS, top_k=0,
+               repetition_penalty=1.0):
+        if isinstance(prompt, str):
+            prompt = self.model.tokenizer(prompt).input_ids
+        max_seq_len = self.model.llama.params.max_seq_len
+        if len(prompt) >= max_seq_len:
+            raise ValueError(f"Prompt of {len(prompt)} tokens does not fit max_seq_len={max_seq_len}")
+        if len(set(stop_strings)) > MAX_STOP_STRINGS:
+            raise ValueError(f"At most {MAX_STOP_STRINGS} stop strings per request, got {len(set(stop_strings))}")
+        request = GenerationRequest(next(self._ids), prompt, audio, image, video,
+                                    min(max_gen_len, max_seq_len - len(prompt)), temperature, top_p,
+                                    audio_length_in_s, decode_music, stop_strings, top_k, repetition_penalty)
+        with self._lock:
+            if len(self.waiting) >= self.max_queue_size:
+                raise RuntimeError(f"Scheduler queue is full ({self.max_queue_size} waiting requests)")
+            self.waiting.append(request)
+        self._wakeup.set()
+        return request
+
+    def cancel(self, request: GenerationRequest):
+        with self._lock:
+            if request.done():
+                return False
+            if request in self.waiting:
+                self.waiting.remove(request)
+                request._finish(GenerationRequest.CANCELLED)
+            else:
+                # removed from the running batch at the next step
+                request.state = GenerationRequest.CANCELLED
+        return True
+
+    def result(self, request: GenerationRequest, timeout=None):
+        """Wait for request and return it in the generate() format, or None if it was cancelled."""
+        # without a decode thread (start()) the caller drives the decode loop
+        while self._thread is None and not request.done():
+            self.step()
+        if not request.wait(timeout):
+            raise TimeoutError(f"Request {request.request_id} did not finish within {timeout}s")
+        if request.state == GenerationRequest.CANCELLED:
+            return None
+        if request.music_output_embedding is None:
+            return [request.text]
+        music = {'emb': request.music_output_embedding}
+        if request.decode_music:
+            music['aud'] = [self._generate_music(request)]
+        return [request.text, music]
+
+    def generate(self, prompt, **kwargs):
+        return self.result(self.submit(prompt, **kwargs))
+
+    def _generate_music(self, request):
+        with self._music_lock:
+            return self.model.generate_music(request.music_output_embedding, request.audio_length_in_s, request.text)
+
+    def stream(self, prompt, **kwargs):
+        """Like generate(), but yields events while the answer is generated:
+
+            {'type': 'text', 'text': increment}     as tokens are sampled
+            {'type': 'music_pending'}               the answer asks for music, decoding starts
+            {'type': 'audio', 'audio': audio}       the decoded music
+            {'type': 'done', 'result': result}      result in the generate() format
+
+        The text increments add up to the final text. Without a running decode thread (start()), the decode
+        loop is driven from here (by one caller at a time). Closing the generator early cancels the request.
+        """
+        request = self.submit(prompt, **kwargs)
+        detokenizer = IncrementalDetokenizer(self.model.tokenizer)
+        stop_tokens = (13, self.model.tokenizer.eos_token_id)
+        seen, text_done = 0, False
+        try:
+            while True:
+                if self._thread is None:
+                    if not request.done():
+                        self.step()
+                else:
+                    request._progress.wait()
+                    request._progress.clear()
+                finished = request.done()
+                tokens = request.tokens[seen:]
+                seen += len(tokens)
+                for token in tokens:
+                    # same cut as the final text
+                    text_done = text_done or token in stop_tokens
+                    if text_done:
+                        break
+                    text = detokenizer.add(token)
+                    if text:
+                        yield {'type': 'text', 'text': text}
+                if finished:
+                    break
+        finally:
+            if not request.done():
+                self.cancel(request)
+        if request.state == GenerationRequest.CANCELLED:
+            return
+        text = detokenizer.flush()
+        if text:
+            yield {'type': 'text', 'text': text}
+
+        if request.music_output_embedding is None:
+            yield {'type': 'done', 'result': [request.text]}
+            return
+        music = {'emb': request.music_output_embedding}
+        if request.decode_music:
+            yield {'type': 'music_pending'}
+            music['aud'] = [self._generate_music(request)]
+            yield {'type': 'audio', 'audio': music['aud'][0]}
+        yield {'type': 'done', 'result': [request.text, music]}
+
+    @property
+    def queue_depth(self):
+        return len(self.waiting)
+
+    @property
+    def num_running(self):
+        return len(self.running)
+
+    def _evict_token_times(self, now):
+        while self._token_times and self._token_times[0][0] < now - self.stats_window:
+            self._token_times.popleft()
+
+    @property
+    def tokens_per_second(self):
+        now = time.time()
+        self._evict_token_times(now)
+        if not self._token_times:
+            return 0.0
+        span = max(now - self._token_times[0][0], 1e-6)
+        return sum(n for _, n in self._token_times) / span
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue_depth,
+            'running': self.num_running,
+            'free_kv_blocks': self.kv_cache.num_free_blocks,
+            'kv_cache_bytes': self.kv_cache.memory_bytes,
+            'prefix_hit_rate': self.kv_cache.prefix_hit_tokens / max(self.kv_cache.prefix_query_tokens, 1),
+            'tokens_per_s': self.tokens_per_second,
+            'generated_tokens': self.num_generated_tokens,
+            'finished_requests': self.num_finished,
+            'feature_cache': None if self.model.feature_cache is None else self.model.feature_cache.stats(),
+            'components': self.model.components.stats(),
+        }
+
+    def start(self):
+        if self._thread is None:
+            self._stop = False
+            self._thread = threading.Thread(target=self._loop, name="mumu-llama-scheduler", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        # the KV cache is shared with the model: shrink it only if nobody else holds blocks
+        if not self.kv_cache.block_tables:
+            self.kv_cache.release()
+
+    def run_until_complete(self):
+        while self.waiting or self.running:
+            self.step()
+
+    # ---------------------------------------------------------------- decode loop
+    def _loop(self):
+        while not self._stop:
+            if not self.waiting and not self.running:
+                self._wakeup.wait(0.1)
+                self._wakeup.clear()
+                continue
+            self.step()
+
+    @torch.inference_mode()
+    def step(self):
+        """Admit waiting requests, then advance every running request by one token."""
+        with self._step_lock:
+            self._drop_cancelled()
+            self._admit()
+            if not self.running:
+                return
+            self._decode()
+            self._drop_cancelled()
+
+    def _drop_cancelled(self):
+        with self._lock:
+            for request in [r for r in self.running if r.state == GenerationRequest.CANCELLED]:
+                self._release(request, GenerationRequest.CANCELLED)
+
+    def _admit(self):
+        while True:
+            with self._lock:
+                if not self.waiting:
+                    return
+                request = self.waiting[0]
+                if len(self.running) >= self.max_batch_size or \
+                        not self.kv_cache.can_allocate(len(request.prompt) + request.max_gen_len) or \
+                        len(self._stop_strings(self.running + [request])) > MAX_STOP_STRINGS:
+                    return
+                self.waiting.popleft()
+                request.seq_id = self.kv_cache.allocate(len(request.prompt) + request.max_gen_len)
+                request.state = GenerationRequest.RUNNING
+                self.running.append(request)
+            self._prefill(request)
+
+    def _prefill(self, request):
+        model = self.model
+        with torch.cuda.amp.autocast():
+            request.feats = tuple(
+                None if x is None else fn({modality: [[x], 1]})
+                for fn, modality, x in ((model.forward_audio, 'Audio', request.audio),
+                                        (model.forward_image, 'Image', request.image),
+                                        (model.forward_video, 'Video', request.video)))
+            request.adapters = model.project_adapters(*request.feats)
+        fingerprint = model.prefix_fingerprint(*request.feats)
+        cached = self.kv_cache.match_prefix(request.seq_id, request.prompt, fingerprint)
+        tokens = torch.tensor([request.prompt[cached:]], dtype=torch.long, device=model.device)
+        start_pos = torch.tensor([cached], dtype=torch.long, device=model.device)
+        self._forward_and_sample([request], tokens, start_pos,
+                                 on_forward=lambda: self.kv_cache.cache_prefix(request.seq_id, request.prompt,
+                                                                               fingerprint))
+
+    def _decode(self):
+        model = self.model
+        tokens = torch.tensor([[r.tokens[-1]] for r in self.running], dtype=torch.long, device=model.device)
+        start_pos = torch.tensor([r.num_tokens - 1 for r in self.running], dtype=torch.long, device=model.device)
+        self._forward_and_sample(list(self.running), tokens, start_pos)
+
+    def _stack_adapters(self, requests):
+        # projected once per request at prefill; restacked only when the running batch changes
+        key = tuple(r.request_id for r in requests)
+        if key != self._adapters_key:
+            self._adapters_key = key
+            self._adapters = [tuple(None if xs[0] is None else torch.cat(xs) for xs in zip(*layer))
+                              for layer in zip(*[r.adapters for r in requests])]
+        return self._adapters
+
+    @staticmethod
+    def _stop_strings(requests):
+        return tuple(sorted(set().union(*(r.stop_strings for r in requests))))
+
+    def _batch_stop_matcher(self):
+        # recompiled (cached by get_stop_matcher) when the union of the running requests' stop strings
+        # changes; the states of the running requests are then recomputed from their generated tokens
+        stop_strings = self._stop_strings(self.running)
+        if self._stop_matcher is None or stop_strings != self._stop_matcher.stop_strings:
+            self._stop_matcher = get_stop_matcher(self.model.tokenizer, stop_strings)
+            for request in self.running:
+                request.stop_mask = None
+        matcher = self._stop_matcher
+        for request in self.running:
+            if request.stop_mask is None:
+                request.stop_mask = matcher.mask(request.stop_strings)
+                request.stop_state = matcher.initial_state()
+                for token in request.tokens:
+                    request.stop_state, _ = matcher.advance(request.stop_state, token)
+        return matcher
+
+    def _forward_and_sample(self, requests, tokens, start_pos, on_forward=None):
+        model = self.model
+        with torch.cuda.amp.autocast():
+            logits, music_output_embedding = model.forward_inference(tokens, start_pos,
+                                                                     seq_ids=[r.seq_id for r in requests],
+                                                                     adapters=self._stack_adapters(requests))
+        if on_forward is not None:
+            on_forward()
+
+        device = logits.device
+        prev_tokens, repetition_penalty = None, 1.0
+        if any(r.repetition_penalty != 1.0 for r in requests):
+            # pad with each request's last token, penalising a token twice has no further effect
+            history = [r.prompt + r.tokens for r in requests]
+            n = max(len(h) for h in history)
+            prev_tokens = torch.tensor([h + h[-1:] * (n - len(h)) for h in history], device=device)
+            repetition_penalty = torch.tensor([r.repetition_penalty for r in requests], device=device)
+        next_token = sample(logits, torch.tensor([r.temperature for r in requests], device=device),
+                            torch.tensor([r.top_p for r in requests], device=device),
+                            torch.tensor([r.top_k for r in requests], device=device),
+                            repetition_penalty, prev_tokens)
+        stop_state, stop_hit = self._batch_stop_matcher().step(
+            torch.tensor([r.stop_state for r in requests], device=device), next_token,
+            torch.tensor([r.stop_mask for r in requests], device=device))
+
+        now = time.time()
+        self._token_times.append((now, len(requests)))
+        self._evict_token_times(now)
+        self.num_generated_tokens += len(requests)
+        # one transfer to the host for the tokens and the stop states of the whole batch
+        results = torch.stack([next_token, stop_state, stop_hit.long()], dim=1).tolist()
+        for i, (request, (token, stop_state, hit)) in enumerate(zip(requests, results)):
+            request.stop_state = stop_state
+            if request.first_token_time is None:
+                request.first_token_time = now
+            request.tokens.append(token)
+            request._progress.set()
+            if self._is_finished(request, token, music_output_embedding[i, -1:, :], hit):
+                with self._lock:
+                    self._release(request, GenerationRequest.FINISHED)
+
+    def _is_finished(self, request, token, hidden, stop_hit):
+        model = self.model
+        stop = token == model.tokenizer.eos_token_id or stop_hit != 0
+        if token == model.audio_tokens[request.gather]:
+            if request.gather == 0:
+                request.music_output_embeddings = []
+            request.music_output_embeddings.append(hidden)
+            request.gather += 1
+            if request.gather >= len(model.audio_tokens):
+                request.gather = 0
+                stop = True
+        return stop or len(request.tokens) >= request.max_gen_len
+
+    def _release(self, request, state):
+        if request in self.running:
+            self.running.remove(request)
+        if request.seq_id is not None:
+            self.kv_cache.free(request.seq_id)
+            request.seq_id = None
+        request.feats = (None, None, None)
+        request.adapters = None
+        if state == GenerationRequest.FINISHED:
+            t = request.tokens
+            # cut to eos tok if any
+            for stop_token in (13, self.model.tokenizer.eos_token_id):
+                if stop_token in t:
+                    t = t[: t.index(stop_token)]
+            request.text = self.model.tokenizer.decode(t)
+            if len(request.music_output_embeddings) == len(self.model.audio_tokens):
+                request.music_output_embedding = torch.cat(request.music_output_embeddings, dim=1)
+            self.num_finished += 1
+        request.music_output_embeddings = []
+        request._finish(state)
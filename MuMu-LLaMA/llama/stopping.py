@@ -0,0 +1,117 @@
+import functools
+import re
+from collections import deque
+
+import numpy as np
+import torch
+
+DEFAULT_STOP_STRINGS = ("\n###",)
+MAX_STOP_STRINGS = 63  # matches are bitmasks in int64
+
+_BYTE_PIECE = re.compile(r"^<0x([0-9A-Fa-f]{2})>$")
+
+
+def token_bytes(tokenizer):
+    """UTF-8 bytes every token id contributes to the decoded text (byte-fallback pieces are single bytes)."""
+    pieces = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+    out = []
+    for piece in pieces:
+        match = _BYTE_PIECE.match(piece)
+        out.append(bytes([int(match.group(1), 16)]) if match else piece.replace("▁", " ").encode("utf-8"))
+    return out
+
+
+class StopSequenceMatcher:
+    """Detects stop strings in generated text from token ids alone.
+
+    An Aho-Corasick automaton is built over the UTF-8 bytes of the stop strings and then lifted to tokens:
+    next_state[s, t] is the state after feeding all bytes of token t from state s, and matches[s, t] is a
+    bitmask of the stop strings completed on the way. A stop string is therefore found however it is split
+    into tokens, including byte-fallback tokens and tokens that reach past either end of it. Only tokens
+    containing a byte of some stop string need to be simulated, all others lead back to the root.
+
+    Both tables live on the device of the generation loop, so advancing a whole batch is one gather
+    (step()); advance() does the same on the host for loops that already have their tokens there.
+    """
+
+    def __init__(self, tokenizer, stop_strings=DEFAULT_STOP_STRINGS):
+        self.stop_strings = tuple(stop_strings)
+        assert len(self.stop_strings) <= MAX_STOP_STRINGS, f"at most {MAX_STOP_STRINGS} stop strings"
+        goto, fail, output = [{}], [0], [0]
+        for i, stop in enumerate(self.stop_strings):
+            state = 0
+            for byte in stop.encode("utf-8"):
+                if byte not in goto[state]:
+                    goto.append({})
+                    fail.append(0)
+                    output.append(0)
+                    goto[state][byte] = len(goto) - 1
+                state = goto[state][byte]
+            output[state] |= 1 << i
+
+        # byte level transition function, breadth first so that fail links are final when used
+        num_states = len(goto)
+        delta = np.zeros((num_states, 256), dtype=np.int64)
+        queue = deque()
+        for byte, state in goto[0].items():
+            delta[0, byte] = state
+            queue.append(state)
+        while queue:
+            state = queue.popleft()
+            output[state] |= output[fail[state]]
+            delta[state] = delta[fail[state]]
+            for byte, child in goto[state].items():
+                fail[child] = delta[fail[state], byte] if state else 0
+                delta[state, byte] = child
+                queue.append(child)
+
+        alphabet = set(b"".join(s.encode("utf-8") for s in self.stop_strings))
+        next_state = np.zeros((num_states, len(tokenizer)), dtype=np.int64)
+        matches = np.zeros((num_states, len(tokenizer)), dtype=np.int64)
+        for token, data in enumerate(token_bytes(tokenizer)):
+            if not alphabet.intersection(data):
+                continue
+            for start in range(num_states):
+                state, hit = start, 0
+                for byte in data:
+                    state = delta[state, byte]
+                    hit |= output[state]
+                next_state[start, token] = state
+                matches[start, token] = hit
+
+        self.num_states = num_states
+        self._next_state = next_state
+        self._matches = matches
+        self._device_tables = {}
+
+    def initial_state(self, bsz=None, device=None):
+        if bsz is None:
+            return 0
+        return torch.zeros(bsz, dtype=torch.long, device=device)
+
+    def advance(self, state: int, token: int):
+        """Host version of step() for a single sequence: (new state, bitmask of matched stop strings)."""
+        return int(self._next_state[state, token]), int(self._matches[state, token])
+
+    def step(self, state: torch.Tensor, tokens: torch.Tensor, stop_mask=None):
+        """state, tokens: [bsz]. Returns the new states and whether each row completed a stop string.
+        stop_mask ([bsz] bitmask over stop_strings) restricts the stop strings each row listens to."""
+        device = tokens.device
+        if device not in self._device_tables:
+            self._device_tables[device] = (torch.from_numpy(self._next_state).to(device),
+                                           torch.from_numpy(self._matches).to(device))
+        next_state, matches = self._device_tables[device]
+        hit = matches[state, tokens]
+        if stop_mask is not None:
+            hit = hit & stop_mask
+        return next_state[state, tokens], hit != 0
+
+    def mask(self, stop_strings):
+        """Bitmask selecting stop_strings (all of which have to be compiled into this matcher)."""
+        return sum(1 << self.stop_strings.index(s) for s in set(stop_strings))
+
+
+@functools.lru_cache(maxsize=32)
+def get_stop_matcher(tokenizer, stop_strings=DEFAULT_STOP_STRINGS):
+    """Compiled matchers are cached per tokenizer and tuple of stop strings."""
+    return StopSequenceMatcher(tokenizer, stop_strings)
@@ -1,4 +1,5 @@
 import torch
+import torch.nn.functional as F
 
 
 def sample_top_p(probs, p):
@@ -12,6 +13,20 @@ def sample_top_p(probs, p):
     return next_token
 
 
+def sampling_probs(logits, temperature, top_p):
+    """The distribution sample_top_p(softmax(logits / temperature), top_p) draws from, over the full vocab.
+    Greedy decoding (temperature 0) is the one-hot distribution of the argmax."""
+    if temperature <= 0:
+        return F.one_hot(logits.argmax(dim=-1), logits.shape[-1]).to(logits.dtype)
+    probs = torch.softmax(logits / temperature, dim=-1)
+    probs_sort, probs_idx = torch.sort(probs, dim=-1, descending=True)
+    probs_sum = torch.cumsum(probs_sort, dim=-1)
+    mask = probs_sum - probs_sort > top_p
+    probs_sort[mask] = 0.0
+    probs_sort.div_(probs_sort.sum(dim=-1, keepdim=True))
+    return torch.zeros_like(probs).scatter_(-1, probs_idx, probs_sort)
+
+
 def format_prompt(instruction):
 
     PROMPT_DICT = {
@@ -23,3 +38,64 @@ def format_prompt(instruction):
     }
     return PROMPT_DICT["prompt_input"].format_map({'instruction': instruction})
 
+
+
+class IncrementalDetokenizer:
+    """Turns a stream of token ids into text increments that add up to tokenizer.decode() of all tokens.
+
+    Only a short window of tokens is decoded at each step: everything since the last emitted increment plus
+    the tokens before it. Sentencepiece drops the leading whitespace of a decoded sequence, so windows that do
+    not start a segment are decoded behind a fixed anchor token which is cut off again. Text is held back
+    while it ends in an incomplete UTF-8 sequence, e.g. the first byte-fallback token of a character spread
+    over several tokens. Added tokens such as [AUD0] split the text into segments that the tokenizer decodes
+    separately and joins with spaces, which is mirrored here.
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.tokens = []
+        self.segment_start = 0
+        self.prefix_offset = 0
+        self.read_offset = 0
+        self.separator = ""
+        self.anchor = tokenizer("a", add_special_tokens=False).input_ids
+        self.anchor_text = tokenizer.decode(self.anchor)
+        self.added_tokens = {i for t, i in tokenizer.get_added_vocab().items()
+                             if t not in tokenizer.all_special_tokens}
+
+    def _decode(self, start, end=None):
+        if start == self.segment_start:
+            return self.tokenizer.decode(self.tokens[start:end])
+        return self.tokenizer.decode(self.anchor + self.tokens[start:end])[len(self.anchor_text):]
+
+    def _emit(self, text):
+        if text:
+            text, self.separator = self.separator + text, ""
+        return text
+
+    def add(self, token):
+        if token in self.added_tokens:
+            text = self.flush()
+            if self.tokens:
+                self.separator = " "
+            self.tokens.append(token)
+            self.segment_start = self.prefix_offset = self.read_offset = len(self.tokens)
+            text = text + self._emit(self.tokenizer.convert_ids_to_tokens(token))
+            self.separator = " "
+            return text
+
+        self.tokens.append(token)
+        prefix_text = self._decode(self.prefix_offset, self.read_offset)
+        new_text = self._decode(self.prefix_offset)
+        if len(new_text) <= len(prefix_text) or new_text.endswith("\ufffd"):
+            return ""
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.tokens)
+        return self._emit(new_text[len(prefix_text):])
+
+    def flush(self):
+        """Whatever is still held back, e.g. a trailing incomplete character."""
+        prefix_text = self._decode(self.prefix_offset, self.read_offset)
+        new_text = self._decode(self.prefix_offset)
+        self.prefix_offset = self.read_offset = len(self.tokens)
+        return self._emit(new_text[len(prefix_text):])
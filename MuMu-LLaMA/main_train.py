@@ -43,6 +43,16 @@ def get_args_parser():
                         help='path to LLaMA pretrained checkpoint')
     parser.add_argument('--mert_path', default="m-a-p/MERT-v1-330M", type=str,
                         help='path to MERT pretrained checkpoint')
+    parser.add_argument('--disable_components', default=[], nargs='*', choices=['mert', 'vit', 'vivit', 'music_decoder'],
+                        help='pretrained sub-models that are never loaded')
+    parser.add_argument('--preload_components', default=[], nargs='*',
+                        help='sub-models loaded at startup instead of on first use')
+    parser.add_argument('--mert_window_s', default=60, type=float,
+                        help='length of the MERT windows of long audio, in seconds')
+    parser.add_argument('--mert_overlap_s', default=0, type=float,
+                        help='overlap of consecutive MERT windows, in seconds')
+    parser.add_argument('--mert_max_windows', default=4, type=int,
+                        help='maximum number of audio windows per MERT forward pass')
     parser.add_argument('--vit_path', default="google/vit-base-patch16-224-in21k", type=str,
                         help='path to ViT pretrained checkpoint')
     parser.add_argument('--vivit_path', default="google/vivit-b-16x2-kinetics400", type=str,
@@ -71,6 +81,12 @@ def get_args_parser():
                         help='Training stage')
     parser.add_argument('--load_same_stage', action='store_true',
                         help='Load data from same training stage')
+    parser.add_argument('--full_checkpoint', action='store_true',
+                        help='Save the whole model instead of an adapter checkpoint (the trained parameters and '
+                             'a manifest of the frozen base weights)')
+    parser.add_argument('--no_base_hashes', action='store_true',
+                        help='Record only the sizes of the LLaMA shards in the manifest of adapter checkpoints, '
+                             'not their sha256')
 
     # Dataset parameters
     parser.add_argument('--data_config', default='configs/data/pretrain/EN.yaml', type=str,
@@ -143,6 +159,7 @@ def main(args):
         print("Model is parallelizable")
         
     print("Model = %s" % str(model_without_ddp))
+    print(model_without_ddp.components.report())
 
     print("Trainable Params:")
     print([(key, val.shape) for key, val in model.named_parameters() if val.requires_grad])
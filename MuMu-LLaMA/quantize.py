@@ -0,0 +1,148 @@
+"""Weight-only int8/int4 quantisation of a MuMu_LLaMA checkpoint, gated by an accuracy check.
+
+The unquantised model greedily completes a fixed set of prompts; the quantised model is then run on the same
+token sequences and its next-token predictions are compared (top-1 agreement and KL divergence over the
+completions). The quantised checkpoint is only written if both are within the thresholds (or with --force).
+inference.py and gradio_app.py load the result like any other checkpoint.
+
+    python quantize.py --model ./ckpts/checkpoint.pth --llama_dir ./ckpts/LLaMA-2 --bits 8 --output ./ckpts/checkpoint_int8.pth
+"""
+import argparse
+import os
+import sys
+
+import torch
+import torch.nn.functional as F
+
+from llama.mumu_llama import MuMu_LLaMA, is_adapter_checkpoint
+from llama.quantization import save_quantized
+from llama.utils import format_prompt
+
+PROMPTS = [
+    "Describe the music in detail.",
+    "What is the genre and the mood of this song?",
+    "Which instruments can be heard in this piece?",
+    "Generate a music for a calm evening by the sea.",
+    "Write a short description of an upbeat electronic dance track.",
+    "Explain the difference between a major and a minor key.",
+    "Suggest a tempo and a time signature for a waltz.",
+    "Compose a cheerful melody for a children's birthday party.",
+]
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--model", default="./ckpts/checkpoint.pth", type=str,
+    help="Name of or path to MuMu_LLaMA pretrained checkpoint",
+)
+parser.add_argument(
+    "--llama_type", default="7B", type=str,
+    help="Type of llama original weight",
+)
+parser.add_argument(
+    "--llama_dir", default="/path/to/llama", type=str,
+    help="Path to LLaMA pretrained checkpoint",
+)
+parser.add_argument(
+    "--mert_path", default="m-a-p/MERT-v1-330M", type=str,
+    help="Path to MERT pretrained checkpoint",
+)
+parser.add_argument(
+    "--vit_path", default="google/vit-base-patch16-224-in21k", type=str,
+    help="Path to ViT pretrained checkpoint",
+)
+parser.add_argument(
+    "--vivit_path", default="google/vivit-b-16x2-kinetics400", type=str,
+    help="Path to ViViT pretrained checkpoint",
+)
+parser.add_argument(
+    '--music_decoder', default="musicgen", type=str,
+    help='Decoder to use musicgen/audioldm2')
+parser.add_argument(
+    '--music_decoder_path', default="facebook/musicgen-medium", type=str,
+    help='Path to decoder to use musicgen/audioldm2')
+
+parser.add_argument('--bits', default=8, type=int, choices=[8, 4],
+                    help='int8 (per-channel scales) or int4 (group-wise scales/zeros). int4 runs a packed kernel '
+                         'only in bfloat16 on CPU with torch >= 2.6; elsewhere it dequantises the whole weight for '
+                         'every matmul, which only saves memory and is slower than the unquantised model')
+parser.add_argument('--group_size', default=128, type=int, help='Input columns per int4 scale/zero group')
+parser.add_argument('--compute_dtype', default=None, type=str, choices=['float32', 'bfloat16', 'float16'],
+                    help='dtype of the quantised matmuls in the check (default: bfloat16 on CPU, else the '
+                         'activation dtype)')
+parser.add_argument('--output', default=None, type=str, help='Where to write the quantised checkpoint')
+parser.add_argument('--max_gen_len', default=32, type=int, help='Greedy tokens completed per prompt')
+parser.add_argument('--min_top1', default=0.9, type=float,
+                    help='Minimum fraction of completion tokens the quantised model predicts identically')
+parser.add_argument('--max_kl', default=0.1, type=float,
+                    help='Maximum mean KL(unquantised || quantised) of the next-token distributions')
+parser.add_argument('--verify_base_hashes', action='store_true',
+                    help='For adapter checkpoints, compare the sha256 of the LLaMA shards with the ones the adapter '
+                         'was trained on')
+parser.add_argument('--force', action='store_true', help='Write the checkpoint even if the check fails')
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+args = parser.parse_args()
+
+llama_ckpt_dir = os.path.join(args.llama_dir, args.llama_type)
+print("Loading Model Checkpoint")
+checkpoint = torch.load(args.model, map_location='cpu')
+assert checkpoint.get('quantization') is None, f"{args.model} is already quantised"
+# adapter checkpoints only hold what was trained, the LLaMA base weights are loaded from --llama_dir
+adapter = is_adapter_checkpoint(checkpoint)
+model = MuMu_LLaMA(llama_ckpt_dir, args.llama_dir, args, knn=False, stage=3, load_llama=adapter)
+
+new_ckpt = {key.replace("module.", ""): value for key, value in checkpoint['model'].items()}
+if adapter:
+    load_result = model.load_adapter_checkpoint({**checkpoint, 'model': new_ckpt},
+                                                verify_hashes=args.verify_base_hashes)
+else:
+    load_result = model.load_state_dict(new_ckpt, strict=True)
+assert len(load_result.unexpected_keys) == 0, f"Unexpected keys: {load_result.unexpected_keys}"
+del checkpoint, new_ckpt
+model.eval()
+model.to(args.device)
+
+
+@torch.inference_mode()
+def completion_logits(tokens, n_prompt):
+    # next-token logits of the positions that predict the completion, in float32 on the CPU
+    logits, _ = model.forward_inference(tokens, 0, all_logits=True)
+    return logits[0, n_prompt - 1:-1].float().cpu()
+
+
+# reference completions and logits of the unquantised model (no KV cache: every step recomputes the prefix)
+sequences, reference = [], []
+for prompt in PROMPTS:
+    tokens = torch.tensor([model.tokenizer(format_prompt(prompt)).input_ids], device=args.device)
+    n_prompt = tokens.shape[1]
+    with torch.inference_mode():
+        for _ in range(args.max_gen_len):
+            logits, _ = model.forward_inference(tokens, 0)
+            next_token = logits.argmax(dim=-1, keepdim=True)
+            tokens = torch.cat([tokens, next_token], dim=1)
+            if next_token.item() == model.tokenizer.eos_token_id:
+                break
+    sequences.append((tokens, n_prompt))
+    reference.append(completion_logits(tokens, n_prompt))
+
+if args.compute_dtype is None:
+    args.compute_dtype = 'bfloat16' if args.device == 'cpu' else None
+model.quantize(args.bits, args.group_size,
+               compute_dtype=None if args.compute_dtype is None else getattr(torch, args.compute_dtype))
+
+agree, kl, count = 0.0, 0.0, 0
+print(f"int{args.bits}" + (f" group size {args.group_size}" if args.bits == 4 else " per channel"))
+for prompt, (tokens, n_prompt), ref in zip(PROMPTS, sequences, reference):
+    out = completion_logits(tokens, n_prompt)
+    prompt_agree = (out.argmax(dim=-1) == ref.argmax(dim=-1)).float().sum().item()
+    prompt_kl = F.kl_div(out.log_softmax(-1), ref.log_softmax(-1), log_target=True, reduction='sum').item()
+    agree, kl, count = agree + prompt_agree, kl + prompt_kl, count + len(ref)
+    print(f"  top-1 agreement {prompt_agree / len(ref):.3f}  KL {prompt_kl / len(ref):.4f}  {prompt}")
+agree, kl = agree / count, kl / count
+passed = agree >= args.min_top1 and kl <= args.max_kl
+print(f"overall: top-1 agreement {agree:.3f} (min {args.min_top1}), KL {kl:.4f} (max {args.max_kl}) over {count} "
+      f"tokens: {'PASSED' if passed else 'FAILED'}")
+
+if args.output is not None and (passed or args.force):
+    save_quantized(model, args.output)
+    print(f"Quantised checkpoint saved to {args.output}")
+sys.exit(0 if passed else 1)
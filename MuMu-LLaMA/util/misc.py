@@ -302,13 +302,20 @@ def save_model(args, epoch, model, model_without_ddp, optimizer, loss_scaler):
     if loss_scaler is not None:
         checkpoint_paths = [output_dir / ('checkpoint.pth')]
         for checkpoint_path in checkpoint_paths:
-            to_save = {
-                'model': model_without_ddp.state_dict(),
+            if not is_main_process():
+                continue
+            if getattr(args, 'full_checkpoint', False):
+                to_save = {'model': model_without_ddp.state_dict()}
+            else:
+                # only the adapter: what is trained, plus a manifest of the frozen base weights
+                to_save = getattr(model_without_ddp, 'module', model_without_ddp).adapter_checkpoint(
+                    hashes=not getattr(args, 'no_base_hashes', False))
+            to_save.update({
                 'optimizer': optimizer.state_dict(),
                 'epoch': epoch,
                 'scaler': loss_scaler.state_dict(),
                 'args': args,
-            }
+            })
 
             save_on_master(to_save, checkpoint_path)
     else:
@@ -316,7 +323,7 @@ def save_model(args, epoch, model, model_without_ddp, optimizer, loss_scaler):
         model.save_checkpoint(save_dir=args.output_dir, tag="checkpoint", client_state=client_state)
 
 
-def load_model(model_without_ddp, optimizer, loss_scaler, path):
+def load_model(model_without_ddp, optimizer, loss_scaler, path, verify_base_hashes=False):
     if path.startswith('https'):
         checkpoint = torch.hub.load_state_dict_from_url(
             path, map_location='cpu', check_hash=True)
@@ -336,7 +343,13 @@ def load_model(model_without_ddp, optimizer, loss_scaler, path):
         key = key.replace("iu_vit_softmax", "iu_vivit_softmax")
         new_ckpt[key] = value
 
-    load_result = model_without_ddp.load_state_dict(new_ckpt, strict=True)
+    from llama.mumu_llama import is_adapter_checkpoint
+    if is_adapter_checkpoint(checkpoint):
+        # the base weights come from the checkpoints model_without_ddp was built with
+        load_result = model_without_ddp.load_adapter_checkpoint({**checkpoint, 'model': new_ckpt},
+                                                                verify_hashes=verify_base_hashes)
+    else:
+        load_result = model_without_ddp.load_state_dict(new_ckpt, strict=True)
     assert len(load_result.unexpected_keys) == 0, f"Unexpected keys: {load_result.unexpected_keys}"
     print("Load checkpoint %s" % path)
     return checkpoint['epoch']